@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pandas as pd
+
+from ssc_utils.scenario import scenario_spec, statistical_parameters
+from ssc_utils.pipeline import pipeline
+from ssc_utils.executor import local_executor, query_cache
+from ssc_utils.tracing import tracer, NO_TRACE
+import ssc_utils.calculator as c
+
+# Headless batch runner: computes the sample size tables of many scenarios in one job.
+#
+#   python -m ssc_utils.batch scenarios.yaml --out planning_pack.csv
+#
+# Scenario file (YAML or JSON), metrics can be ratio or quantile metrics too (see metric_switcher.metric_kind):
+#
+#   defaults:
+#     effect: 0.01
+#     power: 0.8
+#   scenarios:
+#     - name: roku_tvt
+#       metric: tvt
+#       filters: {attribute: [platform, '=', "'ROKU'"]}
+#     - name: roku_visits_2pct
+#       metric: visits
+#       filters: {attribute: [platform, '=', "'ROKU'"]}
+#       effect: 0.02
+#       treatments: 2
+#
+# Scenarios with the same filters share one query (all their metrics are computed over the same eligible devices),
+# and identical queries are only run once (see pipeline/query_cache).
+
+
+def load_scenarios(path):
+    """
+    Reads a scenario file, filling in the defaults.
+
+    Returns: list of scenario.scenario_spec
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml  # only needed for YAML scenario files
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+
+    if isinstance(spec, list):
+        spec = {'scenarios': spec}
+    defaults = spec.get('defaults', {})
+
+    scenarios = []
+    for position, scenario in enumerate(spec['scenarios']):
+        scenario = dict({'name': 'scenario_' + str(position + 1)}, **scenario)
+        scenarios.append(scenario_spec.from_dict(scenario, defaults = defaults))
+    return scenarios
+
+
+def query_groups(scenarios):
+    """
+    Groups scenarios that can share one query (same filters).
+
+    Returns: dict of filter_spec -> list of scenarios
+    """
+    groups = {}
+    for scenario in scenarios:
+        groups.setdefault(scenario.filters, []).append(scenario)
+    return groups
+
+
+def calculate_scenario(raw_df, scenario):
+    """
+    Sample size table of one scenario, from the query results of its group. Top level so it can run in a process pool.
+
+    Returns: dataframe
+    """
+    df = c.calculate_sample_required(df = raw_df[raw_df['metric_name'] == scenario.metric_name],
+                                     parameters = scenario.parameters)
+
+    scenario_cols = ['scenario', 'scenario_metric'] + list(statistical_parameters.__dataclass_fields__.keys())
+    scenario_values = [scenario.name, scenario.metric] + [getattr(scenario.parameters, col) for col in scenario_cols[2:]]
+    for position, (col, value) in enumerate(zip(scenario_cols, scenario_values)):
+        df.insert(position, col, value)
+    return df
+
+
+def run_batch(scenarios, batch_pipeline, query_workers = 4, calc_processes = 1, trace = False):
+    """
+    Runs every scenario: one query per group (in a thread pool, the warehouse does the work),
+    then one sample size table per scenario (optionally in a process pool).
+
+    Returns: tuple (dataframe with all sample size tables, list of tracers)
+    """
+    groups = query_groups(scenarios)
+    tracers = []
+
+    def run_group(group):
+        group_tracer = tracer(tags = {'scenarios': [s.name for s in group],
+                                      'metrics': [s.metric for s in group],
+                                      'filters': repr(group[0].filters)}) if trace else NO_TRACE
+        tracers.append(group_tracer)
+        return batch_pipeline.summary(group[0].filters, [s.metric for s in group], tracer = group_tracer)
+
+    group_list = list(groups.values())
+    with ThreadPoolExecutor(max_workers = query_workers) as pool:
+        raw_dfs = list(pool.map(run_group, group_list))
+
+    jobs = [(raw_df, scenario) for raw_df, group in zip(raw_dfs, group_list) for scenario in group]
+    if calc_processes > 1:
+        with ProcessPoolExecutor(max_workers = calc_processes) as pool:
+            tables = list(pool.map(calculate_scenario, *zip(*jobs)))
+    else:
+        tables = [calculate_scenario(raw_df, scenario) for raw_df, scenario in jobs]
+
+    # keep the order of the scenario file
+    order = {scenario.name: position for position, scenario in enumerate(scenarios)}
+    tables = sorted(tables, key = lambda df: order[df['scenario'].iloc[0]] if len(df) > 0 else len(order))
+    return pd.concat(tables, ignore_index = True), tracers
+
+
+def write_results(df, path):
+    """Writes Parquet when the path ends with .parquet, CSV otherwise"""
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index = False)
+    else:
+        df.to_csv(path, index = False)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run many sample size scenarios from a YAML/JSON spec file.')
+    parser.add_argument('spec', help = 'scenario file (.yaml, .yml or .json)')
+    parser.add_argument('--out', default = 'sample_sizes.csv', help = 'output file (.csv or .parquet)')
+    parser.add_argument('--query-workers', type = int, default = 4, help = 'queries running at the same time')
+    parser.add_argument('--calc-processes', type = int, default = 1, help = 'processes for the sample size calculations')
+    parser.add_argument('--cache-dir', default = None, help = 'query result cache (default ~/.ssc_utils/query_cache)')
+    parser.add_argument('--local-dsn', default = None, help = 'run on a local Postgres database instead of Redshift')
+    parser.add_argument('--trace', default = None, help = 'append per-stage traces to this JSON lines file')
+    args = parser.parse_args(argv)
+
+    executor = None
+    if args.local_dsn is not None:
+        import psycopg2  # only needed for the local backend
+        executor = local_executor(psycopg2.connect(args.local_dsn))
+    cache = query_cache(args.cache_dir) if args.cache_dir is not None else None
+
+    scenarios = load_scenarios(args.spec)
+    results, tracers = run_batch(scenarios, pipeline(executor = executor, cache = cache),
+                                 query_workers = args.query_workers,
+                                 calc_processes = args.calc_processes,
+                                 trace = args.trace is not None)
+    write_results(results, args.out)
+    if args.trace is not None:
+        for group_tracer in tracers:
+            group_tracer.to_jsonl(args.trace)
+
+    print('{} scenarios, {} queries -> {}'.format(len(scenarios), len(query_groups(scenarios)), os.path.abspath(args.out)), file = sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
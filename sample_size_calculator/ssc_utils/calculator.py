@@ -1,6 +1,9 @@
 from statsmodels.stats.power import tt_ind_solve_power
 import numpy as np
 
+from ssc_utils.reach import accrual_weeks_required
+from ssc_utils.cuped import PLATFORMS
+
 # Set of helper functions that do the power tests
 
 # Functions that set default parameters
@@ -31,31 +34,169 @@ def sample_power_ttest(p1, p2, sd_diff, alpha=0.05, power=0.8, ratio=1, alternat
                          alternative=alternative) # Potential improvement: make this able to handle one-sided tests
     return np.array(n).round()
 
+def delta_method_summary(moments_df, use_cuped = True):
+    """
+    Mean and per-device standard deviation of ratio metrics (ratio of means, sum(y) / sum(x)), from the moments of
+    ratio_summary's query, in the format calculate_sample_required takes (avg_cuped_result, std_cuped_result).
+    
+    The delta method linearizes the ratio: R_hat - R ~ mean of L = (y - R * x) / mean(x), so Var(R_hat) = Var(L) / n.
+    With use_cuped, L is adjusted with the same linearization of the covariates (y0 - R0 * x0) / mean(x0):
+    Var(L) * (1 - corr(L, L0)^2).
+    
+    Returns: dataframe (metric_name, platform, observations, avg_cuped_result, std_cuped_result, std_result)
+    """
+    n = moments_df['devices'].to_numpy(dtype = float)
+    mean = {var: moments_df['sum_' + var].to_numpy(dtype = float) / n for var in ('y', 'x', 'y0', 'x0')}
+    
+    def cov(a, b):
+        col = 'sum_' + a + '_' + b if 'sum_' + a + '_' + b in moments_df.columns else 'sum_' + b + '_' + a
+        return (moments_df[col].to_numpy(dtype = float) - n * mean[a] * mean[b]) / (n - 1)
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ratio = mean['y'] / mean['x']
+        var_l = (cov('y', 'y') - 2 * ratio * cov('y', 'x') + ratio ** 2 * cov('x', 'x')) / mean['x'] ** 2
+        
+        std_l = np.sqrt(var_l)
+        if use_cuped:
+            ratio_0 = mean['y0'] / mean['x0']
+            var_l0 = (cov('y0', 'y0') - 2 * ratio_0 * cov('y0', 'x0') + ratio_0 ** 2 * cov('x0', 'x0')) / mean['x0'] ** 2
+            cov_l_l0 = (cov('y', 'y0') - ratio_0 * cov('y', 'x0') - ratio * cov('x', 'y0') + ratio * ratio_0 * cov('x', 'x0')) / (mean['x'] * mean['x0'])
+            adjusted = var_l - cov_l_l0 ** 2 / var_l0
+            # no usable covariate (all new devices, constant covariate): no adjustment
+            std_l = np.where(np.isfinite(adjusted) & (var_l0 > 0), np.sqrt(np.maximum(adjusted, 0)), std_l)
+    
+    return moments_df[['metric_name', 'platform', 'observations']].assign(avg_cuped_result = ratio,
+                                                                         std_cuped_result = std_l,
+                                                                         std_result = np.sqrt(var_l))
+
+def post_stratify(df, weights = None, strata = None, col_name_p = 'avg_cuped_result', std_col_name = 'std_cuped_result'):
+    """
+    Replaces the mean and std of every metric's 'ALL' row of the cuped results by their post-stratified values, from
+    the per-stratum rows of the same results (no extra query). All metrics at once.
+
+    With stratum shares w_h (observations of the stratum / of all strata), means mu_h and stds sigma_h:
+        mean = sum(w_h mu_h),  std = sqrt(sum(w_h sigma_h^2))
+    ie. the between-strata part of the 'ALL' variance is left out, as a post-stratified estimator does (up to an
+    O(1/n^2) term). The strata are also CUPED-adjusted separately (their own theta).
+
+    Args:
+        weights: optional dict of stratum -> planned share of the experiment's traffic (normalized to 1), instead of the
+                 observed shares. Strata not in weights get 0.
+        strata: platform values whose rows partition 'ALL'; default is the platform_type rows (every platform that is
+                neither 'ALL' nor in cuped.PLATFORMS)
+
+    Raises: ValueError naming the metrics and strata when a metric's 'ALL' row can't be stratified: it has no strata
+            rows, or no row for a stratum with a planned weight
+
+    Returns: dataframe, a copy of df with the 'ALL' rows replaced and the original std in unstratified_std
+    """
+    df = df.copy()
+    if strata is None:
+        strata = [platform for platform in df['platform'].unique() if platform != 'ALL' and platform not in PLATFORMS]
+    rows = df[df['platform'].isin(list(strata))]
+
+    all_rows = (df['platform'] == 'ALL').to_numpy()
+    metrics = df.loc[all_rows, 'metric_name']
+    present = rows.groupby('metric_name')['platform'].agg(set).to_dict()
+    if weights is None:
+        unstratified = [metric for metric in metrics.unique() if metric not in present]
+        if unstratified:
+            raise ValueError('no strata rows ' + str(list(strata)) + ' to post-stratify metrics ' + str(unstratified))
+    else:
+        planned = [stratum for stratum, weight in weights.items() if weight > 0]
+        missing = {metric: [stratum for stratum in planned if stratum not in present.get(metric, set())] for metric in metrics.unique()}
+        missing = {metric: missing_strata for metric, missing_strata in missing.items() if missing_strata}
+        if missing:
+            raise ValueError('no rows for the weighted strata (metric -> missing strata): ' + str(missing))
+
+    if weights is None:
+        share = rows['observations'] / rows.groupby('metric_name')['observations'].transform('sum')
+    else:
+        total = float(sum(weights.values()))
+        share = rows['platform'].map({stratum: weight / total for stratum, weight in weights.items()}).fillna(0.0)
+
+    stratified = rows[['metric_name']].assign(mean = share * rows[col_name_p],
+                                              variance = share * np.square(rows[std_col_name]),
+                                              share = share).groupby('metric_name').sum(min_count = 1)
+
+    df['unstratified_std'] = df[std_col_name]
+    df.loc[all_rows, col_name_p] = metrics.map(stratified['mean']).to_numpy()
+    df.loc[all_rows, std_col_name] = np.sqrt(metrics.map(stratified['variance']).to_numpy())
+    return df
+
 # ---------- Constants ---------- # 
 
 def calculate_sample_required(df, 
-                              effect_size_relative, 
-                              number_variations, 
-                              allocation, 
-                              power, 
-                              alpha, 
+                              effect_size_relative = None, 
+                              number_variations = None, 
+                              allocation = None, 
+                              power = None, 
+                              alpha = None, 
                               col_name_p = 'avg_cuped_result', 
                               std_col_name = 'std_cuped_result', 
-                              ratio = 1):
+                              ratio = 1,
+                              parameters = None,
+                              grid = None,
+                              accrual = None,
+                              stratify = False,
+                              strata_weights = None):
+    """
+    Adds sample_required and weeks_required to a copy of the cuped query results (df is not modified).
+    
+    Parameters come either from the notebook widgets (effect_size_relative ... alpha, read via .result) 
+    or from a scenario.statistical_parameters (parameters), which takes precedence.
+    
+    grid: optional power_grid.power_grid; rows it covers are looked up instead of solved, the rest use tt_ind_solve_power
+    accrual: optional dict of platform -> cumulative unique reach over 1..N weeks (reach.accrual_curves); rows whose
+             platform has a curve get weeks_required on it instead of assuming devices accrue linearly
+    stratify: post-stratified mean/std for the 'ALL' rows, from the platform_type rows (see post_stratify);
+              strata_weights (dict of platform_type -> planned traffic share) re-weights them and implies stratify.
+              Raises ValueError when a metric is missing the strata rows (see post_stratify)
     
-    corrected_alpha = alpha.result / number_variations.result
-    p2_multiplicative_factor =  1 + effect_size_relative.result
+    Returns: dataframe
+    """
+    
+    if parameters is None:
+        # imported here: scenario imports this module for its defaults
+        from ssc_utils.scenario import statistical_parameters
+        parameters = statistical_parameters.from_widgets(effect_size_relative, number_variations, allocation, power, alpha, ratio = ratio)
+    
+    if stratify or strata_weights is not None:
+        df = post_stratify(df, weights = strata_weights, col_name_p = col_name_p, std_col_name = std_col_name)
+    else:
+        df = df.copy()
+    corrected_alpha = parameters.alpha / parameters.treatments
+    p2_multiplicative_factor =  1 + parameters.effect
 
     # ---------- Implementation ---------- #
-    df['sample_required'] =  df.apply(lambda row: sample_power_ttest(p1 = row[col_name_p], 
-                                                                     p2 = row[col_name_p] * p2_multiplicative_factor, 
-                                                                     sd_diff = row[std_col_name], 
-                                                                     alpha = corrected_alpha, 
-                                                                     power = power.result, 
-                                                                     ratio = ratio
-                                                                    ), axis=1)
-
-    df['weeks_required'] = np.divide(df['sample_required'], (df['observations'] * 0.5 * allocation.result))
+    def solve(rows):
+        return rows.apply(lambda row: sample_power_ttest(p1 = row[col_name_p], 
+                                                         p2 = row[col_name_p] * p2_multiplicative_factor, 
+                                                         sd_diff = row[std_col_name], 
+                                                         alpha = corrected_alpha, 
+                                                         power = parameters.power, 
+                                                         ratio = parameters.ratio
+                                                        ), axis=1)
+    
+    looked_up = None
+    if grid is not None:
+        std_effect_size = np.divide(np.abs(df[col_name_p] * p2_multiplicative_factor - df[col_name_p]), df[std_col_name])
+        looked_up = grid.lookup(std_effect_size, alpha = corrected_alpha, power = parameters.power, ratio = parameters.ratio)
+    
+    if looked_up is None:
+        df['sample_required'] = solve(df)
+    else:
+        df['sample_required'] = np.round(looked_up)
+        off_grid = ~np.isfinite(looked_up)
+        if off_grid.any():
+            df.loc[off_grid, 'sample_required'] = solve(df[off_grid])
+
+    df['weeks_required'] = np.divide(df['sample_required'], (df['observations'] * 0.5 * parameters.allocation))
+    for platform, curve in (accrual or {}).items():
+        rows = (df['platform'] == platform).to_numpy()
+        if rows.any():
+            df.loc[rows, 'weeks_required'] = accrual_weeks_required(df.loc[rows, 'sample_required'], df.loc[rows, 'observations'], 
+                                                                    curve, parameters.allocation)
     df['sample_required'] = df['sample_required'].astype('int')
     df['weeks_required'] = df['weeks_required'].astype('float')
     
@@ -0,0 +1,292 @@
+import numpy as np
+import pandas as pd
+
+from ssc_utils.cuped import cuped, PLATFORMS
+
+# Multi-covariate variance reduction (CUPAC-style regression adjustment).
+#
+# cuped.py adjusts each metric with one covariate, the metric itself before first exposure. Here the adjusted metric is
+# y - (X - mean(X)) theta with several pre-exposure covariates X, theta from the least squares fit of y on X.
+# The fit only needs the normal equations, so each metric x platform group is reduced in one pass to
+# n, sum(X), sum(y), X'X, X'y and y'y. Those sums are mergeable: the warehouse computes them per group in one GROUP BY,
+# and chunks/shards of device-level rows (device_store) can be accumulated separately and merged.
+#
+# Platform is a covariate too: the 'ALL' and platform_type rows pool the within-platform fits (platform fixed effects),
+# by adding the per-platform centered sums.
+
+
+# name -> SQL expression over metrics m and device_covariates d
+COVARIATES = [
+    ('metric_covariate', 'COALESCE(m.metric_covariate, 0)'),
+    ('new_device', 'CASE WHEN m.metric_covariate IS NULL THEN 1.0 ELSE 0.0 END'),
+    ('pre_visits', 'COALESCE(d.pre_visits, 0)'),
+    ('device_age_days', 'COALESCE(d.device_age_days, 0)'),
+]
+
+# raw_user_data columns device_covariates reads, besides the metrics' own (see pipeline.generate_metrics_ctes)
+RAW_COLUMNS = ('visit_total_count',)
+
+
+class normal_equations(object):
+    """
+    Mergeable least squares accumulators, one per group key: n, sum(X), sum(y), X'X, X'y, y'y.
+
+    update() adds chunks of rows, merge() adds another accumulator (another chunk/shard), solve() fits every group.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.keys = []
+        self._index = {}
+        self.n = np.zeros(0)
+        self.sum_x = np.zeros((0, k))
+        self.sum_y = np.zeros(0)
+        self.xx = np.zeros((0, k, k))
+        self.xy = np.zeros((0, k))
+        self.yy = np.zeros(0)
+
+    def group_indexes(self, keys):
+        """Row of each key in the accumulators, adding new groups as needed"""
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self._index]
+        if new_keys:
+            for key in new_keys:
+                self._index[key] = len(self.keys)
+                self.keys.append(key)
+            grow = len(new_keys)
+            self.n = np.concatenate([self.n, np.zeros(grow)])
+            self.sum_x = np.concatenate([self.sum_x, np.zeros((grow, self.k))])
+            self.sum_y = np.concatenate([self.sum_y, np.zeros(grow)])
+            self.xx = np.concatenate([self.xx, np.zeros((grow, self.k, self.k))])
+            self.xy = np.concatenate([self.xy, np.zeros((grow, self.k))])
+            self.yy = np.concatenate([self.yy, np.zeros(grow)])
+        return np.array([self._index[key] for key in keys], dtype = int)
+
+    def update(self, keys, X, y, codes = None):
+        """
+        Adds rows. Rows are grouped by integer codes: counts and sums of y are np.bincount, X'X and X'y one matrix
+        product per group.
+
+        Args:
+            keys: one group key (hashable) per row, or a single key for all rows,
+                  or with codes the list of keys the codes index
+            X: (rows x k) covariates
+            y: (rows,) metric values
+            codes: optional int array, the index into keys of each row (no per-row key objects to hash)
+        """
+        X = np.asarray(X, dtype = float).reshape(len(y), self.k)
+        y = np.asarray(y, dtype = float)
+        if codes is not None:
+            codes, uniques = np.asarray(codes), list(keys)
+        elif isinstance(keys, tuple) or np.ndim(keys) == 0:
+            codes, uniques = np.zeros(len(y), dtype = int), [keys]
+        else:
+            codes, uniques = pd.factorize(pd.Series(list(keys)))
+        present, inverse = np.unique(codes, return_inverse = True)
+        inverse = inverse.reshape(-1)
+        groups = self.group_indexes([uniques[code] for code in present])
+
+        # groups are distinct, so plain fancy-index += is safe
+        counts = np.bincount(inverse, minlength = len(groups))
+        self.n[groups] += counts
+        self.sum_y[groups] += np.bincount(inverse, weights = y, minlength = len(groups))
+        self.yy[groups] += np.bincount(inverse, weights = y * y, minlength = len(groups))
+
+        if len(groups) > 1:
+            order = np.argsort(inverse, kind = 'stable')
+            X, y = X[order], y[order]
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        for g, group in enumerate(groups):
+            X_g, y_g = X[bounds[g]:bounds[g + 1]], y[bounds[g]:bounds[g + 1]]
+            self.sum_x[group] += X_g.sum(axis = 0)
+            self.xy[group] += X_g.T.dot(y_g)
+            self.xx[group] += X_g.T.dot(X_g)
+
+    def merge(self, other):
+        """Adds another accumulator's sums (same covariates). Returns: self"""
+        groups = self.group_indexes(other.keys)
+        np.add.at(self.n, groups, other.n)
+        np.add.at(self.sum_y, groups, other.sum_y)
+        np.add.at(self.yy, groups, other.yy)
+        np.add.at(self.sum_x, groups, other.sum_x)
+        np.add.at(self.xy, groups, other.xy)
+        np.add.at(self.xx, groups, other.xx)
+        return self
+
+    @classmethod
+    def from_moments(cls, moments_df, key_cols, k):
+        """Accumulators from the sums of cupac's query (generate_cupac_cte), one group per row"""
+        accumulators = cls(k)
+        groups = accumulators.group_indexes(list(moments_df[key_cols].itertuples(index = False, name = None)))
+        col = lambda name: moments_df[name].to_numpy(dtype = float)
+        accumulators.n[groups] = col('n')
+        accumulators.sum_y[groups] = col('sum_y')
+        accumulators.yy[groups] = col('sum_yy')
+        for i in range(k):
+            accumulators.sum_x[groups, i] = col('sum_x' + str(i))
+            accumulators.xy[groups, i] = col('sum_x' + str(i) + '_y')
+            for j in range(i, k):
+                accumulators.xx[groups, i, j] = accumulators.xx[groups, j, i] = col('sum_x' + str(i) + '_x' + str(j))
+        return accumulators
+
+    def centered(self):
+        """
+        Returns: dict of n, mean_y, and the centered sums of squares/cross-products sxx (G x k x k), sxy (G x k), syy (G,)
+        """
+        n = np.maximum(self.n, 1)
+        mean_x, mean_y = self.sum_x / n[:, None], self.sum_y / n
+        return {'n': self.n,
+                'mean_y': mean_y,
+                'sxx': self.xx - n[:, None, None] * mean_x[:, :, None] * mean_x[:, None, :],
+                'sxy': self.xy - n[:, None] * mean_x * mean_y[:, None],
+                'syy': self.yy - n * mean_y ** 2}
+
+
+def pool(centered, group_of, keys):
+    """
+    Pools centered sums into coarser groups (within-group fits = group fixed effects).
+
+    Args:
+        centered: normal_equations.centered()
+        group_of: function of a fine key -> coarse key (None to leave the fine group out)
+        keys: the fine keys, in the order of centered
+
+    Returns: tuple (coarse keys, centered sums of the coarse groups)
+    """
+    coarse = [group_of(key) for key in keys]
+    coarse_keys = [key for key in dict.fromkeys(coarse) if key is not None]
+    index = {key: i for i, key in enumerate(coarse_keys)}
+    keep = np.array([key is not None for key in coarse])
+    codes = np.array([index[key] for key in coarse if key is not None], dtype = int)
+
+    pooled = {}
+    for name in ('n', 'sxx', 'sxy', 'syy'):
+        pooled[name] = np.zeros((len(coarse_keys),) + centered[name].shape[1:])
+        np.add.at(pooled[name], codes, centered[name][keep])
+    total_y = np.zeros(len(coarse_keys))
+    np.add.at(total_y, codes, (centered['mean_y'] * centered['n'])[keep])
+    pooled['mean_y'] = total_y / np.maximum(pooled['n'], 1)
+    return coarse_keys, pooled
+
+
+def solve(centered, ridge = 1e-9):
+    """
+    Least squares fit of every group at once (pseudo-inverse, so constant or collinear covariates are fine).
+
+    Returns: tuple (theta (G x k), adjusted mean (G,), adjusted per-device standard deviation (G,))
+    """
+    sxx = centered['sxx']
+    k = sxx.shape[-1]
+    scale = np.maximum(np.trace(sxx, axis1 = 1, axis2 = 2) / k, 1e-300)
+    theta = np.einsum('gij,gj->gi', np.linalg.pinv(sxx + ridge * scale[:, None, None] * np.eye(k)), centered['sxy'])
+    residual = centered['syy'] - np.einsum('gi,gi->g', centered['sxy'], theta)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        std = np.sqrt(np.maximum(residual, 0) / (centered['n'] - 1))
+    # centered covariates: the adjusted mean is the metric's mean
+    return theta, centered['mean_y'], std
+
+
+def adjusted_summary(accumulators, sample_multiplier = 1.0):
+    """
+    Regression-adjusted mean/std per metric at the 'ALL', platform_type and platform levels, from accumulators keyed by
+    (metric_name, platform_type, platform), in the format calculate_sample_required takes.
+
+    Returns: dataframe (metric_name, platform, observations, avg_cuped_result, std_cuped_result)
+    """
+    centered = accumulators.centered()
+    levels = [
+        pool(centered, lambda key: (key[0], 'ALL'), accumulators.keys),
+        pool(centered, lambda key: (key[0], key[1]), accumulators.keys),
+        pool(centered, lambda key: (key[0], key[2]) if key[2] in PLATFORMS else None, accumulators.keys)
+    ]
+
+    dfs = []
+    for keys, level in levels:
+        if not keys:
+            continue
+        _, mean, std = solve(level)
+        dfs.append(pd.DataFrame({'metric_name': [key[0] for key in keys],
+                                 'platform': [key[1] for key in keys],
+                                 'observations': level['n'] * sample_multiplier,
+                                 'avg_cuped_result': mean,
+                                 'std_cuped_result': std}))
+    return pd.concat(dfs, ignore_index = True)
+
+
+def accumulate_device_store(store, chunk_rows = 10000000, accumulators = None):
+    """
+    Accumulates a device_store in chunks, with the covariates it has (metric_covariate and new_device).
+    Pass the accumulators of other chunks/shards to merge into them.
+
+    Returns: normal_equations keyed by (metric_name, platform_type, platform)
+    """
+    accumulators = accumulators if accumulators is not None else normal_equations(2)
+    platform_types = store.labels['platform_type']
+    for metric_name in store.metrics():
+        for platform in store.platforms(metric_name):
+            start, stop = store.row_range(metric_name, platform)
+            keys = [(metric_name, platform_type, platform) for platform_type in platform_types]
+            for chunk_start in range(start, stop, chunk_rows):
+                rows = slice(chunk_start, min(chunk_start + chunk_rows, stop))
+                covariate = store.columns['metric_covariate'][rows].astype(float)
+                new_device = np.isnan(covariate)
+                X = np.column_stack([np.where(new_device, 0.0, covariate), new_device.astype(float)])
+                accumulators.update(keys, X, store.columns['metric_result'][rows], codes = store.columns['platform_type'][rows])
+    return accumulators
+
+
+class cupac(object):
+
+    def generate_cupac_cte(self, event2_condition_interact = None, sample_pct = 100, filters = None):
+        """
+        Generates the SQL that reduces the metrics CTE (metric_summary) to the normal equation sums of every
+        metric x platform, with the COVARIATES. Should always be the last CTE in the final SQL string, in place of cuped's.
+        The sample multiplier for observations is left to adjusted_summary (see cuped.sample_multiplier).
+
+        Returns: String
+        """
+        covariates = [expression for _, expression in COVARIATES]
+        k = len(covariates)
+        sums = ['COUNT(*)::float AS n', 'SUM(y) AS sum_y', 'SUM(y * y) AS sum_yy']
+        sums += ['SUM(x{i}) AS sum_x{i}'.format(i = i) for i in range(k)]
+        sums += ['SUM(x{i} * y) AS sum_x{i}_y'.format(i = i) for i in range(k)]
+        sums += ['SUM(x{i} * x{j}) AS sum_x{i}_x{j}'.format(i = i, j = j) for i in range(k) for j in range(i, k)]
+
+        return """
+            , device_covariates AS (
+              SELECT device_id,
+                     platform,
+                     SUM(CASE WHEN ds < first_exposure_ds THEN visit_total_count ELSE 0 END)::float AS pre_visits,
+                     DATEDIFF(day, MIN(device_first_seen_ts), MIN(first_exposure_ds))::float AS device_age_days
+              FROM raw_user_data
+              GROUP BY 1, 2
+            )
+
+            , cupac_values AS (
+              SELECT m.metric_name,
+                     m.platform_type,
+                     m.platform,
+                     m.metric_result AS y,
+                     {covariates}
+              FROM metrics AS m
+                LEFT JOIN device_covariates AS d
+                  ON m.device_id = d.device_id
+                  AND m.platform = d.platform
+            )
+
+            SELECT metric_name,
+                   platform_type,
+                   platform,
+                   {sums}
+            FROM cupac_values
+            GROUP BY 1, 2, 3
+            """.format(covariates = ',\n                     '.join(expression + ' AS x' + str(i) for i, expression in enumerate(covariates)),
+                       sums = ',\n                   '.join(sums))
+
+    def summary(self, moments_df, event2_condition_interact = None, sample_pct = 100, filters = None):
+        """
+        Adjusted mean/std from the results of generate_cupac_cte's query (same arguments, for the observations scaling).
+
+        Returns: dataframe, see adjusted_summary
+        """
+        accumulators = normal_equations.from_moments(moments_df, ['metric_name', 'platform_type', 'platform'], len(COVARIATES))
+        return adjusted_summary(accumulators, cuped().sample_multiplier(event2_condition_interact, sample_pct, filters))
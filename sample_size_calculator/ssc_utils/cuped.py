@@ -1,16 +1,44 @@
+from ssc_utils.raw_user_data import check_sample_pct
+
+# platforms that get their own row (the others are only in their platform_type and 'ALL' rows)
+PLATFORMS = ('ROKU','AMAZON','IPHONE','IPAD','ANDROID','SONY','PS4','COMCAST','VIZIO','XBOXONE','SAMSUNG','COX')
+
+
 class cuped(object):
 
-    def generate_cuped_cte(self, event2_condition_interact):
+    def sample_multiplier(self, event2_condition_interact = None, sample_pct = 100, filters = None):
+        """
+        Factor from counted devices to observations: event filters run on sampled_analytics_thousandth (x1000),
+        and raw_user_data may keep only sample_pct percent of devices.
+
+        Returns: float
+        """
+        check_sample_pct(sample_pct)
+        if filters is not None:
+            has_primary_event = filters.has_primary_event
+        else:
+            has_primary_event = event2_condition_interact.value[0] != 'no event filter'
+        
+        if not has_primary_event:
+            sample_multiplier = 1.0
+        else:
+            sample_multiplier = 1000.0
+        return sample_multiplier * 100.0 / sample_pct
+
+    def generate_cuped_cte(self, event2_condition_interact = None, sample_pct = 100, filters = None, device_level = False):
         """
         Generates the SQL CTEs that go through CUPED calculations. Should always be the last CTE in the final SQL string. 
+        
+        Args:
+            event2_condition_interact: primary event widget (event filters run on sampled_analytics_thousandth, so observations are scaled by 1000)
+            sample_pct: percent of devices sampled in raw_user_data (observations are scaled back up by 100/sample_pct)
+            filters: filter_expression.filter_spec, used instead of event2_condition_interact when given
+            device_level: return one cuped_result per device, metric and platform (incl. 'ALL' and platform types) instead of the summary
             
         Returns: String
         """
         
-        if event2_condition_interact.value[0] == 'no event filter':
-            sample_multiplier = '1.0'
-        else:
-            sample_multiplier = '1000.0'
+        sample_multiplier = str(self.sample_multiplier(event2_condition_interact, sample_pct, filters))
             
         base_cuped_query = """
             -- Cuped values
@@ -33,7 +61,7 @@ class cuped(object):
                 AVG(metric_result) OVER (PARTITION BY metric_name, platform) AS after_covariate_average,
                 STDDEV(metric_covariate) OVER (PARTITION BY metric_name, platform) AS covariate_standard_dev
               FROM metrics
-              WHERE platform in ('ROKU','AMAZON','IPHONE','IPAD','ANDROID','SONY','PS4','COMCAST','VIZIO','XBOXONE','SAMSUNG','COX')
+              WHERE platform in {platforms}
             )
 
             , cuped_data_1 AS (
@@ -105,6 +133,10 @@ class cuped(object):
                   AND a.metric_name = b.metric_name
             )
 
+            {final_select}
+            """
+
+        summary_query = """
             , cuped_results AS (
                 SELECT metric_name,
                         'ALL' as platform,
@@ -149,5 +181,14 @@ class cuped(object):
                    std_cuped_result
             FROM cuped_results        
             """
-        
-        return base_cuped_query.format(sampling = sample_multiplier)
\ No newline at end of file
+
+        device_level_query = """
+            SELECT device_id, metric_name, 'ALL' AS platform, cuped_result FROM cuped_metrics_1
+            UNION ALL
+            SELECT device_id, metric_name, platform, cuped_result FROM cuped_metrics_2
+            UNION ALL
+            SELECT device_id, metric_name, platform, cuped_result FROM cuped_metrics_3
+            """
+
+        final_select = device_level_query if device_level else summary_query.format(sampling = sample_multiplier)
+        return base_cuped_query.format(final_select = final_select, platforms = str(PLATFORMS))
\ No newline at end of file
@@ -0,0 +1,223 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Compact on-disk columnar store of the device level rows of the metrics CTE (pipeline.generate_device_metrics_sql).
+#
+# One directory per extract:
+#   metric_result.npy, metric_covariate.npy       float32 (NULL covariates are NaN)
+#   metric_name.npy, platform.npy, platform_type.npy   int16 codes into the labels in meta.json
+#   device_key.npy                                uint64 hash of device_id (enough to join/dedupe, 8 bytes instead of a string)
+#   meta.json                                     labels, row count, and the row-group index
+#
+# Rows are sorted by (metric_name, platform), so every metric, and every platform within a metric, is one contiguous
+# row group: slices are views of the memory-mapped files (zero copy), and reopening a store only reads meta.json.
+# 100M devices x 1 metric is ~2.2 GB.
+
+
+VALUE_COLUMNS = ('metric_result', 'metric_covariate')
+CODE_COLUMNS = ('metric_name', 'platform', 'platform_type')
+CODE_DTYPE = np.int16
+
+
+def device_keys(device_ids):
+    """uint64 hashes of device ids (vectorized, stable across runs)"""
+    return pd.util.hash_pandas_object(pd.Series(device_ids), index = False).to_numpy(dtype = np.uint64)
+
+
+class device_store_writer(object):
+    """
+    Writes a device_store from chunks of rows (dataframes with device_id, metric_name, platform_type, platform,
+    metric_result, metric_covariate), so an extract never has to fit in memory as a dataframe.
+
+    Chunks are appended unsorted to temporary files; close() sorts them into row groups.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.labels = {col: [] for col in CODE_COLUMNS}
+        self.codes = {col: {} for col in CODE_COLUMNS}
+        self.rows = 0
+        os.makedirs(directory, exist_ok = True)
+        self._files = {col: open(self.tmp_path(col), 'wb') for col in VALUE_COLUMNS + CODE_COLUMNS + ('device_key',)}
+
+    def tmp_path(self, col):
+        return os.path.join(self.directory, col + '.tmp')
+
+    def encode(self, col, values):
+        """int16 codes of string values, adding new labels as they are seen"""
+        codes, uniques = pd.factorize(pd.Series(values).astype(str))
+        lookup = self.codes[col]
+        for label in uniques:
+            if label not in lookup:
+                if len(self.labels[col]) == np.iinfo(CODE_DTYPE).max:
+                    raise ValueError('too many distinct values of ' + col + ' for int16 codes')
+                lookup[label] = len(self.labels[col])
+                self.labels[col].append(label)
+        return np.array([lookup[label] for label in uniques], dtype = CODE_DTYPE)[codes]
+
+    def append(self, df):
+        for col in VALUE_COLUMNS:
+            df[col].to_numpy(dtype = np.float32, na_value = np.nan).tofile(self._files[col])
+        for col in CODE_COLUMNS:
+            self.encode(col, df[col].to_numpy()).tofile(self._files[col])
+        device_keys(df['device_id'].to_numpy()).tofile(self._files['device_key'])
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Sorts the rows into row groups and writes the final .npy files and meta.json.
+
+        Returns: device_store
+        """
+        for f in self._files.values():
+            f.close()
+
+        def tmp_array(col, dtype):
+            if self.rows == 0:
+                return np.empty(0, dtype = dtype)
+            return np.memmap(self.tmp_path(col), dtype = dtype, mode = 'r', shape = (self.rows,))
+
+        # metric_name then platform, each by label so the index reads in order
+        metric_rank = np.argsort(np.argsort(self.labels['metric_name'])).astype(CODE_DTYPE)
+        platform_rank = np.argsort(np.argsort(self.labels['platform'])).astype(CODE_DTYPE)
+        metric_codes = tmp_array('metric_name', CODE_DTYPE)
+        platform_codes = tmp_array('platform', CODE_DTYPE)
+        order = np.lexsort((platform_rank[platform_codes], metric_rank[metric_codes])) if self.rows > 0 else np.empty(0, dtype = int)
+
+        # one column at a time, so only the order and one column are in memory
+        dtypes = dict({col: np.float32 for col in VALUE_COLUMNS}, **{col: CODE_DTYPE for col in CODE_COLUMNS})
+        dtypes['device_key'] = np.uint64
+        for col, dtype in dtypes.items():
+            out = np.lib.format.open_memmap(os.path.join(self.directory, col + '.npy'), mode = 'w+', dtype = dtype, shape = (self.rows,))
+            out[:] = tmp_array(col, dtype)[order]
+            out.flush()
+            del out
+
+        # row groups, from the sorted keys
+        sorted_metric_ranks = metric_rank[metric_codes[order]]
+        sorted_platform_ranks = platform_rank[platform_codes[order]]
+        metric_labels, platform_labels = sorted(self.labels['metric_name']), sorted(self.labels['platform'])
+        row_groups = {}
+        for metric in np.unique(sorted_metric_ranks):
+            start, stop = np.searchsorted(sorted_metric_ranks, metric, 'left'), np.searchsorted(sorted_metric_ranks, metric, 'right')
+            platforms = sorted_platform_ranks[start:stop]
+            row_groups[metric_labels[metric]] = {
+                'rows': [int(start), int(stop)],
+                'platforms': {platform_labels[platform]: [int(start + np.searchsorted(platforms, platform, 'left')),
+                                                         int(start + np.searchsorted(platforms, platform, 'right'))]
+                              for platform in np.unique(platforms)}
+            }
+
+        for col in dtypes:
+            os.remove(self.tmp_path(col))
+        meta = {'rows': int(self.rows), 'labels': self.labels, 'row_groups': row_groups}
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return device_store(self.directory)
+
+
+class device_store(object):
+    """
+    Read side: memory-maps the columns of a store written by device_store_writer (or device_store.write).
+
+    store.slice('tvt', 'ROKU')['metric_result'] is a float32 view of the file, nothing is read until it is used.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.labels = meta['labels']
+        self.row_groups = meta['row_groups']
+        self.columns = {}
+        for col in VALUE_COLUMNS + CODE_COLUMNS + ('device_key',):
+            self.columns[col] = np.load(os.path.join(directory, col + '.npy'), mmap_mode = 'r')
+
+    @classmethod
+    def write(cls, df, directory):
+        """Writes one dataframe (e.g. a pipeline.run_query result) as a store. Returns: device_store"""
+        writer = device_store_writer(directory)
+        writer.append(df)
+        return writer.close()
+
+    @classmethod
+    def write_from_cursor(cls, cursor, directory, chunk_rows = 1000000):
+        """Writes the result of an executed DB-API cursor (generate_device_metrics_sql), chunk_rows at a time. Returns: device_store"""
+        writer = device_store_writer(directory)
+        names = [d[0] for d in cursor.description]
+        while True:
+            chunk = cursor.fetchmany(chunk_rows)
+            if not chunk:
+                break
+            writer.append(pd.DataFrame.from_records(chunk, columns = names))
+        return writer.close()
+
+    def metrics(self):
+        return list(self.row_groups.keys())
+
+    def platforms(self, metric_name):
+        return list(self.row_groups[metric_name]['platforms'].keys())
+
+    def row_range(self, metric_name, platform = None):
+        group = self.row_groups[metric_name]
+        if platform is None or platform == 'ALL':
+            return group['rows']
+        if platform not in group['platforms']:
+            return [group['rows'][0], group['rows'][0]]
+        return group['platforms'][platform]
+
+    def slice(self, metric_name, platform = None):
+        """
+        Columns of one metric (platform None or 'ALL') or one metric x platform, as views of the memory-mapped files.
+
+        Returns: dict of column -> array
+        """
+        start, stop = self.row_range(metric_name, platform)
+        return {col: values[start:stop] for col, values in self.columns.items()}
+
+    def platform_type_slice(self, metric_name, platform_type):
+        """Columns of one metric x platform_type (not a contiguous row group, so these are copies)"""
+        columns = self.slice(metric_name)
+        if platform_type not in self.labels['platform_type']:
+            return {col: values[:0] for col, values in columns.items()}
+        keep = columns['platform_type'] == self.labels['platform_type'].index(platform_type)
+        return {col: values[keep] for col, values in columns.items()}
+
+    def cuped_result(self, metric_name, platform = None):
+        """
+        CUPED adjusted values of one slice, as cuped.py computes them: result - (covariate - mean covariate) * theta,
+        the result itself where the covariate is NULL.
+
+        Returns: float64 array
+        """
+        columns = self.slice(metric_name, platform)
+        result = columns['metric_result'].astype(float)
+        covariate = columns['metric_covariate'].astype(float)
+        known = ~np.isnan(covariate)
+        if known.sum() < 2:
+            return result
+        # same aggregates as the SQL: AVG/STDDEV skip NULL covariates, COUNT(*) doesn't
+        covariate_mean = covariate[known].mean()
+        variance = covariate[known].var(ddof = 1)
+        if variance == 0:
+            return result
+        theta = np.sum((covariate[known] - covariate_mean) * (result[known] - result.mean())) / (variance * len(result))
+        return np.where(known, result - (covariate - covariate_mean) * theta, result)
+
+    def to_frame(self, metric_name = None, platform = None):
+        """Decoded dataframe (categorical labels) of the whole store or one slice. Copies."""
+        if metric_name is None:
+            columns = self.columns
+        else:
+            columns = self.slice(metric_name, platform)
+        df = pd.DataFrame({col: np.asarray(columns[col]) for col in ('device_key',) + VALUE_COLUMNS})
+        for col in CODE_COLUMNS:
+            df[col] = pd.Categorical.from_codes(np.asarray(columns[col]), categories = self.labels[col])
+        return df
+
+    def nbytes(self):
+        return int(sum(values.nbytes for values in self.columns.values()))
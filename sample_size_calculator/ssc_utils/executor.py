@@ -0,0 +1,181 @@
+import tubi_data_runtime as tdr
+import pandas as pd
+import datetime
+import hashlib
+import os
+import threading
+import uuid
+
+from ssc_utils.tracing import NO_TRACE
+
+# Executors run the final SQL string and return a dataframe.
+# Everything downstream (preflight, calculator) only needs run() and explain(), so the same pipeline can point at
+# Redshift or at a local Postgres-compatible database loaded with a copy of the tubidw tables (for testing).
+
+
+class redshift_executor(object):
+    """Runs queries on Redshift through tubi_data_runtime"""
+
+    name = 'redshift'
+
+    def run(self, sql, tracer = NO_TRACE):
+        """
+        Args:
+            sql: SQL string
+            tracer: tracing.tracer; traces the 'execute' and 'to_df' stages, then splits 'execute' into 
+                    warehouse queue / execution / result transfer using Redshift's system tables
+
+        Returns: dataframe
+        """
+        if tracer.enabled:
+            trace_id = uuid.uuid4().hex
+            sql = '/* ssc_trace:' + trace_id + ' */\n' + sql
+
+        with tracer.stage('execute') as execute_record:
+            result = tdr.query_redshift(sql)
+        with tracer.stage('to_df') as record:
+            df = result.to_df()
+            record.observe(df)
+
+        if tracer.enabled:
+            self.trace_warehouse_stages(trace_id, execute_record, tracer)
+        return df
+
+    def trace_warehouse_stages(self, trace_id, execute_record, tracer):
+        """
+        Looks up the queue and execution times of a traced query (STL_WLM_QUERY) and records them as child stages of 'execute'. 
+        Whatever is left of the 'execute' wall time is recorded as result transfer. 
+        Best effort: STL tables can lag by a few seconds, in which case nothing is recorded.
+        """
+        # the marker is split in two, so this lookup query does not match itself
+        query = """
+            SELECT w.total_queue_time, w.total_exec_time
+            FROM stl_query AS q
+              JOIN stl_wlm_query AS w
+                ON q.query = w.query
+            WHERE q.querytxt LIKE '%ssc_' || 'trace:{trace_id}%'
+            ORDER BY q.starttime
+            LIMIT 1
+        """.format(trace_id = trace_id)
+        try:
+            timings = tdr.query_redshift(query).to_df()
+        except Exception:
+            return
+        if timings.empty:
+            return
+
+        # STL times are in microseconds
+        queue_sec = float(timings['total_queue_time'].iloc[0]) / 1e6
+        exec_sec = float(timings['total_exec_time'].iloc[0]) / 1e6
+        transfer_sec = max(execute_record['wall_sec'] - queue_sec - exec_sec, 0.0)
+        start = execute_record['start']
+        tracer.add('warehouse_queue', start, queue_sec, parent = 'execute')
+        tracer.add('warehouse_execution', start + queue_sec, exec_sec, parent = 'execute')
+        tracer.add('result_transfer', start + queue_sec + exec_sec, transfer_sec, parent = 'execute')
+
+    def explain(self, sql):
+        """Returns: list of strings, one per line of the query plan"""
+        df = tdr.query_redshift('EXPLAIN ' + sql).to_df()
+        return df.iloc[:, 0].tolist()
+
+
+class local_executor(object):
+    """
+    Runs queries on a local database through any DB-API connection (ie. psycopg2.connect(...)).
+    The database needs the tubidw schema and Postgres-style EXPLAIN output.
+
+    Thread safe: queries share the one connection one at a time, and a failed query is rolled back so the connection
+    doesn't stay in an aborted transaction (the service keeps one executor for its whole life).
+    """
+
+    name = 'local'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def run(self, sql, tracer = NO_TRACE):
+        with tracer.stage('wait_connection'):
+            self._lock.acquire()
+        try:
+            cursor = self.connection.cursor()
+            try:
+                with tracer.stage('execute'):
+                    cursor.execute(sql)
+                with tracer.stage('result_transfer') as record:
+                    columns = [col[0] for col in cursor.description]
+                    rows = cursor.fetchall()
+                    record.observe(rows = len(rows))
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+        finally:
+            self._lock.release()
+
+        with tracer.stage('to_df') as record:
+            df = pd.DataFrame(rows, columns = columns)
+            record.observe(df)
+        return df
+
+    def explain(self, sql):
+        return self.run('EXPLAIN ' + sql).iloc[:, 0].tolist()
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def data_week(now = None):
+    """
+    The week the generated SQL reads up to: its windows end at DATE_TRUNC('week', GETDATE()), the Monday of the
+    current (UTC) week, so the same SQL returns new data every Monday.
+
+    Returns: String, ISO date of that Monday
+    """
+    now = now if now is not None else utc_now()
+    return (now.date() - datetime.timedelta(days = now.weekday())).isoformat()
+
+
+class query_cache(object):
+    """
+    On-disk cache of query results, keyed by a hash of the SQL string and the data_week it runs in.
+    Identical filter/metric selections generate identical SQL, so repeated runs can skip the warehouse entirely,
+    until the week rolls over and the SQL's GETDATE() windows cover new data.
+
+    clock: returns the current UTC datetime (for tests)
+    """
+
+    def __init__(self, cache_dir = os.path.join(os.path.expanduser('~'), '.ssc_utils', 'query_cache'), clock = None):
+        self.cache_dir = cache_dir
+        self.clock = clock if clock is not None else utc_now
+
+    def key(self, sql):
+        # whitespace only changes (ie. indentation of the CTE templates) should not miss the cache
+        return hashlib.sha1((data_week(self.clock()) + '\n' + ' '.join(sql.split())).encode('utf-8')).hexdigest()
+
+    def path(self, sql):
+        return os.path.join(self.cache_dir, self.key(sql) + '.pkl')
+
+    def has(self, sql):
+        return os.path.exists(self.path(sql))
+
+    def get(self, sql):
+        if not self.has(sql):
+            return None
+        return pd.read_pickle(self.path(sql))
+
+    def put(self, sql, df):
+        os.makedirs(self.cache_dir, exist_ok = True)
+        # write then rename, so a half written file is never read back; the temporary name is unique, so concurrent
+        # writers of the same key (threads, processes) don't write into each other's file
+        path = self.path(sql)
+        tmp_path = path + '.' + uuid.uuid4().hex + '.tmp'
+        try:
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return df
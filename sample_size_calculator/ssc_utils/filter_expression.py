@@ -0,0 +1,513 @@
+import tubi_data_runtime as tdr
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+from ssc_utils.filter_generator import filter_generator
+
+# Filter expression trees: combine any number of attribute, metric and event predicates with AND/OR/NOT.
+#
+# A tree is compiled into the same filtering CTEs as filter_generator.generate_filter_cte, so each source table
+# (all_metric_hourly/sampled_analytics_thousandth and device_metric_daily) is still scanned once no matter how many
+# predicates are in the tree. Example:
+#
+#   and_(attribute('platform', 'IN', "('ROKU','AMAZON')"),
+#        attribute('country', '=', "'US'"),
+#        or_(metric('tvt_sec', '>=', '3600'), metric('visit_total_count', '>=', '3')),
+#        not_(attribute('app_mode', '=', "'kids'")))
+
+
+##### Expression nodes #####
+
+@dataclass(frozen=True)
+class predicate(object):
+    """
+    A single "field condition value" check.
+
+    filter_type is one of:
+        attribute: column of all_metric_hourly (or sampled_analytics_thousandth when events are filtered)
+        metric: cumulative device_metric_daily column, checked as MAX(cumulative metric)
+        event: primary event condition (ie. event_name, page_type, content_completion_pct)
+        pre_event: condition on the event that has to happen before the primary event
+    """
+    filter_type: str
+    field: str
+    condition: str
+    value: str
+
+
+@dataclass(frozen=True)
+class and_(object):
+    children: tuple
+
+    def __init__(self, *children):
+        if len(children) == 0:
+            raise ValueError('and_() needs at least one child')
+        object.__setattr__(self, 'children', tuple(children))
+
+
+@dataclass(frozen=True)
+class or_(object):
+    children: tuple
+
+    def __init__(self, *children):
+        if len(children) == 0:
+            raise ValueError('or_() needs at least one child')
+        object.__setattr__(self, 'children', tuple(children))
+
+
+@dataclass(frozen=True)
+class not_(object):
+    child: object
+
+
+def attribute(field, condition, value):
+    return predicate('attribute', field, condition, value)
+
+def metric(field, condition, value):
+    return predicate('metric', field, condition, value)
+
+def event(field, condition, value):
+    return predicate('event', field, condition, value)
+
+def pre_event(field, condition, value):
+    return predicate('pre_event', field, condition, value)
+
+
+@dataclass(frozen=True)
+class filter_spec(object):
+    """
+    Plain, hashable description of all the filters of a scenario: an expression tree and the max time between events.
+    Two scenarios with equal filter_specs select the same devices, so it can be used as a cache key.
+    """
+    expression: object = None
+    time_interval: str = 'NULL'
+
+    @property
+    def has_primary_event(self):
+        return (self.expression is not None) and ('event' in filter_expression().filter_types(self.expression))
+
+    @classmethod
+    def from_widgets(cls, attribute_condition_interact, metric_condition_interact, 
+                     event1_condition_interact, event1_sub_condition_interact, 
+                     event2_condition_interact, event2_sub_condition_interact, 
+                     event_time_interval_interact):
+        """
+        Reads the notebook widgets (same arguments as filter_generator.generate_filter_cte) into a filter_spec.
+        The widgets are only read here; nothing downstream holds on to them.
+        """
+        parts = []
+        for filter_type, interact in (('attribute', attribute_condition_interact), ('metric', metric_condition_interact)):
+            field, condition, value = [child.value for child in interact.children[:3]]
+            if field != 'no filters':
+                parts.append(predicate(filter_type, field, condition, value))
+
+        # a pre event only counts when there is a primary event (see filter_generator.generate_filter_cte)
+        if event2_condition_interact.value[0] != 'no event filter':
+            for filter_type, events, sub_condition in (('pre_event', event1_condition_interact, event1_sub_condition_interact), 
+                                                       ('event', event2_condition_interact, event2_sub_condition_interact)):
+                if events.value[0] == 'no event filter':
+                    continue
+                in_events = str(tuple(events.value)).replace(',)', ')')
+                parts.append(predicate(filter_type, 'event_name', 'IN', in_events))
+                field, condition, value = [child.value for child in sub_condition.children[:3]]
+                if field != 'no filters':
+                    parts.append(predicate(filter_type, field, condition, value))
+
+        if len(parts) == 0:
+            expression = None
+        elif len(parts) == 1:
+            expression = parts[0]
+        else:
+            expression = and_(*parts)
+        return cls(expression = expression, time_interval = checked_time_interval(event_time_interval_interact.result))
+
+
+##### Validation of plain (untrusted) filter specs #####
+
+# SQL literals a predicate value can be: numbers, and single-quoted strings where quotes are doubled
+# (no backslashes: Redshift reads them as escapes)
+NUMBER = r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?"
+STRING = r"'(?:[^'\\]|'')*'"
+LITERAL = '(?:' + NUMBER + '|' + STRING + ')'
+VALUE_PATTERNS = {
+    'IN': re.compile(r'\(\s*' + LITERAL + r'(?:\s*,\s*' + LITERAL + r')*\s*\)'),
+    'BETWEEN': re.compile(LITERAL + r'\s+AND\s+' + LITERAL, re.IGNORECASE),
+    'IS': re.compile(r'NULL|TRUE|FALSE', re.IGNORECASE),
+    'IS NOT': re.compile(r'NULL|TRUE|FALSE', re.IGNORECASE),
+}
+LITERAL_PATTERN = re.compile(LITERAL)
+
+
+@lru_cache(maxsize = None)
+def filter_fields(filter_type):
+    """Columns a filter type can filter on (the notebook's choices). Returns: frozenset"""
+    generator = filter_generator()
+    if filter_type == 'attribute':
+        fields = generator.filter_attributes_choices()
+    elif filter_type == 'metric':
+        fields = generator.filter_metrics_choices()
+    else:
+        fields = generator.event_sub_cond_field_choices() + ['event_name']
+    return frozenset(fields) - {'no filters'}
+
+
+def sql_literal(value):
+    """SQL literal of a JSON number, string or list (a tuple for IN), with quotes escaped. Returns: String"""
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return '(' + ','.join(sql_literal(item) for item in value) + ')'
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def checked_predicate(filter_type, field, condition, value):
+    """
+    A predicate from untrusted input (ie. a service request): field must be one of filter_fields(filter_type),
+    condition one of condition_choices(), and value a number, a list (rendered as an escaped tuple), or a string that is
+    already a SQL literal of the condition's form (a quoted string or number, "(...)" for IN, "x AND y" for BETWEEN,
+    NULL/TRUE/FALSE for IS). Raises ValueError otherwise, so no unchecked text reaches the SQL.
+
+    Returns: predicate
+    """
+    if field not in filter_fields(filter_type):
+        raise ValueError('unknown ' + filter_type + ' field ' + repr(field))
+    condition = str(condition).upper()
+    if condition not in filter_generator().condition_choices():
+        raise ValueError('unknown condition ' + repr(condition) + ', choose one of ' + str(filter_generator().condition_choices()))
+
+    if not isinstance(value, str):
+        value = sql_literal(value)
+    value = value.strip()
+    if not VALUE_PATTERNS.get(condition, LITERAL_PATTERN).fullmatch(value):
+        raise ValueError('invalid value for ' + condition + ': ' + repr(value))
+    return predicate(filter_type, field, condition, value)
+
+
+def checked_time_interval(value):
+    """
+    The max seconds between the pre event and the primary event from untrusted input: a non-negative integer (or a
+    string of digits), or None/'NULL'/'' for no limit. Raises ValueError otherwise, since it is formatted into the SQL.
+
+    Returns: String
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, int) and not isinstance(value, bool):
+        seconds = value
+    elif isinstance(value, str) and value.strip().upper() in ('', 'NULL'):
+        return 'NULL'
+    elif isinstance(value, str) and value.strip().isdigit() and value.strip().isascii():
+        seconds = int(value.strip())
+    else:
+        raise ValueError('invalid time_interval ' + repr(value) + ': expected a number of seconds or NULL')
+    if seconds < 0:
+        raise ValueError('invalid time_interval ' + repr(value) + ': expected a number of seconds or NULL')
+    return str(seconds)
+
+
+def from_spec(spec):
+    """
+    Builds an expression tree from plain (JSON/YAML) data, ie. for batch scenario files and service requests
+    (predicates are checked, see checked_predicate):
+
+        {'and': [{'attribute': ['platform', 'IN', "('ROKU','AMAZON')"]},
+                 {'or': [{'metric': ['tvt_sec', '>=', '3600']}, {'metric': ['visit_total_count', '>=', '3']}]},
+                 {'not': {'attribute': {'field': 'app_mode', 'condition': '=', 'value': "'kids'"}}}]}
+
+    Returns: expression tree (None for no filters)
+    """
+    if spec is None:
+        return None
+    if (not isinstance(spec, dict)) or (len(spec) != 1):
+        raise ValueError('each filter node must be a dict with exactly 1 key, got: ' + repr(spec))
+
+    key, content = list(spec.items())[0]
+    if key == 'and':
+        return and_(*[from_spec(child) for child in content])
+    elif key == 'or':
+        return or_(*[from_spec(child) for child in content])
+    elif key == 'not':
+        return not_(from_spec(content))
+    elif key in ('attribute', 'metric', 'event', 'pre_event'):
+        if isinstance(content, dict):
+            return checked_predicate(key, content['field'], content['condition'], content['value'])
+        field, condition, value = content
+        return checked_predicate(key, field, condition, value)
+    else:
+        raise ValueError('unknown filter node: ' + key)
+
+
+class column_statistics(object):
+    """
+    Cached per-column planner statistics (pg_stats) used to estimate predicate selectivity.
+    Statistics are pulled at most once per (table, column) for the lifetime of the kernel.
+
+    Falls back on the Postgres planner defaults when a column has no statistics (or the lookup fails).
+    """
+
+    # Postgres planner defaults (selfuncs.h)
+    DEFAULT_EQ_SEL = 0.005
+    DEFAULT_INEQ_SEL = 1.0 / 3.0
+    DEFAULT_RANGE_INEQ_SEL = 0.005
+    DEFAULT_NULL_FRAC = 0.01
+
+    _cache = {}
+
+    def __init__(self, use_warehouse_stats = True):
+        self.use_warehouse_stats = use_warehouse_stats
+
+    def lookup(self, table, column):
+        """
+        Returns: dict with null_frac and n_distinct (n_distinct < 0 means a fraction of the rows, as in pg_stats), or None
+        """
+        if not self.use_warehouse_stats:
+            return None
+
+        key = (table, column)
+        if key not in column_statistics._cache:
+            query = """
+                SELECT null_frac, n_distinct
+                FROM pg_stats
+                WHERE schemaname = 'tubidw'
+                AND tablename = '{table}'
+                AND attname = '{column}'
+            """.format(table = table, column = column)
+            try:
+                df = tdr.query_redshift(query).to_df()
+                column_statistics._cache[key] = None if df.empty else df.iloc[0].to_dict()
+            except Exception:
+                column_statistics._cache[key] = None
+        return column_statistics._cache[key]
+
+    def selectivity(self, table, node):
+        """Estimated fraction of rows in table that pass a predicate"""
+        stats = self.lookup(table, node.field) if node.filter_type != 'metric' else None
+        condition = node.condition.upper()
+
+        null_frac = self.DEFAULT_NULL_FRAC
+        eq_sel = self.DEFAULT_EQ_SEL
+        if stats is not None:
+            null_frac = float(stats['null_frac'] or 0.0)
+            n_distinct = float(stats['n_distinct'] or 0.0)
+            if n_distinct > 0:
+                eq_sel = (1.0 - null_frac) / n_distinct
+            elif n_distinct < 0:
+                # high cardinality column (distinct values scale with the table), equality is close to unique
+                eq_sel = self.DEFAULT_EQ_SEL * self.DEFAULT_EQ_SEL
+
+        if condition == '=':
+            return eq_sel
+        elif condition == '<>':
+            return max(1.0 - null_frac - eq_sel, 0.0)
+        elif condition == 'IN':
+            n_values = node.value.count(',') + 1
+            return min(n_values * eq_sel, 1.0)
+        elif condition == 'IS':
+            return null_frac if 'NULL' in node.value.upper() else 0.5
+        elif condition == 'IS NOT':
+            return 1.0 - null_frac if 'NULL' in node.value.upper() else 0.5
+        elif condition == 'BETWEEN':
+            return self.DEFAULT_RANGE_INEQ_SEL
+        else:
+            return self.DEFAULT_INEQ_SEL
+
+
+class filter_expression(object):
+    """
+    Compiles a filter expression tree into the filtering CTEs (see filter_generator).
+
+    Before rendering, the tree is normalized: nested AND/OR are flattened, duplicate predicates are dropped,
+    double negations cancel, and the children of every AND/OR are ordered by estimated selectivity
+    (most selective first for AND, least selective first for OR) so the scan can short-circuit as early as possible.
+
+    The top level must be an AND of subtrees that each use a single filter type. OR/NOT across filter types
+    (ie. "attribute OR metric") would need one scan per branch, so this raises ValueError.
+    """
+
+    FILTER_TYPES = ('attribute', 'metric', 'event', 'pre_event')
+
+    def __init__(self, statistics = None):
+        self.statistics = statistics if statistics is not None else column_statistics()
+
+    ##### Tree helpers #####
+
+    def filter_types(self, node):
+        """Set of filter types used by the leaves of a subtree"""
+        if isinstance(node, predicate):
+            return {node.filter_type}
+        elif isinstance(node, not_):
+            return self.filter_types(node.child)
+        else:
+            return set().union(*[self.filter_types(child) for child in node.children])
+
+    def normalize(self, node):
+        """Flattens nested AND/OR, removes duplicate children, and cancels double negations"""
+        if isinstance(node, predicate):
+            if node.filter_type not in self.FILTER_TYPES:
+                raise ValueError('unknown filter type ' + repr(node.filter_type) + ', choose one of ' + str(self.FILTER_TYPES))
+            return node
+
+        if isinstance(node, not_):
+            child = self.normalize(node.child)
+            if isinstance(child, not_):
+                return child.child
+            return not_(child)
+
+        children = []
+        for child in node.children:
+            child = self.normalize(child)
+            if type(child) is type(node):
+                children.extend(child.children)
+            else:
+                children.append(child)
+
+        # dict keeps the first occurrence of each (hashable) child, in order
+        children = list(dict.fromkeys(children))
+        if len(children) == 1:
+            return children[0]
+        return type(node)(*children)
+
+    def source_table(self, filter_type, has_events):
+        if filter_type == 'metric':
+            return 'device_metric_daily'
+        elif (filter_type == 'attribute') & (not has_events):
+            return 'all_metric_hourly'
+        else:
+            return 'sampled_analytics_thousandth'
+
+    def selectivity(self, node, table):
+        if isinstance(node, predicate):
+            return self.statistics.selectivity(table, node)
+        elif isinstance(node, not_):
+            return 1.0 - self.selectivity(node.child, table)
+
+        child_selectivities = [self.selectivity(child, table) for child in node.children]
+        if isinstance(node, and_):
+            result = 1.0
+            for s in child_selectivities:
+                result *= s
+            return result
+        else:
+            result = 1.0
+            for s in child_selectivities:
+                result *= (1.0 - s)
+            return 1.0 - result
+
+    def order_by_selectivity(self, node, table):
+        if isinstance(node, predicate):
+            return node
+        elif isinstance(node, not_):
+            return not_(self.order_by_selectivity(node.child, table))
+
+        children = [self.order_by_selectivity(child, table) for child in node.children]
+        if isinstance(node, and_):
+            children = sorted(children, key = lambda child: self.selectivity(child, table))
+        else:
+            children = sorted(children, key = lambda child: -self.selectivity(child, table))
+        return type(node)(*children)
+
+    def split_by_filter_type(self, node):
+        """
+        Splits a normalized tree into one subtree per filter type.
+
+        Returns: dict of filter_type -> subtree
+        """
+        parts = node.children if isinstance(node, and_) else (node,)
+
+        grouped = {}
+        for part in parts:
+            types = self.filter_types(part)
+            if len(types) > 1:
+                raise ValueError('OR/NOT across filter types ' + str(sorted(types)) + ' needs more than one scan per table')
+            grouped.setdefault(types.pop(), []).append(part)
+
+        return {filter_type: (parts[0] if len(parts) == 1 else and_(*parts)) for filter_type, parts in grouped.items()}
+
+    ##### Rendering #####
+
+    def render(self, node, metric_aliases):
+        if isinstance(node, predicate):
+            if node.filter_type == 'metric':
+                field = 'MAX(' + metric_aliases[node.field] + ')'
+            else:
+                field = node.field
+            return field + ' ' + node.condition + ' ' + node.value
+        elif isinstance(node, not_):
+            return 'NOT (' + self.render(node.child, metric_aliases) + ')'
+
+        joiner = ' AND ' if isinstance(node, and_) else ' OR '
+        return '(' + joiner.join([self.render(child, metric_aliases) for child in node.children]) + ')'
+
+    def metric_fields(self, node):
+        """Distinct metric columns in a subtree, in order of first appearance"""
+        if isinstance(node, predicate):
+            return [node.field]
+        elif isinstance(node, not_):
+            return self.metric_fields(node.child)
+        return list(dict.fromkeys([field for child in node.children for field in self.metric_fields(child)]))
+
+    ##### CTE Generator Function #####
+
+    def compile(self, expression):
+        """
+        Normalizes and splits an expression tree into per filter type SQL conditions.
+
+        Returns: dict with attr_filter, metric_fields, metric_filter_having, pre_event_condition, primary_event_condition
+        (the inputs of filter_generator.assemble_filter_cte)
+        """
+        compiled = {
+            'attr_filter': '',
+            'metric_fields': [],
+            'metric_filter_having': '',
+            'pre_event_condition': 'TRUE',
+            'primary_event_condition': None
+        }
+        if expression is None:
+            return compiled
+
+        parts = self.split_by_filter_type(self.normalize(expression))
+        if ('pre_event' in parts) & ('event' not in parts):
+            raise ValueError('pre_event filters need a primary event filter')
+        has_events = 'event' in parts
+
+        metric_aliases = {}
+        if 'metric' in parts:
+            compiled['metric_fields'] = self.metric_fields(parts['metric'])
+            metric_aliases = {field: filter_generator().metric_filter_alias(position)
+                              for position, field in enumerate(compiled['metric_fields'])}
+
+        rendered = {}
+        for filter_type, part in parts.items():
+            ordered = self.order_by_selectivity(part, self.source_table(filter_type, has_events))
+            rendered[filter_type] = self.render(ordered, metric_aliases)
+
+        if 'attribute' in rendered:
+            compiled['attr_filter'] = 'AND ' + rendered['attribute']
+        if 'metric' in rendered:
+            compiled['metric_filter_having'] = 'AND ' + rendered['metric']
+        if 'pre_event' in rendered:
+            compiled['pre_event_condition'] = rendered['pre_event']
+        if 'event' in rendered:
+            compiled['primary_event_condition'] = rendered['event']
+        return compiled
+
+    def generate_filter_cte(self, expression, time_interval = 'NULL', sample_pct = 100):
+        """
+        Generates the filtering CTEs for an expression tree. The final CTE elig_devices is a list of eligible device_ids,
+        exactly like filter_generator.generate_filter_cte.
+
+        Args:
+            expression: tree of predicate/and_/or_/not_ (None for no filters), or a filter_spec
+            time_interval: max seconds between the pre event and the primary event ('NULL' for no limit); 
+                           ignored for a filter_spec, which has its own
+            sample_pct: percent of devices the filter scans keep (same devices as raw_user_data's sample_pct)
+
+        Returns: String
+        """
+        if isinstance(expression, filter_spec):
+            expression, time_interval = expression.expression, expression.time_interval
+        compiled = self.compile(expression)
+        return filter_generator().assemble_filter_cte(time_interval = time_interval, sample_pct = sample_pct, **compiled)
@@ -1,6 +1,8 @@
 import tubi_data_runtime as tdr
 import pandas as pd
 
+from ssc_utils.raw_user_data import device_sample_filter
+
 class filter_generator(object):
     """
     Contains a set of functions that generates the SQL CTEs that filter and give a list of eligible device_ids based on user-specified conditions. 
@@ -117,6 +119,7 @@ class filter_generator(object):
         
         The resulting string has 1 input that can be specified by the user: 
             attr_filter
+        and the device sample condition (sample_filter, see assemble_filter_cte)
         """
         
         attr_filter_query = """
@@ -127,6 +130,7 @@ class filter_generator(object):
             WHERE DATE_TRUNC('week',hs) >= dateadd('week',-4,DATE_TRUNC('week',GETDATE()))
             AND DATE_TRUNC('week',hs) < DATE_TRUNC('week',GETDATE())
             {attr_filter} -- attribute filters dynamically populate here
+            {sample_filter}
             -- TODO: currently can't get a metric/attribute combo filter, like "devices that watched at least 50% of a specific content_id"
         )
         """
@@ -137,8 +141,9 @@ class filter_generator(object):
         """
         This CTE must always be preceded by the attribute CTEs or events CTEs.
 
-        The resulting string has 2 inputs: 
-            cumul_filter_metric
+        The resulting string has 3 inputs (see metric_filter_columns for the first 2): 
+            daily_filter_metrics
+            cumul_filter_metrics
             metric_filter_having
         """ 
         
@@ -153,7 +158,7 @@ class filter_generator(object):
                 d.platform_type,
                 d.ds,
                 -- For filtering devices
-                sum({cumul_filter_metric}) as daily_filter_metric
+                {daily_filter_metrics}
             FROM tubidw.device_metric_daily as d
             JOIN pre_approved_devices as p
                 ON d.device_id = p.device_id
@@ -161,7 +166,8 @@ class filter_generator(object):
         )
 
         , elig_device_cumul_filter as (
-            SELECT *, sum(daily_filter_metric) OVER (PARTITION BY device_id, platform_type, platform ORDER BY ds rows between unbounded preceding and current row) as cumul_filter_metric
+            SELECT *, 
+                {cumul_filter_metrics}
             FROM elig_device_metrics
         )
 
@@ -180,7 +186,7 @@ class filter_generator(object):
         return metric_filter_query
     
     def events_sessionized_query(self):
-        """One input: attr_filter"""
+        """One input: attr_filter (and the device sample condition, sample_filter)"""
             
         sessionized_sql = """
         WITH next_event AS ( 
@@ -226,6 +232,7 @@ class filter_generator(object):
           WHERE DATE_TRUNC('week',ts) >= dateadd('week',-4, DATE_TRUNC('week',GETDATE()))
             AND DATE_TRUNC('week',ts) < DATE_TRUNC('week',GETDATE())
           {attr_filter} -- attribute filters dynamically populate here
+          {sample_filter}
         )
 
         , sessionized_events AS (
@@ -350,6 +357,31 @@ class filter_generator(object):
     
     ##### Helper Functions #####
     # These get used in the notebook to transform user-generated inputs into SQL code
+
+    def metric_filter_alias(self, position):
+        """
+        Column name of the cumulative metric at a given position in the metric filter CTE. 
+        The first metric keeps the original name (cumul_filter_metric) so single metric filters are unchanged.
+        """
+        return 'cumul_filter_metric' if position == 0 else 'cumul_filter_metric_' + str(position + 1)
+
+    def metric_filter_columns(self, metric_fields):
+        """
+        Generates the daily and cumulative select lists of dmd_metric_filter_query for one or more metrics. 
+        
+        Args:
+            metric_fields: list of device_metric_daily columns to filter on (one column per cumulative metric)
+        
+        Returns: tuple of strings (daily_filter_metrics, cumul_filter_metrics)
+        """
+        daily_cols = []
+        cumul_cols = []
+        for position, field in enumerate(metric_fields):
+            alias = self.metric_filter_alias(position)
+            daily_alias = alias.replace('cumul_', 'daily_')
+            daily_cols.append('sum(' + field + ') as ' + daily_alias)
+            cumul_cols.append('sum(' + daily_alias + ') OVER (PARTITION BY device_id, platform_type, platform ORDER BY ds rows between unbounded preceding and current row) as ' + alias)
+        return ',\n                '.join(daily_cols), ',\n                '.join(cumul_cols)
     
     def make_sql_condition_string(self, field, condition, value, filter_type):
         """
@@ -398,6 +430,58 @@ class filter_generator(object):
     ##### CTE Generator Function #####
     # This glues everything together and generates a CTE with a list of eligible device_ids 
     
+    def assemble_filter_cte(self, attr_filter, metric_fields, metric_filter_having, 
+                            pre_event_condition, primary_event_condition, time_interval, sample_pct = 100):
+        """
+        Picks and fills in the filtering CTEs from already rendered SQL conditions. 
+        Shared by generate_filter_cte (widgets) and filter_expression (filter trees).
+        
+        Args:
+            attr_filter: string of "AND ..." attribute conditions ('' for no attribute filter)
+            metric_fields: list of device_metric_daily columns used by the metric filter ([] for no metric filter)
+            metric_filter_having: string of "AND ..." conditions on the cumulative metric columns
+            pre_event_condition: event conditional for the pre event ('TRUE' for no pre event)
+            primary_event_condition: event conditional for the primary event (None for no event filter)
+            time_interval: max seconds between pre and primary event ('NULL' for no limit)
+            sample_pct: percent of devices the scans keep (same device hash as raw_user_data's sample_pct)
+        
+        Returns: String
+        """
+        sample_filter = device_sample_filter(sample_pct)
+        
+        # return only the relevant filters chosen (allows us to pick which CTEs to include)
+        if (primary_event_condition is None) & (len(metric_fields) == 0) & (attr_filter == ''):
+            return 'WITH'
+        
+        if len(metric_fields) > 0:
+            daily_filter_metrics, cumul_filter_metrics = self.metric_filter_columns(metric_fields)
+            metric_sql = self.dmd_metric_filter_query().format(daily_filter_metrics = daily_filter_metrics,
+                                                               cumul_filter_metrics = cumul_filter_metrics,
+                                                               metric_filter_having = metric_filter_having)
+            devices_cte_name = 'pre_approved_devices'
+        else:
+            metric_sql = ''
+            devices_cte_name = 'elig_devices'
+        
+        # Dynamically return the filtering CTEs based on which filter types were chosen
+        if primary_event_condition is None:
+            # scenario1: attribute CTE only
+            # scenario2: attribute CTE + metrics CTEs
+            attr_sql = self.amh_attr_filter_query().format(attr_filter = attr_filter,
+                                                           sample_filter = sample_filter,
+                                                           final_cte_name = devices_cte_name)
+            return attr_sql + metric_sql + ','
+        else:
+            # scenario3: events CTEs only
+            # scenario4: events CTEs + metrics CTEs
+            sessionized_sql = self.events_sessionized_query().format(attr_filter = attr_filter, 
+                                                                     sample_filter = device_sample_filter(sample_pct, 'a.device_id'))
+            window_sql = self.events_2step_window_query().format(condition1 = pre_event_condition, condition2 = primary_event_condition)
+            summ_session_sql = self.events_summarized_session_query().format(time_interval = time_interval, 
+                                                                             steps_interval = 'NULL', 
+                                                                             final_cte_name = devices_cte_name)
+            return sessionized_sql + window_sql + summ_session_sql + metric_sql + ','
+    
     def generate_filter_cte(self, attribute_condition_interact, metric_condition_interact, 
                             event1_condition_interact, event1_sub_condition_interact, 
                             event2_condition_interact, event2_sub_condition_interact, 
@@ -413,46 +497,23 @@ class filter_generator(object):
             event2_condition_interact
             event_time_interval_interact
         """
-                
-        # return only the relevant filters chosen (allows us to pick which CTEs to include)
-        if (event2_condition_interact.value[0] == 'no event filter') & (metric_condition_interact.children[0].value == 'no filters') & (attribute_condition_interact.children[0].value == 'no filters'):
-            return 'WITH'
         
+        if metric_condition_interact.children[0].value == 'no filters':
+            metric_fields = []
+        else:
+            metric_fields = [metric_condition_interact.children[0].value]
+        
+        if event2_condition_interact.value[0] == 'no event filter':
+            primary_event_input = None
         else:
-            # Initialize static sql strings
-            metric_sql = self.dmd_metric_filter_query().format(cumul_filter_metric = metric_condition_interact.children[0].value,
-                                                               metric_filter_having = metric_condition_interact.result)
-
-            pre_event_input = self.make_sql_event_condition_string(event_names = event1_condition_interact.value, 
-                                                                   sub_condition_sql = event1_sub_condition_interact.result)
             primary_event_input = self.make_sql_event_condition_string(event_names = event2_condition_interact.value, 
                                                                        sub_condition_sql = event2_sub_condition_interact.result)
-
-            sessionized_sql = self.events_sessionized_query().format(attr_filter = attribute_condition_interact.result)
-            window_sql = self.events_2step_window_query().format(condition1 = pre_event_input, condition2 = primary_event_input)
-            
-            # Dynamically return the filtering CTEs based on which filter types were chosen
-            if event2_condition_interact.value[0] == 'no event filter':
-                if metric_condition_interact.children[0].value == 'no filters':
-                    # scenario1: attribute CTE only
-                    attr_sql = self.amh_attr_filter_query().format(attr_filter = attribute_condition_interact.result,
-                                                                   final_cte_name = 'elig_devices')
-                    return attr_sql + ','
-                else: 
-                    # scenario2: attribute CTE + metrics CTEs
-                    attr_sql = self.amh_attr_filter_query().format(attr_filter = attribute_condition_interact.result,
-                                                                   final_cte_name = 'pre_approved_devices')
-                    return attr_sql + metric_sql + ','
-            else:
-                if metric_condition_interact.children[0].value == 'no filters':
-                    # scenario3: events CTEs only
-                    summ_session_sql = self.events_summarized_session_query().format(time_interval = event_time_interval_interact.result, 
-                                                                                     steps_interval = 'NULL', 
-                                                                                     final_cte_name = 'elig_devices')
-                    return sessionized_sql + window_sql + summ_session_sql + ','
-                else: 
-                    # scenario4: events CTEs + metrics CTEs
-                    summ_session_sql = self.events_summarized_session_query().format(time_interval = event_time_interval_interact.result, 
-                                                                                     steps_interval = 'NULL', 
-                                                                                     final_cte_name = 'pre_approved_devices')
-                    return sessionized_sql + window_sql + summ_session_sql + metric_sql + ','
\ No newline at end of file
+        pre_event_input = self.make_sql_event_condition_string(event_names = event1_condition_interact.value, 
+                                                               sub_condition_sql = event1_sub_condition_interact.result)
+        
+        return self.assemble_filter_cte(attr_filter = attribute_condition_interact.result, 
+                                        metric_fields = metric_fields, 
+                                        metric_filter_having = metric_condition_interact.result, 
+                                        pre_event_condition = pre_event_input, 
+                                        primary_event_condition = primary_event_input, 
+                                        time_interval = event_time_interval_interact.result)
@@ -3,6 +3,7 @@ class metric_summary(object):
     def generate_metric_summary_cte(self):
         """
         Generates the SQL CTE that summarizes the device level metric chosen.
+        Windows are partitioned by metric_name too, so user_data can stack several metrics (see metric_switcher.generate_multi_metric_user_data_cte).
             
         Returns:
             String
@@ -17,32 +18,32 @@ class metric_summary(object):
                      metric_name,
                      CASE
                        WHEN metric_collection_method = 'SUM' THEN SUM(CASE WHEN user_data.ds >= user_data.first_exposure_ds THEN metric_value ELSE 0 END) OVER
-                        (PARTITION BY user_data.device_id, user_data.platform)
+                        (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)
                        WHEN metric_collection_method = 'MAX' THEN MAX(CASE WHEN user_data.ds >= user_data.first_exposure_ds THEN metric_value ELSE 0 END) OVER
-                        (PARTITION BY user_data.device_id, user_data.platform)
+                        (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)
                       WHEN metric_collection_method = 'AVG' THEN AVG(CASE WHEN user_data.ds >= user_data.first_exposure_ds THEN metric_value ELSE NULL END) OVER
-                        (PARTITION BY user_data.device_id, user_data.platform)
+                        (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)
                       WHEN metric_collection_method = 'SUMGREATERTHAN' THEN CASE WHEN (SUM(CASE WHEN user_data.ds >= user_data.first_exposure_ds THEN metric_value ELSE 0 END) OVER
-                        (PARTITION BY user_data.device_id, user_data.platform)) > 1 THEN 1.0 ELSE 0.0 END
+                        (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)) > 1 THEN 1.0 ELSE 0.0 END
                       ELSE 0 END::float
                      AS metric_result,
                     CASE
                           WHEN metric_collection_method = 'SUM' THEN
                               SUM(CASE WHEN user_data.ds < user_data.first_exposure_ds THEN metric_value ELSE
                           (CASE WHEN device_first_seen_ts < user_data.first_exposure_ds - interval '14 day' THEN 0 ELSE NULL END) END) OVER
-                          (PARTITION BY user_data.device_id, user_data.platform)
+                          (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)
                           WHEN metric_collection_method = 'MAX' THEN
                               MAX(CASE WHEN user_data.ds < user_data.first_exposure_ds THEN metric_value ELSE
                           (CASE WHEN device_first_seen_ts < user_data.first_exposure_ds - interval '14 day' THEN 0 ELSE NULL END) END) OVER
-                          (PARTITION BY user_data.device_id, user_data.platform)
+                          (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)
                           WHEN metric_collection_method = 'AVG' THEN
                               AVG(CASE WHEN user_data.ds < user_data.first_exposure_ds THEN metric_value ELSE
                           (CASE WHEN device_first_seen_ts < user_data.first_exposure_ds - interval '14 day' THEN 0 ELSE NULL END) END) OVER
-                          (PARTITION BY user_data.device_id, user_data.platform)
+                          (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)
                     WHEN metric_collection_method = 'SUMGREATERTHAN' THEN
                       CASE WHEN (SUM(CASE WHEN user_data.ds < user_data.first_exposure_ds THEN metric_value ELSE
                           (CASE WHEN device_first_seen_ts < user_data.first_exposure_ds - interval '14 day' THEN 0 ELSE NULL END) END) OVER
-                          (PARTITION BY user_data.device_id, user_data.platform)
+                          (PARTITION BY user_data.device_id, user_data.platform, user_data.metric_name)
                           ) > 1 THEN 1 ELSE 0 END
                           ELSE 0 END::float AS metric_covariate
               FROM user_data
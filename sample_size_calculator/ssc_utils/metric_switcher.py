@@ -1,11 +1,132 @@
+from dataclasses import dataclass
+
+from ssc_utils.raw_user_data import DAILY_COLUMNS
+
+# Metric registry: each metric declares what it reads and how it is collected, and the SQL is generated from that.
+# raw_user_data only sums the device_metric_daily columns the chosen metrics need (metric_switcher.required_columns),
+# and the other sources (revenue_bydevice_daily) are only joined when a chosen metric reads them.
+
+COLLECTION_METHODS = ('SUM', 'MAX', 'AVG', 'SUMGREATERTHAN')  # see metric_summary
+
+
+@dataclass(frozen=True)
+class metric_definition(object):
+    """
+    metric_name: name in the query results
+    collection_method: how daily values are collected per device, one of COLLECTION_METHODS
+    value: SQL expression of the daily metric_value ({cap} is replaced by the metric's winsorization cap)
+    columns: raw_user_data columns (DAILY_COLUMNS) that value and row_filter read
+    source: CTE the metric reads, 'raw_user_data' or a key of SOURCES
+    row_filter: SQL condition on the source rows, or None
+    distinct: one row per distinct device, day and value (retention)
+    """
+    metric_name: str
+    collection_method: str
+    value: str
+    columns: tuple = ()
+    source: str = 'raw_user_data'
+    row_filter: str = None
+    distinct: bool = False
+
+    def __post_init__(self):
+        if self.collection_method not in COLLECTION_METHODS:
+            raise ValueError('unknown collection method ' + self.collection_method + ', choose one of ' + str(COLLECTION_METHODS))
+        unknown = [column for column in self.columns if column not in DAILY_COLUMNS]
+        if unknown:
+            raise ValueError('unknown raw_user_data columns ' + str(unknown))
+
+
+# source CTEs besides raw_user_data, keyed by CTE name
+SOURCES = {
+    'device_data_impressions': """
+        , ad_impressions_data AS (
+            SELECT ds,
+                   device_id,
+                   COALESCE(ad_impression_total_count, 0)::float AS ad_impression_total_count
+            FROM tubidw.revenue_bydevice_daily
+            WHERE DATE_TRUNC('week',ds) >= dateadd('week', -4, DATE_TRUNC('week',GETDATE()))
+              AND DATE_TRUNC('week',ds) < DATE_TRUNC('week', GETDATE())
+        )
+
+        , device_data_impressions AS (
+            SELECT  d.device_id,
+                    d.ds,
+                    d.platform,
+                    d.platform_type,
+                    d.device_first_seen_ts,
+                    d.first_exposure_ds,
+                    COALESCE(SUM(rev.ad_impression_total_count), 0)::float AS ad_impression_total_count
+            FROM ad_impressions_data AS rev
+              RIGHT JOIN raw_user_data AS d
+                ON d.device_id = rev.device_id
+                AND d.ds = rev.ds
+            GROUP BY 1, 2, 3, 4, 5, 6
+        )
+        """
+}
+
+TVT = '(tvt_sec + linear_tvt_sec)'
+TVT_COLUMNS = ('tvt_sec', 'linear_tvt_sec')
+DAILY_TVT_HOURS = 'SUM(' + TVT + '/3600.0) OVER (PARTITION BY device_id,ds,platform)'
+FIRST_WEEK_SEEN = "ds >= DATE_TRUNC('day',device_first_seen_ts) AND ds < device_first_seen_ts + INTERVAL '7 day'"
+
+# possible_metrics() string -> definition
+METRICS = {
+    'tvt': metric_definition('tvt', 'SUM', TVT + ' / 3600.0', TVT_COLUMNS),
+    'tvt-capped': metric_definition('tvt-capped', 'SUM',
+                                    'CASE WHEN ' + DAILY_TVT_HOURS + ' > {cap} THEN {cap} ELSE ' + DAILY_TVT_HOURS + ' END', TVT_COLUMNS),
+    'tvt-capped_new_visitors': metric_definition('tvt-capped-new_visitors', 'SUM',
+                                                 'CASE WHEN ' + DAILY_TVT_HOURS + ' > {cap} THEN {cap} ELSE ' + DAILY_TVT_HOURS + ' END', TVT_COLUMNS,
+                                                 row_filter = FIRST_WEEK_SEEN),
+    'visits': metric_definition('visit', 'SUM', 'visit_total_count::float', ('visit_total_count',)),
+    'retention--new_viewers': metric_definition('retention--new_viewers', 'MAX',
+                                                "CASE WHEN ds > device_first_view_ts + INTERVAL '1 day' AND " + TVT + ' > 10 THEN 1.0 ELSE 0.0 END', TVT_COLUMNS,
+                                                row_filter = "ds >= DATE_TRUNC('day',device_first_view_ts) AND ds < device_first_view_ts + INTERVAL '7 day'"),
+    'retention': metric_definition('retention', 'SUMGREATERTHAN', '1.0', TVT_COLUMNS, row_filter = TVT + ' > 10', distinct = True),
+    'ad_impressions': metric_definition('ad_impressions', 'SUM', 'COALESCE(ad_impression_total_count,0)::float', source = 'device_data_impressions'),
+    'tvt-vod_series': metric_definition('tvt-vod_series', 'SUM', 'series_tvt_sec/3600.0', ('series_tvt_sec',)),
+    'tvt-vod_movie': metric_definition('tvt-vod_movie', 'SUM', 'movie_tvt_sec/3600.0', ('movie_tvt_sec',)),
+    'conversion-5min': metric_definition('conversion-5min', 'MAX', 'CASE WHEN ' + TVT + ' > 60*5.0 THEN 1.0 ELSE 0.0 END', TVT_COLUMNS),
+    'conversion-5min-new_visitors': metric_definition('conversion-5min-new_visitors', 'MAX', 'CASE WHEN ' + TVT + ' > 60*5.0 THEN 1.0 ELSE 0.0 END',
+                                                      TVT_COLUMNS, row_filter = FIRST_WEEK_SEEN),
+    # not in possible_metrics() yet
+    'registration-did_signup': metric_definition('registration-did_signup', 'MAX', 'CASE WHEN user_signup_count > 0 THEN 1.0 ELSE 0.0 END',
+                                                 ('user_signup_count',)),
+    'registration-did_activate': metric_definition('registration-did_activate', 'MAX', 'CASE WHEN device_registration_count > 0 THEN 1.0 ELSE 0.0 END',
+                                                   ('device_registration_count',)),
+    'conversion': metric_definition('conversion', 'MAX', 'CASE WHEN ' + TVT + ' > 10 THEN 1.0 ELSE 0.0 END', TVT_COLUMNS),
+    'conversion--new_visitors': metric_definition('conversion--new_visitors', 'MAX', 'CASE WHEN ' + TVT + ' > 10 THEN 1.0 ELSE 0.0 END', TVT_COLUMNS,
+                                                  row_filter = FIRST_WEEK_SEEN),
+}
+
+
 class metric_switcher(object):
     """
-    Contains a set of functions that generates the SQL CTE for a chosen metric.
+    Generates the SQL CTE of the chosen metrics from their definitions in METRICS.
+    
+    caps: daily winsorization caps of the capped metrics (hours of tvt per device and day), ie. from 
+          quantile_sketch.winsorization_caps: metric_switcher(caps = {'tvt-capped': 6.5})
     """
     
-    def generate_user_data_cte(self, metric): # <-- whatever you input here in "metric" will choose one of the CTEs below      
+    default_caps = {'tvt-capped': 4.0, 'tvt-capped_new_visitors': 4.0}
+    # capped metric -> the uncapped metric whose daily values it caps
+    capped_metrics = {'tvt-capped': 'tvt', 'tvt-capped_new_visitors': 'tvt'}
+    
+    def __init__(self, caps = None):
+        self.caps = dict(self.default_caps, **(caps or {}))
+    
+    def definition(self, metric):
+        """
+        Returns: metric_definition of a metric chosen from possible_metrics() (or the inactive ones in METRICS)
         """
-        Generates a string SQL CTE based on the metric chosen. 
+        if metric not in METRICS:
+            raise ValueError('unknown metric ' + str(metric) + ', choose one of ' + str(self.possible_metrics()))
+        return METRICS[metric]
+
+    def generate_user_data_cte(self, metric):
+        """
+        Generates a string SQL CTE based on the metric chosen, from its definition in METRICS
+        (with the source CTE it reads, ie. revenue for ad_impressions).
         
         Args: 
             metric: a string chosen from the list of metrics in possible_metrics()
@@ -13,12 +134,119 @@ class metric_switcher(object):
         Returns:
             String
         """
-        # Get the method from 'self'. Default to a lambda.
-        metric_clean = metric.replace('--','_').replace('-','_')
-        method = getattr(self, metric_clean, lambda: "Invalid metric")
+        return self.generate_source_ctes([metric]) + self.generate_metric_cte(metric)
+
+    def generate_source_ctes(self, metrics):
+        """The SOURCES CTEs (other than raw_user_data) that metrics read, each once. Returns: String"""
+        sources = dict.fromkeys(self.definition(metric).source for metric in metrics)
+        return ''.join(SOURCES[source] for source in sources if source != 'raw_user_data')
+
+    def generate_metric_cte(self, metric, cte_name = 'user_data'):
+        """The user_data CTE of one metric (daily metric_value per device), without its source CTE. Returns: String"""
+        definition = self.definition(metric)
+        return """
+        , {cte_name} AS (
+          SELECT {distinct}
+            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
+            '{metric_name}'::text AS metric_name,
+            '{collection_method}'::text AS metric_collection_method, 
+            {value} AS metric_value
+          FROM {source}{where}
+        )
+        """.format(cte_name = cte_name,
+                   distinct = 'DISTINCT' if definition.distinct else '',
+                   metric_name = definition.metric_name,
+                   collection_method = definition.collection_method,
+                   value = definition.value.format(cap = float(self.caps.get(metric, 0))),
+                   source = definition.source,
+                   where = '' if definition.row_filter is None else """
+          WHERE """ + definition.row_filter)
+
+    def required_columns(self, metrics):
+        """
+        The raw_user_data columns (device_metric_daily sums) that metrics read, in raw_user_data.DAILY_COLUMNS order.
+
+        Returns: tuple of strings
+        """
+        needed = set(column for metric in metrics for column in self.definition(metric).columns)
+        return tuple(column for column in DAILY_COLUMNS if column in needed)
+    
+    def generate_multi_metric_user_data_cte(self, metrics):
+        """
+        Generates one user_data CTE that stacks several metrics (UNION ALL), so one query computes all of them 
+        over the same eligible devices. metric_summary and cuped already partition by metric_name.
+        
+        Args: 
+            metrics: list of strings chosen from possible_metrics()
+
+        Returns:
+            String
+        """
+        metrics = list(dict.fromkeys(metrics))
+        if len(metrics) == 1:
+            return self.generate_user_data_cte(metrics[0])
+        
+        metric_sqls = []
+        union_sqls = []
+        for position, metric in enumerate(metrics):
+            cte_name = 'user_data_' + str(position + 1)
+            metric_sqls.append(self.generate_metric_cte(metric, cte_name = cte_name))
+            union_sqls.append("""
+          SELECT device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
+                 metric_name, metric_collection_method, metric_value
+          FROM """ + cte_name)
         
-        # Call the method as we return it
-        return method()
+        return self.generate_source_ctes(metrics) + ''.join(metric_sqls) + """
+        , user_data AS (""" + """
+          UNION ALL""".join(union_sqls) + """
+        )
+        """
+    
+    def metric_name(self, metric):
+        """
+        The metric_name a metric's CTE writes in the query results (not always the same as the possible_metrics() string, ie. 'visits' -> 'visit').
+        Ratio metrics keep their name; quantile metrics are their base metric_name + '-pXX' (see quantile_metric_summary).
+        
+        Returns: String
+        """
+        kind = self.metric_kind(metric)
+        if kind == 'ratio':
+            return metric
+        if kind == 'quantile':
+            base, quantile = self.quantile_metric(metric)
+            return self.definition(base).metric_name + '-p' + ('%g' % (quantile * 100))
+        return self.definition(metric).metric_name
+
+    def quantile_metric(self, metric):
+        """
+        Splits a quantile metric, a possible_metrics() string + '-pXX' with 0 < XX < 100 (ie. 'tvt-p50', 'visits-p99.5').
+
+        Returns: tuple (base metric, quantile in (0, 1)), or None when metric isn't a quantile metric
+        """
+        base, separator, percentile = metric.rpartition('-p')
+        if (separator == '') or (base not in self.possible_metrics()):
+            return None
+        try:
+            quantile = float(percentile) / 100.0
+        except ValueError:
+            return None
+        return (base, quantile) if 0 < quantile < 1 else None
+
+    def metric_kind(self, metric):
+        """
+        'metric' for possible_metrics() (and the inactive METRICS), 'ratio' for possible_ratio_metrics(),
+        'quantile' for quantile metrics (see quantile_metric). Raises ValueError for anything else.
+
+        Returns: String
+        """
+        if metric in METRICS:
+            return 'metric'
+        if metric in self.possible_ratio_metrics():
+            return 'ratio'
+        if self.quantile_metric(metric) is not None:
+            return 'quantile'
+        raise ValueError('unknown metric ' + str(metric) + ', choose one of ' + str(self.possible_metrics())
+                         + ', a ratio metric ' + str(list(self.possible_ratio_metrics())) + " or a quantile metric (ie. 'tvt-p50')")
     
     def possible_metrics(self):
         # Possible metrics to use for MDE (same as current calculator)
@@ -45,222 +273,19 @@ class metric_switcher(object):
         ]"""
         return metrics
         
+    def possible_ratio_metrics(self):
+        """
+        Ratio metrics: ratio of the means of two per-device metrics from possible_metrics() (see ratio_summary).
+        
+        Returns: dict of ratio metric name -> (numerator metric, denominator metric)
+        """
+        return {
+            'tvt-per_visit': ('tvt', 'visits'),
+            'ad_impressions-per_tvt_hour': ('ad_impressions', 'tvt'),
+            'tvt-vod_series-share': ('tvt-vod_series', 'tvt'),
+            'conversion-5min-per_visit': ('conversion-5min', 'visits')
+        }
+        
     def choose_metric(self, metric):
         # the most important function in this tool
         return metric
-
-    def tvt(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'tvt'::text AS metric_name,
-            'SUM'::text AS metric_collection_method, 
-            (tvt_sec + linear_tvt_sec) / 3600.0 AS metric_value
-          FROM raw_user_data
-        )
-        """
-
-    def tvt_capped(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'tvt-capped'::text AS metric_name,
-            'SUM'::text AS metric_collection_method, 
-            CASE WHEN (SUM((tvt_sec + linear_tvt_sec)/3600.0) OVER (PARTITION BY device_id,ds,platform)) > 4 THEN 4.0 
-                 ELSE (SUM((tvt_sec + linear_tvt_sec)/3600.0) OVER (PARTITION BY device_id,ds,platform)) 
-            END AS metric_value
-          FROM raw_user_data
-        )
-        """
-
-    def tvt_capped_new_visitors(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'tvt-capped-new_visitors'::text AS metric_name,
-            'SUM'::text AS metric_collection_method, 
-            CASE WHEN (SUM((tvt_sec + linear_tvt_sec)/3600.0) OVER (PARTITION BY device_id,ds,platform)) > 4 THEN 4.0 ELSE (SUM((tvt_sec + linear_tvt_sec)/3600.0) OVER (PARTITION BY device_id,ds,platform)) END AS metric_value
-          FROM raw_user_data
-          WHERE ds >= DATE_TRUNC('day',device_first_seen_ts) AND ds < device_first_seen_ts + INTERVAL '7 day'
-        )
-        """
-
-    def registration_did_signup(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'registration-did_signup'::text AS metric_name,
-            'MAX'::text AS metric_collection_method, 
-            CASE WHEN user_signup_count > 0 THEN 1.0 ELSE 0.0 END AS metric_value
-          FROM raw_user_data
-        )
-        """
-
-    def registration_did_activate(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'registration-did_activate'::text AS metric_name,
-            'MAX'::text AS metric_collection_method, 
-            CASE WHEN device_registration_count > 0 THEN 1.0 ELSE 0.0 END AS metric_value
-          FROM raw_user_data
-        )
-        """
-    
-    def visits(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'visit'::text AS metric_name,
-            'SUM'::text AS metric_collection_method, 
-            visit_total_count::float AS metric_value
-          FROM raw_user_data
-        )
-        """
-    
-    def conversion(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'conversion'::text AS metric_name,
-            'MAX'::text AS metric_collection_method, 
-            CASE WHEN (tvt_sec + linear_tvt_sec) > 10 THEN 1.0 ELSE 0.0 END AS metric_value
-          FROM raw_user_data
-        )
-        """
-    
-    def conversion_5min(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'conversion-5min'::text AS metric_name,
-            'MAX'::text AS metric_collection_method, 
-            CASE WHEN (tvt_sec + linear_tvt_sec) > 60*5.0 THEN 1.0 ELSE 0.0 END AS metric_value
-          FROM raw_user_data
-        )
-        """
-
-    def conversion_new_visitors(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'conversion--new_visitors'::text AS metric_name,
-            'MAX'::text AS metric_collection_method, 
-            CASE WHEN (tvt_sec + linear_tvt_sec) > 10 THEN 1.0 ELSE 0.0 END AS metric_value
-          FROM raw_user_data
-          WHERE ds >= DATE_TRUNC('day',device_first_seen_ts) AND ds < device_first_seen_ts + INTERVAL '7 day'
-        )
-        """
-    
-    def conversion_5min_new_visitors(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'conversion-5min-new_visitors'::text AS metric_name,
-            'MAX'::text AS metric_collection_method, 
-            CASE WHEN (tvt_sec + linear_tvt_sec) > 60*5.0 THEN 1.0 ELSE 0.0 END AS metric_value
-          FROM raw_user_data
-          WHERE ds >= DATE_TRUNC('day',device_first_seen_ts) AND ds < device_first_seen_ts + INTERVAL '7 day'
-        )
-        """
-
-    def retention_new_viewers(self):
-        return """
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'retention--new_viewers'::text AS metric_name,
-            'MAX'::text AS metric_collection_method, 
-            CASE WHEN ds > device_first_view_ts + INTERVAL '1 day' AND (tvt_sec + linear_tvt_sec) > 10 THEN 1.0 ELSE 0.0 END AS metric_value
-          FROM raw_user_data
-          WHERE ds >= DATE_TRUNC('day',device_first_view_ts) AND ds < device_first_view_ts + INTERVAL '7 day'
-        )
-        """
-
-    def retention(self):
-        return """
-        , user_data AS (
-          SELECT DISTINCT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'retention'::text AS metric_name,
-            'SUMGREATERTHAN'::text AS metric_collection_method,
-            1.0 AS metric_value
-          FROM raw_user_data
-          WHERE (tvt_sec + linear_tvt_sec) > 10
-        )
-        """
-
-    def ad_impressions(self):
-        return """
-        , ad_impressions_data AS (
-            SELECT ds,
-                   device_id,
-                   device_first_seen_ts,
-                   platform,
-                   GETDATE() AS last_exposure_ds,
-                   DATEADD('week', -2, DATE_TRUNC('week', last_exposure_ds)) AS first_exposure_ds,
-                   COALESCE(ad_impression_total_count, 0)::float AS ad_impression_total_count,
-                   COALESCE(gross_revenue, 0)::float AS gross_revenue
-            FROM tubidw.revenue_bydevice_daily
-            WHERE DATE_TRUNC('week',ds) >= dateadd('week', -4, DATE_TRUNC('week',GETDATE()))
-              AND DATE_TRUNC('week',ds) < DATE_TRUNC('week', GETDATE())
-        )
-
-        , device_data_impressions AS (
-            SELECT  d.device_id,
-                    d.ds,
-                    d.platform,
-                    d.platform_type,
-                    d.device_first_seen_ts,
-                    d.first_exposure_ds,
-                    COALESCE(SUM(rev.ad_impression_total_count), 0)::float AS ad_impression_total_count,
-                    SUM(rev.gross_revenue) AS gross_revenue
-            FROM ad_impressions_data AS rev
-              RIGHT JOIN raw_user_data AS d
-                ON d.device_id = rev.device_id
-                AND d.ds = rev.ds
-            GROUP BY 1, 2, 3, 4, 5, 6
-        )
-
-          -- Impressions
-        , user_data AS (
-          SELECT 
-            device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds, 
-            'ad_impressions'::text AS metric_name,
-            'SUM'::text AS metric_collection_method,
-             COALESCE(ad_impression_total_count,0)::float AS metric_value
-          FROM device_data_impressions
-        )
-        """
-    
-    def tvt_vod_series(self):
-        return """
-        , user_data AS (
-            SELECT device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds,
-                'tvt-vod_series'::text AS metric_name,
-                series_tvt_sec/3600.0 AS metric_value,
-                'SUM'::text AS metric_collection_method
-            FROM raw_user_data
-        )
-        """
-    
-    def tvt_vod_movie(self):
-        return """
-        , user_data AS (
-            SELECT device_id, ds, platform_type, platform, device_first_seen_ts, first_exposure_ds,
-                'tvt-vod_movie'::text AS metric_name,
-                movie_tvt_sec/3600.0 AS metric_value,
-                'SUM'::text AS metric_collection_method
-            FROM raw_user_data
-        )
-        """
\ No newline at end of file
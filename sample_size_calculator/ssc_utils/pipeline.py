@@ -0,0 +1,266 @@
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+
+import pandas as pd
+
+from ssc_utils.filter_expression import filter_expression
+from ssc_utils.raw_user_data import raw_user_data, DAILY_COLUMNS
+from ssc_utils.metric_switcher import metric_switcher
+from ssc_utils.metric_summary import metric_summary
+from ssc_utils.cuped import cuped
+from ssc_utils.ratio_summary import ratio_summary
+from ssc_utils.cupac import cupac, RAW_COLUMNS
+from ssc_utils.quantile_sketch import metric_sketch, sketches_from_frame, quantile_metric_summary
+from ssc_utils.reach import device_reach
+from ssc_utils.executor import redshift_executor, query_cache, data_week
+from ssc_utils.tracing import NO_TRACE
+from ssc_utils.calculator import delta_method_summary
+
+
+@lru_cache(maxsize = 1024)
+def generate_metrics_ctes(filters, metrics, sample_pct = 100, caps = (), columns = ()):
+    """
+    The CTEs up to and including metric_summary's metrics (one metric_result/metric_covariate per device and metric).
+    raw_user_data only sums the columns the metrics read, plus columns (ie. for cupac's covariates).
+    caps: tuple of (metric, cap) items for metric_switcher
+    """
+    switcher = metric_switcher(dict(caps))
+    needed = set(switcher.required_columns(metrics)) | set(columns)
+    filters_sql = filter_expression().generate_filter_cte(filters, sample_pct = sample_pct)
+    raw_user_sql = raw_user_data().generate_raw_user_data_cte(prev_cte_sql = filters_sql, sample_pct = sample_pct,
+                                                              columns = [column for column in DAILY_COLUMNS if column in needed])
+    user_sql = switcher.generate_multi_metric_user_data_cte(list(metrics))
+    summary_sql = metric_summary().generate_metric_summary_cte()
+    return filters_sql + raw_user_sql + user_sql + summary_sql
+
+
+@lru_cache(maxsize = 1024)
+def generate_sql(filters, metrics, sample_pct = 100, device_level = False, caps = ()):
+    """Memoized on the (hashable) filter_spec, tuple of metrics, sample_pct, device_level and caps. See pipeline.generate_sql."""
+    cuped_sql = cuped().generate_cuped_cte(filters = filters, sample_pct = sample_pct, device_level = device_level)
+    return generate_metrics_ctes(filters, metrics, sample_pct, caps) + cuped_sql
+
+
+@lru_cache(maxsize = 1024)
+def generate_sketch_sql(filters, metrics, sample_pct = 100, source = 'metrics', relative_accuracy = 0.01, caps = ()):
+    """Memoized like generate_sql. See pipeline.generate_sketch_sql."""
+    sketch_sql = metric_sketch().generate_sketch_cte(source = source, relative_accuracy = relative_accuracy)
+    return generate_metrics_ctes(filters, metrics, sample_pct, caps) + sketch_sql
+
+
+@lru_cache(maxsize = 1024)
+def generate_cupac_sql(filters, metrics, sample_pct = 100):
+    """Memoized like generate_sql. See pipeline.generate_cupac_sql."""
+    return generate_metrics_ctes(filters, metrics, sample_pct, columns = RAW_COLUMNS) + cupac().generate_cupac_cte()
+
+
+@lru_cache(maxsize = 1024)
+def generate_ratio_sql(filters, ratio_metrics, sample_pct = 100):
+    """Memoized like generate_sql. See pipeline.generate_ratio_sql."""
+    definitions = metric_switcher().possible_ratio_metrics()
+    components = tuple(dict.fromkeys(metric for ratio in ratio_metrics for metric in definitions[ratio]))
+    ratio_sql = ratio_summary().generate_ratio_moments_cte(list(ratio_metrics), filters = filters, sample_pct = sample_pct)
+    return generate_metrics_ctes(filters, components, sample_pct) + ratio_sql
+
+
+@lru_cache(maxsize = 1024)
+def generate_reach_sql(filters, weeks = 8, precision = 12):
+    """Memoized on the filter_spec, weeks and precision. See pipeline.generate_reach_sql."""
+    filters_sql = filter_expression().generate_filter_cte(filters)
+    return device_reach().generate_reach_cte(prev_cte_sql = filters_sql, weeks = weeks, precision = precision)
+
+
+@lru_cache(maxsize = 1024)
+def generate_device_metrics_sql(filters, metrics, sample_pct = 100):
+    """The per-device rows of the metrics CTE, unordered: device_store sorts them on close (see pipeline.generate_device_metrics_sql)"""
+    return generate_metrics_ctes(filters, metrics, sample_pct) + """
+            SELECT device_id, metric_name, platform_type, platform, metric_result, metric_covariate
+            FROM metrics
+            """
+
+
+class pipeline(object):
+    """
+    The notebook's workflow without widgets: filter expression + metrics -> final SQL -> executor -> dataframe.
+
+    Query results are shared:
+        - identical queries that are already running are coalesced: later callers wait for the first one's result
+        - finished results are kept in memory (least recently used are dropped past max_results, all of them when
+          the week rolls over, see executor.data_week)
+        - and reused across sessions through the on-disk query_cache
+
+    stats counts where results came from (memory_hits, disk_hits, coalesced, misses).
+    """
+
+    def __init__(self, executor = None, cache = None, max_results = 256):
+        self.executor = executor if executor is not None else redshift_executor()
+        self.cache = cache if cache is not None else query_cache()
+        self.max_results = max_results
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'coalesced': 0, 'misses': 0}
+        self._results = OrderedDict()
+        self._results_week = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def generate_sql(self, filters, metrics, sample_pct = 100, device_level = False, caps = None):
+        """
+        Generates the final SQL string for one filter set and one or more metrics.
+        All metrics are computed in one query, on the same eligible devices.
+
+        Args:
+            filters: filter_expression.filter_spec
+            metrics: list of strings chosen from metric_switcher().possible_metrics()
+            sample_pct: percent of devices to keep, 0 < sample_pct <= 100 (see raw_user_data); the filter scans are sampled too
+            device_level: one cuped_result per device instead of the summary (see simulation)
+            caps: dict of winsorization caps for metric_switcher, ie. {'tvt-capped': 6.5}
+
+        Returns: String
+        """
+        return generate_sql(filters, tuple(metrics), sample_pct, device_level, tuple(sorted((caps or {}).items())))
+
+    def generate_sketch_sql(self, filters, metrics, sample_pct = 100, source = 'metrics', relative_accuracy = 0.01, caps = None):
+        """
+        Same arguments as generate_sql, but the query returns quantile sketch buckets per metric x platform
+        (quantile_sketch.sketches_from_frame reads them). source = 'user_data' sketches the daily values, 
+        to pick winsorization caps; 'metrics' the per-device values, for quantile metrics.
+
+        Returns: String
+        """
+        return generate_sketch_sql(filters, tuple(metrics), sample_pct, source, relative_accuracy, tuple(sorted((caps or {}).items())))
+
+    def generate_cupac_sql(self, filters, metrics, sample_pct = 100):
+        """
+        Same arguments as generate_sql, but with multi-covariate regression adjustment instead of CUPED: the query returns
+        the normal equation sums per metric x platform, cupac().summary(df, filters = filters, sample_pct = sample_pct)
+        turns them into the calculator's input.
+
+        Returns: String
+        """
+        return generate_cupac_sql(filters, tuple(metrics), sample_pct)
+
+    def generate_ratio_sql(self, filters, ratio_metrics, sample_pct = 100):
+        """
+        Generates the SQL string of one or more ratio metrics (metric_switcher().possible_ratio_metrics()):
+        their numerator/denominator moments per platform, for calculator.delta_method_summary.
+        
+        Returns: String
+        """
+        return generate_ratio_sql(filters, tuple(ratio_metrics), sample_pct)
+
+    def generate_reach_sql(self, filters, weeks = 8, precision = 12):
+        """
+        Generates the SQL of weekly HLL sketches of the eligible devices (all active devices without filters) per platform,
+        over the last weeks complete weeks. reach.accrual_curves(reach.weekly_sketches(df, precision)) gives the
+        accrual curves for calculate_sample_required(..., accrual = curves).
+
+        Returns: String
+        """
+        return generate_reach_sql(filters, weeks, precision)
+
+    def generate_device_metrics_sql(self, filters, metrics, sample_pct = 100):
+        """
+        Same arguments as generate_sql, but returns the device level metric_result/metric_covariate rows
+        (before CUPED), to be kept locally in a device_store.
+
+        Returns: String
+        """
+        return generate_device_metrics_sql(filters, tuple(metrics), sample_pct)
+
+    def summary(self, filters, metrics, sample_pct = 100, tracer = NO_TRACE):
+        """
+        Runs the queries behind any mix of metric kinds (see metric_switcher.metric_kind) for one filter set:
+        one cuped query for the metrics, one ratio query (delta method) and one sketch query (quantile metrics), as needed.
+
+        Returns: dataframe in the calculator's input format (metric_name, platform, observations, avg_cuped_result,
+                 std_cuped_result), rows of every metric_switcher().metric_name(metric)
+        """
+        switcher = metric_switcher()
+        kinds = {'metric': [], 'ratio': [], 'quantile': []}
+        for metric in dict.fromkeys(metrics):
+            kinds[switcher.metric_kind(metric)].append(metric)
+
+        frames = []
+        if kinds['metric']:
+            with tracer.stage('generate_sql'):
+                sql = self.generate_sql(filters, kinds['metric'], sample_pct)
+            frames.append(self.run_query(sql, tracer = tracer))
+        if kinds['ratio']:
+            with tracer.stage('generate_sql'):
+                sql = self.generate_ratio_sql(filters, kinds['ratio'], sample_pct)
+            frames.append(delta_method_summary(self.run_query(sql, tracer = tracer)))
+        if kinds['quantile']:
+            split = [switcher.quantile_metric(metric) for metric in kinds['quantile']]
+            with tracer.stage('generate_sql'):
+                sql = self.generate_sketch_sql(filters, list(dict.fromkeys(base for base, _ in split)), sample_pct)
+            sketches = sketches_from_frame(self.run_query(sql, tracer = tracer))
+            quantile_df = quantile_metric_summary(sketches, quantiles = sorted(set(q for _, q in split)),
+                                                  sample_multiplier = cuped().sample_multiplier(sample_pct = sample_pct, filters = filters))
+            names = [switcher.metric_name(metric) for metric in kinds['quantile']]
+            quantile_df = quantile_df[quantile_df['metric_name'].isin(names)]
+            # a single valued distribution has no density, and no sample size
+            undefined = quantile_df['std_cuped_result'].isna()
+            if undefined.any():
+                warnings.warn('dropped quantile metrics of single valued distributions: '
+                              + ', '.join(quantile_df.loc[undefined, 'metric_name'] + ' (' + quantile_df.loc[undefined, 'platform'] + ')'))
+            frames.append(quantile_df[~undefined])
+
+        columns = ['metric_name', 'platform', 'observations', 'avg_cuped_result', 'std_cuped_result']
+        return pd.concat([frame[columns] for frame in frames], ignore_index = True)
+
+    def run_query(self, sql, tracer = NO_TRACE):
+        """
+        Runs the SQL string, unless the same query is already running or was already run (in memory or in the on-disk cache).
+        Safe to call from many threads.
+
+        Returns: dataframe (shared between callers, copy before mutating)
+        """
+        # the key includes the data week, so results of last week's windows are never returned
+        key = self.cache.key(sql)
+        week = data_week(self.cache.clock())
+        with self._lock:
+            if week != self._results_week:
+                self._results.clear()
+                self._results_week = week
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self._results[key]
+            if key in self._in_flight:
+                self.stats['coalesced'] += 1
+                future = self._in_flight[key]
+                owner = False
+            else:
+                future = Future()
+                self._in_flight[key] = future
+                owner = True
+
+        if not owner:
+            with tracer.stage('wait_in_flight_query'):
+                return future.result()
+
+        try:
+            if self.cache.has(sql):
+                with tracer.stage('cache_read') as record:
+                    df = self.cache.get(sql)
+                    record.observe(df)
+                stat = 'disk_hits'
+            else:
+                df = self.cache.put(sql, self.executor.run(sql, tracer = tracer))
+                stat = 'misses'
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self.stats[stat] += 1
+            self._results[key] = df
+            while len(self._results) > self.max_results:
+                self._results.popitem(last = False)
+            del self._in_flight[key]
+        future.set_result(df)
+        return df
@@ -0,0 +1,191 @@
+import json
+import os
+
+import numpy as np
+from scipy import stats
+
+# Precomputed sample size lookup grid: required n per group for the two-sample t-test (as tt_ind_solve_power),
+# without any root finding at query time.
+#
+# n only depends on the standardized effect size d, alpha, power, ratio and sidedness. For fixed (alpha, power, ratio,
+# sidedness), n * d^2 is almost constant (it is exactly constant in the normal approximation) and smooth in log(d),
+# so the grid stores log(n * d^2) on log-spaced effect sizes and lookups interpolate linearly in log space.
+# That interpolation is monotone, vectorized (np.interp), and its error is measured at build time (max_rel_error).
+# The grid stops at d = 1 (n of a few dozen per group): above that the t-distribution correction bends n * d^2 too much
+# for a coarse grid, and the exact solver is cheap anyway.
+#
+# The table is a float32 .npy, memory-mapped on load, next to a small .json with the axes.
+
+
+BASE_ALPHAS = (0.01, 0.05, 0.10)
+MAX_TREATMENTS = 8
+
+
+def bonferroni_alphas(base_alphas = BASE_ALPHAS, max_treatments = MAX_TREATMENTS):
+    """The corrected alphas calculate_sample_required produces (alpha / number of treatments) for 1..max_treatments arms"""
+    return sorted(set(round(alpha / treatments, 12) for alpha in base_alphas for treatments in range(1, max_treatments + 1)))
+
+
+def nct_sf(x, df, nc):
+    """
+    Survival function of the noncentral t distribution.
+    scipy's nct returns NaN for large noncentrality/df (which is exactly where our sample sizes are), so those points use
+    the normal approximation of the noncentral t (Johnson, Kotz & Balakrishnan), accurate to ~1e-6 for df >= 100.
+    """
+    with np.errstate(all = 'ignore'):
+        exact = stats.nct.sf(x, df, nc)
+    approx = stats.norm.sf((x * (1.0 - 1.0 / (4.0 * df)) - nc) / np.sqrt(1.0 + x ** 2 / (2.0 * df)))
+    return np.where(np.isfinite(exact), exact, approx)
+
+
+def ttest_ind_power(effect_size, nobs1, alpha, ratio = 1, alternative = 'two-sided'):
+    """
+    Power of the two-sample t-test, vectorized over all arguments.
+    Same definition as statsmodels TTestIndPower.power (which tt_ind_solve_power inverts).
+    """
+    nobs2 = nobs1 * ratio
+    df = nobs1 + nobs2 - 2
+    nc = effect_size * np.sqrt(1.0 / (1.0 / nobs1 + 1.0 / nobs2))
+    alpha_ = alpha / 2.0 if alternative == 'two-sided' else alpha
+
+    power = nct_sf(stats.t.isf(alpha_, df), df, nc)
+    if alternative == 'two-sided':
+        power = power + (1.0 - nct_sf(stats.t.ppf(alpha_, df), df, nc))
+    return power
+
+
+def solve_nobs1(effect_size, alpha, power, ratio = 1, alternative = 'two-sided', iterations = 32):
+    """
+    Vectorized tt_ind_solve_power for nobs1: bisection in log(n) over whole arrays at once.
+
+    Returns: array of (unrounded) nobs1
+    """
+    effect_size, alpha, power = np.broadcast_arrays(np.asarray(effect_size, dtype = float),
+                                                    np.asarray(alpha, dtype = float),
+                                                    np.asarray(power, dtype = float))
+    # bracket around the normal approximation
+    z = stats.norm.isf(alpha / 2.0 if alternative == 'two-sided' else alpha) + stats.norm.ppf(power)
+    n_normal = (1.0 + 1.0 / ratio) * (z / effect_size) ** 2
+    low = np.log(np.maximum(n_normal / 4.0, 2.0 + 1e-9))
+    high = np.log(np.maximum(n_normal * 4.0, 8.0))
+
+    for _ in range(iterations):
+        mid = (low + high) / 2.0
+        too_small = ttest_ind_power(effect_size, np.exp(mid), alpha, ratio, alternative) < power
+        low = np.where(too_small, mid, low)
+        high = np.where(too_small, high, mid)
+    return np.exp((low + high) / 2.0)
+
+
+class power_grid(object):
+    """
+    Memory-mapped sample size grid.
+
+    Axes: alternative x ratio x alpha x power x log-spaced effect size.
+    Lookups on alphas/powers/ratios that are not on the grid return None, so callers fall back to the exact solver.
+    """
+
+    def __init__(self, table, axes):
+        self.table = table
+        self.axes = axes
+        self.log_effect_sizes = np.log(np.asarray(axes['effect_sizes']))
+        self.alphas = np.asarray(axes['alphas'])
+        self.powers = np.asarray(axes['powers'])
+        self.ratios = np.asarray(axes['ratios'])
+        self.alternatives = list(axes['alternatives'])
+
+    ##### Build / load #####
+
+    @classmethod
+    def build(cls,
+              alphas = None,
+              powers = tuple(np.round(np.arange(0.50, 1.00, 0.01), 2)),
+              ratios = (1.0,),
+              alternatives = ('two-sided', 'larger'),
+              min_effect_size = 1e-4,
+              max_effect_size = 1.0,
+              n_effect_sizes = 128):
+        """
+        Computes the grid, and measures the interpolation error at the midpoints between effect sizes.
+
+        Returns: power_grid (in memory, see save())
+        """
+        alphas = bonferroni_alphas() if alphas is None else sorted(alphas)
+        effect_sizes = np.geomspace(min_effect_size, max_effect_size, n_effect_sizes)
+        mid_effect_sizes = np.sqrt(effect_sizes[1:] * effect_sizes[:-1])
+
+        table = np.empty((len(alternatives), len(ratios), len(alphas), len(powers), n_effect_sizes), dtype = np.float32)
+        max_rel_error = 0.0
+        alpha_grid, power_grid_, effect_grid = np.meshgrid(alphas, powers, effect_sizes, indexing = 'ij')
+        alpha_mid, power_mid, effect_mid = np.meshgrid(alphas, powers, mid_effect_sizes, indexing = 'ij')
+        for i, alternative in enumerate(alternatives):
+            for j, ratio in enumerate(ratios):
+                nobs1 = solve_nobs1(effect_grid, alpha_grid, power_grid_, ratio, alternative)
+                table[i, j] = np.log(nobs1 * effect_grid ** 2)
+
+                exact_mid = solve_nobs1(effect_mid, alpha_mid, power_mid, ratio, alternative)
+                log_k = table[i, j].astype(float)
+                interpolated_log_k = (log_k[..., 1:] + log_k[..., :-1]) / 2.0  # midpoint in log(d) space
+                interpolated_mid = np.exp(interpolated_log_k) / effect_mid ** 2
+                max_rel_error = max(max_rel_error, float(np.max(np.abs(interpolated_mid / exact_mid - 1.0))))
+
+        axes = {
+            'alternatives': list(alternatives),
+            'ratios': [float(r) for r in ratios],
+            'alphas': [float(a) for a in alphas],
+            'powers': [float(p) for p in powers],
+            'effect_sizes': [float(d) for d in effect_sizes],
+            'max_rel_error': max_rel_error
+        }
+        return cls(table, axes)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok = True)
+        np.save(os.path.join(directory, 'power_grid.npy'), self.table)
+        with open(os.path.join(directory, 'power_grid.json'), 'w') as f:
+            json.dump(self.axes, f)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-maps a saved grid (pages are only read when looked up)"""
+        table = np.load(os.path.join(directory, 'power_grid.npy'), mmap_mode = 'r')
+        with open(os.path.join(directory, 'power_grid.json')) as f:
+            axes = json.load(f)
+        return cls(table, axes)
+
+    @classmethod
+    def load_or_build(cls, directory = os.path.join(os.path.expanduser('~'), '.ssc_utils', 'power_grid')):
+        if not os.path.exists(os.path.join(directory, 'power_grid.npy')):
+            cls.build().save(directory)
+        return cls.load(directory)
+
+    ##### Lookup #####
+
+    def axis_index(self, values, value):
+        matches = np.flatnonzero(np.isclose(values, value, rtol = 1e-9, atol = 1e-12))
+        return int(matches[0]) if len(matches) > 0 else None
+
+    def lookup(self, effect_size, alpha, power, ratio = 1, alternative = 'two-sided'):
+        """
+        Required nobs1 (unrounded) for an array of standardized effect sizes.
+
+        Effect sizes below the grid use the smallest grid point's n * d^2 (it converges to the normal approximation);
+        effect sizes above the grid come back as NaN.
+
+        Returns: array, or None when alpha/power/ratio/alternative is not on the grid
+        """
+        if alternative not in self.alternatives:
+            return None
+        indexes = (self.alternatives.index(alternative),
+                   self.axis_index(self.ratios, ratio),
+                   self.axis_index(self.alphas, alpha),
+                   self.axis_index(self.powers, power))
+        if None in indexes:
+            return None
+
+        log_k = np.asarray(self.table[indexes], dtype = float)
+        effect_size = np.abs(np.asarray(effect_size, dtype = float))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            log_d = np.log(effect_size)
+            nobs1 = np.exp(np.interp(log_d, self.log_effect_sizes, log_k)) / effect_size ** 2
+        return np.where(log_d > self.log_effect_sizes[-1], np.nan, nobs1)
@@ -0,0 +1,221 @@
+import pandas as pd
+import numpy as np
+import re
+import os
+import time
+from datetime import datetime
+
+from ssc_utils.executor import redshift_executor, query_cache
+from ssc_utils.tracing import NO_TRACE
+
+
+class preflight(object):
+    """
+    Pre-flight cost check for the final SQL string, before launching the full query.
+
+    Runs EXPLAIN on the final SQL (and on its sampled version), parses the estimated rows/cost per CTE, and
+    predicts a runtime band from the timings of previous runs. The user can then run it as is ('full'),
+    on a sample of devices ('sampled'), or reuse the result of an identical earlier query ('cached').
+
+    Runtime history is a small CSV of (backend, plan cost, seconds) pairs, appended by execute().
+    """
+
+    MODES = ('full', 'sampled', 'cached')
+
+    # plan lines look like "XN Hash Join DS_DIST_NONE  (cost=0.00..3456.78 rows=1000 width=20)"
+    PLAN_LINE = re.compile(r'^(?P<indent>\s*)(->\s*)?(?P<node>.*?)\s*\(cost=(?P<startup_cost>[\d.]+)\.\.(?P<total_cost>[\d.]+) rows=(?P<rows>\d+) width=(?P<width>\d+)\)')
+    # node labels that name a CTE ("XN Subquery Scan raw_user_data", "CTE Scan on metrics", "CTE metrics")
+    CTE_LABEL = re.compile(r'(?:Subquery Scan|CTE Scan on|^CTE)\s+(?:on\s+)?(?P<name>\w+)')
+    CTE_NAME = re.compile(r'(\w+)\s+as\s*\(', re.IGNORECASE)
+
+    def __init__(self, executor = None, cache = None,
+                 history_path = os.path.join(os.path.expanduser('~'), '.ssc_utils', 'query_timings.csv'),
+                 min_history = 5):
+        self.executor = executor if executor is not None else redshift_executor()
+        self.cache = cache if cache is not None else query_cache()
+        self.history_path = history_path
+        self.min_history = min_history
+
+    ##### Plan parsing #####
+
+    def cte_names(self, sql):
+        """Names of the CTEs defined in the SQL string, in order"""
+        return list(dict.fromkeys(self.CTE_NAME.findall(sql)))
+
+    def parse_plan(self, plan_lines, cte_names):
+        """
+        Parses EXPLAIN output into one row per plan node.
+
+        Each node is tagged with the CTE it belongs to: the nearest labelled ancestor whose label is one of cte_names
+        (None for nodes outside any CTE, ie. the final SELECT).
+
+        Returns: dataframe (depth, node, cte, startup_cost, total_cost, rows, width)
+        """
+        nodes = []
+        scopes = []  # stack of (depth, cte name)
+        for line in plan_lines:
+            match = self.PLAN_LINE.match(line)
+            if match is None:
+                continue
+            depth = len(match.group('indent'))
+            node = match.group('node').strip()
+
+            while len(scopes) > 0 and scopes[-1][0] >= depth:
+                scopes.pop()
+            label = self.CTE_LABEL.search(node)
+            if (label is not None) and (label.group('name') in cte_names):
+                scopes.append((depth, label.group('name')))
+
+            nodes.append({
+                'depth': depth,
+                'node': node,
+                'cte': scopes[-1][1] if len(scopes) > 0 else None,
+                'startup_cost': float(match.group('startup_cost')),
+                'total_cost': float(match.group('total_cost')),
+                'rows': int(match.group('rows')),
+                'width': int(match.group('width'))
+            })
+        return pd.DataFrame(nodes, columns = ['depth', 'node', 'cte', 'startup_cost', 'total_cost', 'rows', 'width'])
+
+    def summarize_plan(self, plan_df):
+        """
+        Estimated rows and cost per CTE, taken from the top (least indented) node of each CTE.
+        Costs are cumulative, so a CTE's cost includes the CTEs it reads from.
+
+        Returns: dataframe (cte, est_rows, est_cost, est_bytes)
+        """
+        if plan_df.empty:
+            return pd.DataFrame(columns = ['cte', 'est_rows', 'est_cost', 'est_bytes'])
+        tops = plan_df[plan_df['cte'].notnull()].sort_values('depth').groupby('cte', sort = False).head(1)
+        summary = pd.DataFrame({
+            'cte': tops['cte'],
+            'est_rows': tops['rows'],
+            'est_cost': tops['total_cost'],
+            'est_bytes': tops['rows'] * tops['width']
+        })
+        return summary.sort_values('est_cost').reset_index(drop = True)
+
+    ##### Runtime history #####
+
+    def load_history(self):
+        if not os.path.exists(self.history_path):
+            return pd.DataFrame(columns = ['ts', 'backend', 'mode', 'total_cost', 'seconds'])
+        return pd.read_csv(self.history_path)
+
+    def record_timing(self, total_cost, seconds, mode):
+        os.makedirs(os.path.dirname(self.history_path), exist_ok = True)
+        row = pd.DataFrame([{
+            'ts': datetime.now().isoformat(),
+            'backend': self.executor.name,
+            'mode': mode,
+            'total_cost': total_cost,
+            'seconds': seconds
+        }])
+        row.to_csv(self.history_path, mode = 'a', index = False, header = not os.path.exists(self.history_path))
+
+    def runtime_band(self, total_cost, quantiles = (0.1, 0.5, 0.9)):
+        """
+        Predicted runtime (seconds) for a plan cost, from the seconds-per-cost ratios of previous runs on the same backend.
+
+        Returns: tuple (low, median, high), or None when there are fewer than min_history previous runs
+        """
+        history = self.load_history()
+        history = history[(history['backend'] == self.executor.name) & (history['total_cost'] > 0)]
+        if (len(history) < self.min_history) or (total_cost is None):
+            return None
+        seconds_per_cost = history['seconds'] / history['total_cost']
+        return tuple(float(total_cost * seconds_per_cost.quantile(q)) for q in quantiles)
+
+    ##### Pre-flight check #####
+
+    def check(self, sql, sampled_sql = None, tracer = NO_TRACE):
+        """
+        Runs EXPLAIN on the final SQL (and the sampled SQL, if given) without running the query.
+
+        Args:
+            sql: final SQL string
+            sampled_sql: the same query on a sample of devices (see raw_user_data sample_pct), or None
+            tracer: tracing.tracer
+
+        Returns: dict with the plan summary per CTE, total cost/rows, runtime bands and which modes are available
+        """
+        cte_names = self.cte_names(sql)
+        with tracer.stage('explain'):
+            plan_df = self.parse_plan(self.executor.explain(sql), cte_names)
+        total_cost = float(plan_df['total_cost'].iloc[0]) if not plan_df.empty else None
+
+        report = {
+            'sql': sql,
+            'sampled_sql': sampled_sql,
+            'plan': self.summarize_plan(plan_df),
+            'total_cost': total_cost,
+            'total_rows': int(plan_df['rows'].iloc[0]) if not plan_df.empty else None,
+            'runtime_band': self.runtime_band(total_cost),
+            'sampled_total_cost': None,
+            'sampled_runtime_band': None,
+            'cached': self.cache.has(sql)
+        }
+
+        if sampled_sql is not None:
+            sampled_plan_df = self.parse_plan(self.executor.explain(sampled_sql), cte_names)
+            if not sampled_plan_df.empty:
+                report['sampled_total_cost'] = float(sampled_plan_df['total_cost'].iloc[0])
+                report['sampled_runtime_band'] = self.runtime_band(report['sampled_total_cost'])
+
+        report['modes'] = [mode for mode in self.MODES
+                           if (mode == 'full')
+                           or ((mode == 'sampled') and (sampled_sql is not None))
+                           or ((mode == 'cached') and report['cached'])]
+        return report
+
+    def format_band(self, band):
+        if band is None:
+            return 'unknown (not enough timing history yet)'
+        return '{:.0f}s - {:.0f}s (median {:.0f}s)'.format(band[0], band[2], band[1])
+
+    def describe(self, report):
+        """Returns: printable summary of a pre-flight report"""
+        lines = [
+            'estimated cost: {} ({} result rows)'.format(report['total_cost'], report['total_rows']),
+            'predicted runtime: ' + self.format_band(report['runtime_band'])
+        ]
+        if report['sampled_sql'] is not None:
+            lines.append('predicted runtime (sampled): ' + self.format_band(report['sampled_runtime_band']))
+        if report['cached']:
+            lines.append('an identical query was already run: cached result available')
+        lines.append('')
+        lines.append(report['plan'].to_string(index = False))
+        return '\n'.join(lines)
+
+    def execute(self, report, mode = 'full', tracer = NO_TRACE):
+        """
+        Runs the query of a pre-flight report in the chosen mode, and records its runtime for future predictions.
+
+        Args:
+            report: output of check()
+            mode: 'full', 'sampled', or 'cached'
+            tracer: tracing.tracer, passed on to the executor
+
+        Returns: dataframe
+        """
+        if mode not in report['modes']:
+            raise ValueError('mode ' + mode + ' is not available, choose one of ' + str(report['modes']))
+
+        if mode == 'cached':
+            with tracer.stage('cache_read') as record:
+                df = self.cache.get(report['sql'])
+                record.observe(df)
+            return df
+
+        sql = report['sql'] if mode == 'full' else report['sampled_sql']
+        total_cost = report['total_cost'] if mode == 'full' else report['sampled_total_cost']
+
+        start = time.time()
+        df = self.executor.run(sql, tracer = tracer)
+        if total_cost is not None:
+            self.record_timing(total_cost, time.time() - start, mode)
+
+        # only full results are reused by 'cached' mode
+        if mode == 'full':
+            self.cache.put(sql, df)
+        return df
@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+
+from ssc_utils.cuped import PLATFORMS
+from ssc_utils.metric_switcher import metric_switcher, METRICS
+
+# Mergeable quantile sketches per metric x platform, for data-driven winsorization caps and quantile metrics.
+#
+# The sketch is a DDSketch (Masson, Rim & Lee 2019): values are counted in log-spaced buckets
+#   key = ceil(log(|value|) / log(gamma)),  gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+# (one set of buckets per sign) so any quantile comes back within relative_accuracy of the exact one. Unlike t-digest/KLL, the buckets are a plain
+# GROUP BY in SQL, so the warehouse builds sketches in the same pass as the metrics (metric_sketch), and sketches from
+# shards, weeks or local device-level chunks merge by adding bucket counts. Memory is bounded by max_buckets (the
+# buckets closest to zero are collapsed first, as in DDSketch).
+
+
+class quantile_sketch(object):
+    """
+    DDSketch of one distribution: bucket counts of positive values, of negative values (by |value|), and a zero count.
+    """
+
+    def __init__(self, relative_accuracy = 0.01, max_buckets = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.max_buckets = max_buckets
+        # sign -> (keys, counts)
+        self.stores = {1: (np.zeros(0, dtype = np.int64), np.zeros(0)), -1: (np.zeros(0, dtype = np.int64), np.zeros(0))}
+        self.zero_count = 0.0
+
+    @classmethod
+    def from_values(cls, values, relative_accuracy = 0.01, max_buckets = 2048):
+        sketch = cls(relative_accuracy, max_buckets)
+        sketch.add(values)
+        return sketch
+
+    def bucket_keys(self, magnitudes):
+        return np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64)
+
+    def add(self, values):
+        """Adds an array of values (NaN are skipped)"""
+        values = np.asarray(values, dtype = float)
+        values = values[~np.isnan(values)]
+        self.zero_count += float(np.sum(values == 0))
+        for sign in (1, -1):
+            keys, counts = np.unique(self.bucket_keys(np.abs(values[np.sign(values) == sign])), return_counts = True)
+            self.add_buckets(sign, keys, counts)
+
+    def add_buckets(self, sign, keys, counts):
+        """Adds bucket counts of one sign (from SQL, or another sketch with the same relative_accuracy)"""
+        old_keys, old_counts = self.stores[sign]
+        keys, inverse = np.unique(np.concatenate([old_keys, np.asarray(keys, dtype = np.int64)]), return_inverse = True)
+        counts = np.bincount(inverse, weights = np.concatenate([old_counts, np.asarray(counts, dtype = float)]), minlength = len(keys))
+        self.stores[sign] = (keys, counts)
+        self.collapse(sign)
+
+    def merge(self, other):
+        """Adds another sketch (same relative_accuracy). Returns: self"""
+        if not np.isclose(other.gamma, self.gamma):
+            raise ValueError('can only merge sketches with the same relative_accuracy')
+        self.zero_count += other.zero_count
+        for sign, (keys, counts) in other.stores.items():
+            self.add_buckets(sign, keys, counts)
+        return self
+
+    def collapse(self, sign):
+        """Keeps at most max_buckets per sign: the buckets nearest zero are merged into the next one"""
+        keys, counts = self.stores[sign]
+        excess = len(keys) - self.max_buckets
+        if excess > 0:
+            counts = np.concatenate([[counts[:excess + 1].sum()], counts[excess + 1:]])
+            self.stores[sign] = (keys[excess:], counts)
+
+    @property
+    def count(self):
+        return float(sum(counts.sum() for _, counts in self.stores.values()) + self.zero_count)
+
+    def quantile(self, q):
+        """
+        Quantile(s) q in [0, 1] (lower quantile at rank q * (count - 1), as DDSketch).
+        Each bucket is represented by 2 * gamma^key / (gamma + 1), within relative_accuracy of its values.
+
+        Returns: float or array, NaN when the sketch is empty
+        """
+        q = np.asarray(q, dtype = float)
+        if self.count == 0:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        represent = lambda keys: 2.0 * self.gamma ** keys.astype(float) / (self.gamma + 1.0)
+        negative_keys, negative_counts = self.stores[-1]
+        positive_keys, positive_counts = self.stores[1]
+        # ascending values: negatives by decreasing magnitude, zero, positives
+        values = np.concatenate([-represent(negative_keys[::-1]), [0.0], represent(positive_keys)])
+        cumulative = np.cumsum(np.concatenate([negative_counts[::-1], [self.zero_count], positive_counts]))
+        ranks = q * (self.count - 1)
+        result = values[np.minimum(np.searchsorted(cumulative, ranks, side = 'right'), len(values) - 1)]
+        return result if q.ndim else float(result)
+
+
+def sketches_from_frame(df, relative_accuracy = 0.01, max_buckets = 2048, key_cols = ('metric_name', 'platform_type', 'platform')):
+    """
+    Sketches from the bucket counts of metric_sketch's query (one row per key and bucket).
+    Rows with other keys (ie. a week column) are merged into their key_cols group.
+
+    Returns: dict of key -> quantile_sketch
+    """
+    sketches = {}
+    for key, group in df.groupby(list(key_cols)):
+        sketch = quantile_sketch(relative_accuracy, max_buckets)
+        signs, buckets, counts = group['sign'].to_numpy(), group['bucket'].to_numpy(), group['count'].to_numpy(dtype = float)
+        sketch.zero_count = float(counts[signs == 0].sum())
+        for sign in (1, -1):
+            sketch.add_buckets(sign, buckets[signs == sign], counts[signs == sign])
+        sketches[key] = sketch
+    return sketches
+
+
+def merge_sketches(*sketch_dicts):
+    """Merges dicts of sketches (shards, weeks) key by key. Returns: dict"""
+    merged = {}
+    for sketches in sketch_dicts:
+        for key, sketch in sketches.items():
+            if key not in merged:
+                merged[key] = quantile_sketch(sketch.relative_accuracy, sketch.max_buckets)
+            merged[key].merge(sketch)
+    return merged
+
+
+def rollup(sketches):
+    """
+    Sketches keyed by (metric_name, platform_type, platform) -> the levels of cuped's results:
+    (metric_name, 'ALL'), (metric_name, platform_type) and (metric_name, platform) for PLATFORMS.
+
+    Returns: dict of (metric_name, platform) -> quantile_sketch
+    """
+    levels = {}
+    for (metric_name, platform_type, platform), sketch in sketches.items():
+        for key in [(metric_name, 'ALL'), (metric_name, platform_type)] + ([(metric_name, platform)] if platform in PLATFORMS else []):
+            if key not in levels:
+                levels[key] = quantile_sketch(sketch.relative_accuracy, sketch.max_buckets)
+            levels[key].merge(sketch)
+    return levels
+
+
+def winsorization_caps(sketches, quantile = 0.995):
+    """
+    Caps of the capped metrics (metric_switcher.capped_metrics) at a quantile of the pooled daily values of the
+    uncapped metric they cap (the 'ALL' level of rollup(sketches)). The sketches have to be of the uncapped daily
+    values (generate_sketch_sql(filters, ['tvt'], source = 'user_data')): capped values would be capped already.
+
+    Returns: dict of capped metric -> cap, as metric_switcher(caps = ...) and the pipeline's caps take them
+    """
+    pooled = {key[0]: sketch for key, sketch in rollup(sketches).items() if key[1] == 'ALL'}
+    caps = {}
+    for capped, uncapped in metric_switcher.capped_metrics.items():
+        metric_name = METRICS[uncapped].metric_name
+        if metric_name in pooled:
+            caps[capped] = float(pooled[metric_name].quantile(quantile))
+    return caps
+
+
+def quantile_density(sketch, q, bandwidth = 0.01):
+    """
+    Density of the sketch's distribution at its q quantile, from the quantiles at q +- bandwidth. At an atom (ie. a
+    median of 0, or any quantile of integer counts) both quantiles are the same value, so the band is doubled until
+    they differ: the atom's mass is then spread up to the next observed value, as if the counts were continuous.
+
+    Returns: float (NaN when the distribution is a single value)
+    """
+    while True:
+        lower, upper = max(q - bandwidth, 0.0), min(q + bandwidth, 1.0)
+        low, high = sketch.quantile(lower), sketch.quantile(upper)
+        if high > low:
+            return (upper - lower) / (high - low)
+        if (lower == 0.0) and (upper == 1.0):
+            return np.nan
+        bandwidth *= 2
+
+
+def quantile_metric_summary(sketches, quantiles = (0.5, 0.9), bandwidth = 0.01, sample_multiplier = 1.0):
+    """
+    Quantile metrics in the format calculate_sample_required takes, with one 'metric_name-pXX' row per quantile and level.
+
+    The sample quantile is asymptotically normal with variance q(1 - q) / (n f(x_q)^2), so the per-device
+    "std" is sqrt(q(1 - q)) / f(x_q), with the density f estimated from the sketch over q +- bandwidth, widened at
+    atoms (see quantile_density). Only single valued distributions get NaN: they have no usable density.
+
+    Returns: dataframe (metric_name, platform, observations, avg_cuped_result, std_cuped_result)
+    """
+    rows = []
+    for (metric_name, platform), sketch in rollup(sketches).items():
+        for q in quantiles:
+            value = sketch.quantile(q)
+            density = quantile_density(sketch, q, bandwidth)
+            rows.append({'metric_name': metric_name + '-p' + ('%g' % (q * 100)),
+                         'platform': platform,
+                         'observations': sketch.count * sample_multiplier,
+                         'avg_cuped_result': value,
+                         'std_cuped_result': np.sqrt(q * (1 - q)) / density})
+    return pd.DataFrame(rows, columns = ['metric_name', 'platform', 'observations', 'avg_cuped_result', 'std_cuped_result'])
+
+
+class metric_sketch(object):
+
+    def generate_sketch_cte(self, source = 'metrics', relative_accuracy = 0.01):
+        """
+        Generates the SQL that counts the values of every metric x platform in DDSketch buckets
+        (sketches_from_frame reads the results). Should always be the last CTE in the final SQL string.
+
+        Args:
+            source: 'metrics' for the per-device results (quantile metrics), 'user_data' for the daily values
+                    before they are summed per device (winsorization caps of daily values, as tvt-capped's)
+            relative_accuracy: of the quantiles
+
+        Returns: String
+        """
+        value = {'metrics': 'metric_result', 'user_data': 'metric_value'}[source]
+        log_gamma = np.log((1.0 + relative_accuracy) / (1.0 - relative_accuracy))
+        return """
+            , sketch_values AS (
+              SELECT metric_name, platform_type, platform, {value}::float AS value
+              FROM {source}
+              WHERE {value} IS NOT NULL
+            )
+
+            SELECT metric_name,
+                   platform_type,
+                   platform,
+                   SIGN(value)::int AS sign,
+                   CASE WHEN value = 0 THEN 0 ELSE CEIL(LN(ABS(value)) / {log_gamma})::int END AS bucket,
+                   COUNT(*) AS count
+            FROM sketch_values
+            GROUP BY 1, 2, 3, 4, 5
+            """.format(value = value, source = source, log_gamma = repr(float(log_gamma)))
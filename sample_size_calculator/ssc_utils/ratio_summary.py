@@ -0,0 +1,98 @@
+from ssc_utils.metric_switcher import metric_switcher
+from ssc_utils.cuped import cuped, PLATFORMS
+
+
+# Sums over devices, per ratio metric and platform, that the delta method needs (calculator.ratio_summary):
+# numerator y, denominator x and their covariates y0, x0 (the same metrics before first exposure).
+MOMENTS = [('y',), ('x',), ('y0',), ('x0',),
+           ('y', 'y'), ('x', 'x'), ('y', 'x'),
+           ('y0', 'y0'), ('x0', 'x0'), ('y0', 'x0'),
+           ('y', 'y0'), ('y', 'x0'), ('x', 'y0'), ('x', 'x0')]
+
+
+def moment_name(moment):
+    return 'sum_' + '_'.join(moment)
+
+
+class ratio_summary(object):
+
+    def generate_ratio_moments_cte(self, ratio_metrics, event2_condition_interact = None, sample_pct = 100, filters = None):
+        """
+        Generates the SQL that aggregates the numerator/denominator moments of ratio metrics from the metrics CTE
+        (metric_summary), in the same query. Should always be the last CTE in the final SQL string, in place of cuped's.
+        The user_data CTE has to stack all numerators and denominators (metric_switcher.generate_multi_metric_user_data_cte).
+        
+        Args:
+            ratio_metrics: list of strings chosen from metric_switcher().possible_ratio_metrics()
+            event2_condition_interact, sample_pct, filters: as in cuped.generate_cuped_cte (observations scaling)
+            
+        Returns: String
+        """
+        switcher = metric_switcher()
+        definitions = switcher.possible_ratio_metrics()
+        sample_multiplier = str(cuped().sample_multiplier(event2_condition_interact, sample_pct, filters))
+        
+        component_names = []
+        for ratio in ratio_metrics:
+            for metric in definitions[ratio]:
+                if switcher.metric_name(metric) not in component_names:
+                    component_names.append(switcher.metric_name(metric))
+        
+        # one row per device and platform, one column pair (result, covariate) per component metric
+        pivot_sql = ','.join("""
+                MAX(CASE WHEN metric_name = '{name}' THEN metric_result END) AS result_{i},
+                MAX(CASE WHEN metric_name = '{name}' THEN metric_covariate END) AS covariate_{i}""".format(name = name, i = i)
+                               for i, name in enumerate(component_names))
+        
+        # missing metrics (ie. no visits on a day filter) count as 0, NULL covariates (new devices) too
+        ratio_sqls = []
+        for ratio in ratio_metrics:
+            numerator, denominator = [component_names.index(switcher.metric_name(metric)) for metric in definitions[ratio]]
+            ratio_sqls.append("""
+              SELECT device_id, platform_type, platform,
+                     '{ratio}'::text AS metric_name,
+                     COALESCE(result_{y}, 0) AS y,
+                     COALESCE(result_{x}, 0) AS x,
+                     COALESCE(covariate_{y}, 0) AS y0,
+                     COALESCE(covariate_{x}, 0) AS x0
+              FROM ratio_devices""".format(ratio = ratio, y = numerator, x = denominator))
+        
+        moments_sql = ',\n                       '.join('SUM(' + ' * '.join(moment) + ')::float AS ' + moment_name(moment) for moment in MOMENTS)
+        
+        return """
+            , ratio_devices AS (
+              SELECT device_id, platform_type, platform, {pivot}
+              FROM metrics
+              GROUP BY 1, 2, 3
+            )
+            
+            , ratio_values AS ({ratio_values}
+            )
+            
+            , ratio_moments AS (
+                SELECT metric_name, 'ALL' AS platform, COUNT(*) AS devices, {moments}
+                FROM ratio_values
+                GROUP BY 1, 2
+                
+                UNION ALL
+                
+                SELECT metric_name, platform_type AS platform, COUNT(*) AS devices, {moments}
+                FROM ratio_values
+                GROUP BY 1, 2
+                
+                UNION ALL
+                
+                SELECT metric_name, platform, COUNT(*) AS devices, {moments}
+                FROM ratio_values
+                WHERE platform in {platforms}
+                GROUP BY 1, 2
+            )
+            
+            SELECT *, devices * {sampling} AS observations
+            FROM ratio_moments
+            """.format(pivot = pivot_sql,
+                       ratio_values = """
+              UNION ALL""".join(ratio_sqls),
+                       moments = moments_sql,
+                       platforms = str(PLATFORMS),
+                       sampling = sample_multiplier)
@@ -1,11 +1,56 @@
+# device_metric_daily columns raw_user_data can sum per device and day (metric_switcher.required_columns picks the ones
+# the chosen metrics read)
+DAILY_COLUMNS = ('tvt_sec', 'linear_tvt_sec', 'user_signup_count', 'device_registration_count',
+                 'signup_or_registration_activity_count', 'visit_total_count', 'series_tvt_sec', 'movie_tvt_sec')
+
+
+
+def check_sample_pct(sample_pct):
+    """Raises ValueError unless 0 < sample_pct <= 100"""
+    if not (0 < sample_pct <= 100):
+        raise ValueError('sample_pct must be in (0, 100], got ' + repr(sample_pct))
+
+
+def device_sample_filter(sample_pct, device_id = 'device_id'):
+    """
+    "AND ..." condition that keeps sample_pct percent of devices, by a hash of device_id: the same devices in every
+    CTE that uses it (raw_user_data, filter_generator's scans) and in every run. '' for 100.
+
+    Returns: String
+    """
+    check_sample_pct(sample_pct)
+    if sample_pct >= 100:
+        return ''
+    return "AND MOD(STRTOL(LEFT(MD5(" + device_id + "), 8), 16), 10000) < " + str(int(round(sample_pct * 100)))
+
+
 class raw_user_data(object):
     """
-    Generates a catch-all string: SQL CTE that pulls the standard metrics of active devices in the last 4 weeks.
+    Generates the SQL CTE that pulls the daily metric columns (DAILY_COLUMNS) of active devices in the last 4 weeks.
 
     In the future, we may want to improve this to allow flexibility for more complex metrics not available in device_metric_daily
     ie. verification rates can only be calculated from analytics_richevent using is_confirmed = 't'            
     """
-    def generate_raw_user_data_cte(self, prev_cte_sql):
+    def generate_raw_user_data_cte(self, prev_cte_sql, sample_pct = 100, columns = None):
+        """
+        Args:
+            prev_cte_sql: string of filtering CTEs (from filter_generator); 'WITH' means no filters
+            sample_pct: percent of devices to keep, 0 < sample_pct <= 100 (hash of device_id, so the same devices are kept every run). 
+                        Everything downstream (metric, summary, CUPED) only sees the sampled devices; 
+                        cuped.generate_cuped_cte scales observations back up with the same sample_pct.
+            columns: DAILY_COLUMNS to sum (ie. metric_switcher().required_columns(metrics)); None means all of them
+        
+        Returns: String
+        """
+        check_sample_pct(sample_pct)
+        if columns is None:
+            columns = DAILY_COLUMNS
+        unknown = [column for column in columns if column not in DAILY_COLUMNS]
+        if unknown:
+            raise ValueError('unknown device_metric_daily columns ' + str(unknown) + ', choose from ' + str(DAILY_COLUMNS))
+        metric_columns = ''.join(""",
+                  sum({column}) AS {column}""".format(column = column) for column in columns)
+        
         start_str = """ raw_user_data AS (
               SELECT 
                   a.device_id,
@@ -15,18 +60,9 @@ class raw_user_data(object):
                   platform_type,
                   platform,
                   GETDATE() AS last_exposure_ds,
-                  DATEADD('week', -2, DATE_TRUNC('week', last_exposure_ds)) AS first_exposure_ds,
-                  -- Metrics
-                  sum(tvt_sec) as tvt_sec,
-                  sum(linear_tvt_sec) AS linear_tvt_sec,
-                  sum(user_signup_count) as user_signup_count,
-                  sum(device_registration_count) as device_registration_count,
-                  sum(signup_or_registration_activity_count) as signup_or_registration_activity_count,
-                  sum(visit_total_count) as visit_total_count,
-                  sum(series_tvt_sec) as series_tvt_sec,
-                  sum(movie_tvt_sec) AS movie_tvt_sec
+                  DATEADD('week', -2, DATE_TRUNC('week', last_exposure_ds)) AS first_exposure_ds{metric_columns}
               FROM tubidw.device_metric_daily as a
-        """
+        """.format(metric_columns = metric_columns)
         
         if prev_cte_sql == 'WITH':
             join_str = ''
@@ -40,8 +76,9 @@ class raw_user_data(object):
         end_str = """
               WHERE DATE_TRUNC('week',ds) >= dateadd('week', -4, DATE_TRUNC('week',GETDATE()))
                 AND DATE_TRUNC('week',ds) < DATE_TRUNC('week', GETDATE())
+                {sample_filter}
               GROUP BY 1,2,3,4,5,6,7,8
             )
         """
         
-        return start_str + join_str + end_str
\ No newline at end of file
+        return start_str + join_str + end_str.format(sample_filter = device_sample_filter(sample_pct, 'a.device_id'))
\ No newline at end of file
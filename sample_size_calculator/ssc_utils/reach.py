@@ -0,0 +1,174 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from ssc_utils.cuped import PLATFORMS
+
+# Weekly unique-device accrual curves from HyperLogLog sketches, for weeks_required.
+#
+# weeks_required used to divide the sample size by observations * 0.5 * allocation, as if unique devices grew linearly
+# with the run length. They don't: most devices of week 2 were already there in week 1. Exact COUNT(DISTINCT device_id)
+# over every cumulative horizon is expensive, so the warehouse returns one HLL sketch (the max rank per register) per
+# platform and week, and the cumulative reach over 1..N weeks comes from merging weekly sketches (element-wise max).
+# The same registers are computed locally from device ids (md5, as in SQL), so local and warehouse sketches merge.
+
+
+class hll(object):
+    """
+    HyperLogLog sketch with 2^precision registers (relative standard error ~ 1.04 / sqrt(2^precision)).
+    A device id's register is the first precision bits of md5(device_id), its rank the position of the first 1 bit
+    in bits 33-64 (the same as device_reach's SQL).
+    """
+
+    def __init__(self, precision = 12, registers = None):
+        self.precision = precision
+        self.m = 2 ** precision
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype = np.uint8)
+
+    def add(self, device_ids):
+        for device_id in device_ids:
+            digest = hashlib.md5(str(device_id).encode('utf-8')).hexdigest()
+            register = int(digest[:8], 16) >> (32 - self.precision)
+            rank = 33 - int(digest[8:16], 16).bit_length()
+            self.registers[register] = max(self.registers[register], rank)
+        return self
+
+    def merge(self, other):
+        """Union of the two sets. Returns: self"""
+        if other.precision != self.precision:
+            raise ValueError('can only merge sketches with the same precision')
+        self.registers = np.maximum(self.registers, other.registers)
+        return self
+
+    def copy(self):
+        return hll(self.precision, self.registers.copy())
+
+    def cardinality(self):
+        """Estimated number of distinct device ids (with the small-range linear counting correction)"""
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = np.sum(self.registers == 0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            return float(self.m * np.log(self.m / zeros))
+        return float(estimate)
+
+
+def weekly_sketches(df, precision = 12):
+    """
+    HLL sketches from the results of device_reach's query (platform_type, platform, week, register, rank rows).
+
+    Returns: dict of (platform_type, platform) -> list of hll, one per week, oldest first
+    """
+    weeks = sorted(df['week'].unique())
+    week_index = {week: i for i, week in enumerate(weeks)}
+    sketches = {}
+    for key, group in df.groupby(['platform_type', 'platform']):
+        registers = np.zeros((len(weeks), 2 ** precision), dtype = np.uint8)
+        registers[group['week'].map(week_index).to_numpy(), group['register'].to_numpy(dtype = int)] = group['rank'].to_numpy(dtype = np.uint8)
+        sketches[key] = [hll(precision, week_registers) for week_registers in registers]
+    return sketches
+
+
+def accrual_curves(sketches):
+    """
+    Cumulative unique reach over the last 1..N weeks, at the levels of cuped's results ('ALL', platform_type,
+    and platforms in PLATFORMS), by merging the weekly sketches.
+
+    Returns: dict of platform -> array of N cumulative reach estimates (1 week, 2 weeks, ...)
+    """
+    levels = {}
+    for (platform_type, platform), weeks in sketches.items():
+        for level in ['ALL', platform_type] + ([platform] if platform in PLATFORMS else []):
+            if level not in levels:
+                levels[level] = [week.copy() for week in weeks]
+            else:
+                for merged, week in zip(levels[level], weeks):
+                    merged.merge(week)
+
+    curves = {}
+    for level, weeks in levels.items():
+        cumulative, reach = None, []
+        # most recent week first: reach over the last w weeks
+        for week in reversed(weeks):
+            cumulative = week.copy() if cumulative is None else cumulative.merge(week)
+            reach.append(cumulative.cardinality())
+        # HLL noise can make a longer horizon look smaller
+        curves[level] = np.maximum.accumulate(np.array(reach))
+    return curves
+
+
+def accrual_weeks_required(sample_required, observations, curve, allocation, observation_weeks = 2):
+    """
+    Weeks until each arm reaches sample_required, on an accrual curve instead of linear growth.
+
+    The curve gives the shape: the metric's observations over observation_weeks are scaled by curve(w) / curve(observation_weeks).
+    Between whole weeks the curve is interpolated linearly; past its last week it keeps growing by its last weekly increment.
+
+    Returns: array of weeks
+    """
+    curve = np.asarray(curve, dtype = float)
+    weeks = np.arange(0, len(curve) + 1, dtype = float)
+    relative_reach = np.concatenate([[0.0], curve / curve[min(observation_weeks, len(curve)) - 1]])
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        needed = np.asarray(sample_required, dtype = float) / (np.asarray(observations, dtype = float) * 0.5 * allocation)
+        within = np.interp(needed, relative_reach, weeks)
+        last_increment = relative_reach[-1] - relative_reach[-2]
+        beyond = weeks[-1] + (needed - relative_reach[-1]) / last_increment
+    return np.where(needed <= relative_reach[-1], within, beyond)
+
+
+class device_reach(object):
+
+    def generate_reach_cte(self, prev_cte_sql, weeks = 8, precision = 12):
+        """
+        Generates the SQL for weekly HLL sketches of active devices per platform: one row per platform, week and
+        non-empty register with its max rank (weekly_sketches reads them).
+
+        Args:
+            prev_cte_sql: string of filtering CTEs (from filter_generator); 'WITH' means no filters, ie. all devices
+                          of device_metric_daily, otherwise the devices of elig_devices
+            weeks: number of complete weeks, up to last week
+            precision: log2 of the number of registers
+
+        Returns: String
+        """
+        if prev_cte_sql == 'WITH':
+            join_str = ''
+        else:
+            join_str = """
+                JOIN (SELECT DISTINCT device_id from elig_devices) as e
+                  ON a.device_id = e.device_id"""
+
+        return prev_cte_sql + """ weekly_devices AS (
+              SELECT DISTINCT
+                  a.device_id,
+                  platform_type,
+                  platform,
+                  DATE_TRUNC('week', ds) AS week,
+                  MD5(a.device_id) AS device_hash
+              FROM tubidw.device_metric_daily AS a{join_str}
+              WHERE DATE_TRUNC('week', ds) >= DATEADD('week', -{weeks}, DATE_TRUNC('week', GETDATE()))
+                AND DATE_TRUNC('week', ds) < DATE_TRUNC('week', GETDATE())
+            )
+
+            , weekly_hashes AS (
+              SELECT platform_type,
+                     platform,
+                     week,
+                     STRTOL(LEFT(device_hash, 8), 16) AS high_bits,
+                     STRTOL(SUBSTRING(device_hash, 9, 8), 16) AS low_bits
+              FROM weekly_devices
+            )
+
+            SELECT platform_type,
+                   platform,
+                   week,
+                   -- register: first {precision} bits of the hash, rank: first 1 bit in the next 32
+                   FLOOR(high_bits / {register_divisor})::int AS register,
+                   MAX(CASE WHEN low_bits = 0 THEN 33 ELSE 32 - FLOOR(LN(low_bits + 0.5) / LN(2)) END)::int AS rank
+            FROM weekly_hashes
+            GROUP BY 1, 2, 3, 4
+            """.format(join_str = join_str, weeks = int(weeks), precision = int(precision),
+                       register_divisor = 2 ** (32 - int(precision)))
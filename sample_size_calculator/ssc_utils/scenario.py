@@ -0,0 +1,69 @@
+from dataclasses import dataclass, field, asdict
+
+from ssc_utils.filter_expression import filter_spec, from_spec, checked_time_interval
+from ssc_utils.metric_switcher import metric_switcher
+import ssc_utils.calculator as c
+
+# Plain, frozen (hashable) scenario specs, decoupled from ipywidgets.
+# Generators, the calculator, the batch runner and caches all take these, so nothing downstream reads live widgets.
+
+
+@dataclass(frozen=True)
+class statistical_parameters(object):
+    """Inputs of calculate_sample_required (defaults are the notebook's slider defaults)"""
+    effect: float = c.effect()
+    treatments: int = c.treatments()
+    allocation: float = c.allocation()
+    power: float = c.power()
+    alpha: float = c.alpha()
+    ratio: float = 1
+
+    @classmethod
+    def from_widgets(cls, effect_size_relative, number_variations, allocation, power, alpha, ratio = 1):
+        return cls(effect = effect_size_relative.result,
+                   treatments = number_variations.result,
+                   allocation = allocation.result,
+                   power = power.result,
+                   alpha = alpha.result,
+                   ratio = ratio)
+
+
+@dataclass(frozen=True)
+class scenario_spec(object):
+    """
+    One sample size scenario: a metric (from metric_switcher().possible_metrics(), a ratio metric or a quantile metric,
+    see metric_switcher.metric_kind), its filters and its statistical parameters.
+    """
+    metric: str
+    filters: filter_spec = field(default_factory = filter_spec)
+    parameters: statistical_parameters = field(default_factory = statistical_parameters)
+    name: str = None
+
+    def __post_init__(self):
+        # raises ValueError for unknown metrics
+        metric_switcher().metric_kind(self.metric)
+
+    @property
+    def metric_name(self):
+        """metric_name of this metric in the query results"""
+        return metric_switcher().metric_name(self.metric)
+
+    def tags(self):
+        """Flat dict of the scenario, for tracing/logging"""
+        tags = {'name': self.name, 'metric': self.metric, 'filters': repr(self.filters.expression), 'time_interval': self.filters.time_interval}
+        tags.update(asdict(self.parameters))
+        return tags
+
+    @classmethod
+    def from_dict(cls, spec, defaults = None):
+        """
+        Builds a scenario from plain (JSON/YAML) data: metric, filters (see filter_expression.from_spec), time_interval,
+        name, and the statistical_parameters fields. Missing parameters are taken from defaults, then from statistical_parameters.
+        """
+        spec = dict(defaults if defaults is not None else {}, **spec)
+        parameter_names = statistical_parameters.__dataclass_fields__.keys()
+        return cls(metric = spec['metric'],
+                   filters = filter_spec(expression = from_spec(spec.get('filters')),
+                                         time_interval = checked_time_interval(spec.get('time_interval'))),
+                   parameters = statistical_parameters(**{key: spec[key] for key in parameter_names if key in spec}),
+                   name = spec.get('name'))
@@ -0,0 +1,198 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+from scipy import stats, optimize
+
+import ssc_utils.calculator as c
+
+# Group-sequential designs: the test is looked at K times (weekly) and stops early when a look crosses its efficacy
+# boundary. Alpha is spent across the looks with a Lan-DeMets spending function:
+#
+#   'obrien_fleming'   alpha(t) = 2 * (1 - Phi(z_{1 - alpha/2} / sqrt(t)))   (almost nothing spent early)
+#   'pocock'           alpha(t) = alpha * log(1 + (e - 1) * t)                   (spent evenly)
+#
+# Two-sided designs are symmetric: each side spends alpha / 2 (the gsDesign convention).
+#
+# With equally spaced looks, the boundaries and the inflation factor (max n / fixed n) only depend on
+# (K, alpha, power, spending function, sidedness), not on the metric, so they are computed once per key (design() is
+# cached) and applied to the fixed sample sizes of a whole table at once.
+#
+# The boundaries come from the usual recursive numerical integration of the score statistic S_k = Z_k * sqrt(t_k)
+# (Armitage, McPherson & Rowe; Jennison & Turnbull ch. 19), on a Simpson grid over the continuation region.
+# The sub-densities are only computed under H0: under a drift theta they are the H0 ones times exp(theta*s - theta^2*t/2),
+# so power (and the drift that reaches the target power) is a cheap weighted sum, vectorized over drifts.
+
+
+SPENDING_FUNCTIONS = ('obrien_fleming', 'pocock')
+GRID_POINTS = 161
+ONE_SIDED_FLOOR = 8.0  # lower edge of the continuation region of one-sided designs, in standard deviations of S_k
+
+
+def spent_alpha(t, alpha, spending):
+    """Cumulative alpha spent at information fractions t"""
+    t = np.asarray(t, dtype = float)
+    if spending == 'obrien_fleming':
+        return 2.0 * stats.norm.sf(stats.norm.isf(alpha / 2.0) / np.sqrt(t))
+    if spending == 'pocock':
+        return alpha * np.log(1.0 + (np.e - 1.0) * t)
+    raise ValueError('unknown spending function ' + str(spending) + ', choose one of ' + str(SPENDING_FUNCTIONS))
+
+
+def simpson_grid(low, high, points = GRID_POINTS):
+    """Returns: tuple (grid points, Simpson weights)"""
+    grid = np.linspace(low, high, points)
+    weights = np.ones(points)
+    weights[1:-1:2] = 4.0
+    weights[2:-1:2] = 2.0
+    return grid, weights * (grid[1] - grid[0]) / 3.0
+
+
+@dataclass(frozen=True)
+class sequential_design(object):
+    """
+    A group-sequential design with equally spaced looks.
+
+    boundaries: efficacy boundaries on the z scale, one per look
+    inflation_factor: max sample size / fixed-design sample size
+    expected_fraction: expected sample size under the alternative / max sample size
+    stopping_probabilities: probability of stopping at each look under the alternative (the last look takes the rest)
+    """
+    looks: int
+    alpha: float
+    power: float
+    spending: str
+    alternative: str
+    boundaries: tuple
+    drift: float
+    inflation_factor: float
+    expected_fraction: float
+    stopping_probabilities: tuple
+
+
+@lru_cache(maxsize = 4096)
+def design(looks, alpha, power, spending = 'obrien_fleming', alternative = 'two-sided'):
+    """
+    Boundaries, inflation factor and expected sample size of a K-look design. Cached: a table only pays for each key once.
+
+    Returns: sequential_design
+    """
+    two_sided = alternative == 'two-sided'
+    t = np.arange(1, looks + 1) / float(looks)
+    sides = 2 if two_sided else 1
+    spend_per_side = np.diff(np.concatenate([[0.0], spent_alpha(t, alpha / sides, spending)]))
+    delta = 1.0 / looks
+
+    # ---------- Boundaries (under H0) ---------- #
+    boundaries = np.empty(looks)
+    boundaries[0] = stats.norm.isf(spend_per_side[0])
+    grids, weighted_densities = [], []
+
+    def continuation_grid(k):
+        upper = boundaries[k] * np.sqrt(t[k])
+        lower = -upper if two_sided else -ONE_SIDED_FLOOR * np.sqrt(t[k])
+        return simpson_grid(lower, upper)
+
+    grid, weights = continuation_grid(0)
+    density = stats.norm.pdf(grid, scale = np.sqrt(t[0]))
+    grids.append(grid)
+    weighted_densities.append(weights * density)
+
+    for k in range(1, looks):
+        previous_grid, previous_density = grids[-1], weighted_densities[-1]
+
+        def crossing_probability(boundary):
+            upper = stats.norm.sf((boundary * np.sqrt(t[k]) - previous_grid) / np.sqrt(delta))
+            if two_sided:
+                upper = upper + stats.norm.cdf((-boundary * np.sqrt(t[k]) - previous_grid) / np.sqrt(delta))
+            return np.dot(previous_density, upper)
+
+        # crossing probability spans many orders of magnitude (O'Brien-Fleming spends ~1e-40 at early looks)
+        boundaries[k] = optimize.brentq(lambda boundary: np.log(max(crossing_probability(boundary), 1e-300)) - np.log(sides * spend_per_side[k]),
+                                        0.0, 40.0, xtol = 1e-10)
+
+        grid, weights = continuation_grid(k)
+        kernel = stats.norm.pdf((grid[:, None] - previous_grid[None, :]) / np.sqrt(delta)) / np.sqrt(delta)
+        grids.append(grid)
+        weighted_densities.append(weights * kernel.dot(previous_density))
+
+    # ---------- Power under drift theta (Z_K ~ N(theta, 1) without stopping) ---------- #
+    def stopping_probabilities(theta):
+        theta = np.atleast_1d(np.asarray(theta, dtype = float))[:, None]
+        probabilities = [stats.norm.sf(boundaries[0] - theta[:, 0] * np.sqrt(t[0]))]
+        for k in range(1, looks):
+            # H0 sub-density of look k - 1 re-weighted to drift theta
+            tilt = np.exp(theta * grids[k - 1][None, :] - theta ** 2 * t[k - 1] / 2.0)
+            upper = stats.norm.sf((boundaries[k] * np.sqrt(t[k]) - grids[k - 1][None, :] - theta * delta) / np.sqrt(delta))
+            probabilities.append(np.sum(weighted_densities[k - 1][None, :] * tilt * upper, axis = 1))
+        return np.array(probabilities)  # looks x thetas
+
+    fixed_drift = stats.norm.isf(alpha / 2.0 if two_sided else alpha) + stats.norm.ppf(power)
+    drift = optimize.brentq(lambda theta: stopping_probabilities(theta).sum() - power,
+                            fixed_drift, fixed_drift * 2.0 + 1.0, xtol = 1e-10)
+
+    stops = stopping_probabilities(drift)[:, 0]
+    # the last look is reached when nothing stopped earlier
+    stops[-1] = 1.0 - stops[:-1].sum()
+    return sequential_design(looks = looks,
+                             alpha = alpha,
+                             power = power,
+                             spending = spending,
+                             alternative = alternative,
+                             boundaries = tuple(float(b) for b in boundaries),
+                             drift = float(drift),
+                             inflation_factor = float((drift / fixed_drift) ** 2),
+                             expected_fraction = float(np.dot(t, stops)),
+                             stopping_probabilities = tuple(float(p) for p in stops))
+
+
+def calculate_sequential_sample_required(df,
+                                         parameters = None,
+                                         spending = 'obrien_fleming',
+                                         looks = None,
+                                         max_looks = 26,
+                                         col_name_p = 'avg_cuped_result',
+                                         std_col_name = 'std_cuped_result',
+                                         grid = None):
+    """
+    Group-sequential version of calculator.calculate_sample_required (same inputs, its columns are kept as the fixed design).
+
+    looks: number of equally spaced looks. None looks once a week: each row gets the smallest K whose max sample size
+           fits in K weeks of traffic (K = max_looks if none does, the looks are then spaced evenly over the run).
+
+    Adds: looks, max_sample_required, expected_sample_required, max_weeks_required, expected_weeks_required,
+          efficacy_boundaries (z scale, one per look)
+
+    Returns: dataframe
+    """
+    if parameters is None:
+        from ssc_utils.scenario import statistical_parameters
+        parameters = statistical_parameters()
+
+    df = c.calculate_sample_required(df, parameters = parameters, col_name_p = col_name_p, std_col_name = std_col_name, grid = grid)
+    corrected_alpha = parameters.alpha / parameters.treatments
+    weekly_sample = (df['observations'] * 0.5 * parameters.allocation).to_numpy(dtype = float)
+    fixed_sample = df['sample_required'].to_numpy(dtype = float)
+
+    candidate_looks = np.arange(1, max_looks + 1) if looks is None else np.array([looks])
+    designs = [design(int(k), corrected_alpha, parameters.power, spending) for k in candidate_looks]
+    inflation = np.array([d.inflation_factor for d in designs])
+
+    if looks is None:
+        # rows x candidate K: does the max sample size fit in K weeks?
+        fits = fixed_sample[:, None] * inflation[None, :] <= candidate_looks[None, :] * weekly_sample[:, None]
+        chosen = np.where(fits.any(axis = 1), fits.argmax(axis = 1), len(candidate_looks) - 1)
+    else:
+        chosen = np.zeros(len(df), dtype = int)
+
+    expected_fraction = np.array([d.expected_fraction for d in designs])
+    max_sample = np.ceil(fixed_sample * inflation[chosen])
+    expected_sample = np.round(max_sample * expected_fraction[chosen])
+
+    df['looks'] = candidate_looks[chosen]
+    df['max_sample_required'] = max_sample.astype('int')
+    df['expected_sample_required'] = expected_sample.astype('int')
+    df['max_weeks_required'] = np.divide(max_sample, weekly_sample)
+    df['expected_weeks_required'] = np.divide(expected_sample, weekly_sample)
+    df['efficacy_boundaries'] = [designs[i].boundaries for i in chosen]
+    return df
@@ -0,0 +1,194 @@
+import argparse
+import dataclasses
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from ssc_utils.scenario import scenario_spec
+from ssc_utils.pipeline import pipeline
+from ssc_utils.executor import local_executor, query_cache, data_week, utc_now
+from ssc_utils.power_grid import power_grid
+import ssc_utils.calculator as c
+
+# Long-running local HTTP service around the pipeline (SQL generation -> executor -> CUPED -> calculate_sample_required).
+#
+#   python -m ssc_utils.service --port 8050 [--local-dsn postgresql://...] [--warm scenarios.yaml]
+#
+#   POST /sample_size   body: one scenario, same format as a batch scenario file entry
+#                       {"metric": "tvt", "filters": {"attribute": ["platform", "=", "'ROKU'"]}, "effect": 0.02}
+#   GET  /metrics       latency percentiles per endpoint, cache hit/miss counters, queries in flight
+#   GET  /health
+#
+# Identical queries that are already running are coalesced into one (see pipeline.run_query), query results are kept
+# in memory and on disk, and finished sample size tables are kept in memory per scenario. All of them are dropped
+# when the week rolls over, since the SQL's windows end at the start of the current week (see executor.data_week).
+
+
+class sample_size_service(object):
+    """
+    Answers sample size requests. Thread safe: the HTTP server calls it from one thread per request.
+
+    clock: returns the current UTC datetime (for tests)
+    """
+
+    def __init__(self, service_pipeline = None, max_tables = 1024, latency_window = 1000, grid = None, clock = None):
+        self.pipeline = service_pipeline if service_pipeline is not None else pipeline()
+        self.grid = grid
+        self.clock = clock if clock is not None else utc_now
+        self.max_tables = max_tables
+        self.table_stats = {'table_hits': 0, 'table_misses': 0}
+        self._tables = OrderedDict()
+        self._tables_week = None
+        self._latencies = {}
+        self._latency_window = latency_window
+        self._lock = threading.Lock()
+
+    def sample_size(self, scenario):
+        """
+        Args:
+            scenario: scenario.scenario_spec
+
+        Returns: dataframe (sample size table, shared between callers, copy before mutating)
+        """
+        # the name doesn't change the answer, the data week does
+        week = data_week(self.clock())
+        key = (week, dataclasses.replace(scenario, name = None))
+        with self._lock:
+            if week != self._tables_week:
+                self._tables.clear()
+                self._tables_week = week
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                self.table_stats['table_hits'] += 1
+                return self._tables[key]
+
+        raw_df = self.pipeline.summary(scenario.filters, [scenario.metric])
+        table = c.calculate_sample_required(df = raw_df[raw_df['metric_name'] == scenario.metric_name],
+                                            parameters = scenario.parameters,
+                                            grid = self.grid)
+
+        with self._lock:
+            self.table_stats['table_misses'] += 1
+            self._tables[key] = table
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last = False)
+        return table
+
+    def warm(self, scenarios):
+        """Runs scenarios ahead of time, so the first requests for them are served from memory"""
+        for scenario in scenarios:
+            self.sample_size(scenario)
+
+    ##### Metrics #####
+
+    def record_latency(self, endpoint, seconds):
+        with self._lock:
+            self._latencies.setdefault(endpoint, deque(maxlen = self._latency_window)).append(seconds)
+
+    def metrics(self):
+        """Returns: dict of latency percentiles (over the last latency_window requests per endpoint) and cache counters"""
+        with self._lock:
+            latencies = {endpoint: np.array(values) for endpoint, values in self._latencies.items()}
+            counters = dict(self.pipeline.stats, **self.table_stats)
+            counters['queries_in_flight'] = len(self.pipeline._in_flight)
+            counters['tables_in_memory'] = len(self._tables)
+            counters['query_results_in_memory'] = len(self.pipeline._results)
+
+        latency_metrics = {}
+        for endpoint, values in latencies.items():
+            latency_metrics[endpoint] = {
+                'count': int(len(values)),
+                'mean_sec': float(values.mean()),
+                'p50_sec': float(np.percentile(values, 50)),
+                'p95_sec': float(np.percentile(values, 95)),
+                'p99_sec': float(np.percentile(values, 99)),
+                'max_sec': float(values.max())
+            }
+        return {'latency': latency_metrics, 'cache': counters}
+
+
+def make_handler(service):
+    """HTTP request handler class bound to a sample_size_service"""
+
+    class handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            elif self.path == '/metrics':
+                self.send_json(200, service.metrics())
+            else:
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+
+        def do_POST(self):
+            if self.path != '/sample_size':
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+                return
+
+            start = time.perf_counter()
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                scenario = scenario_spec.from_dict(json.loads(body))
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': repr(e)})
+                return
+
+            try:
+                table = service.sample_size(scenario)
+                self.send_json(200, {'scenario': scenario.tags(), 'results': json.loads(table.to_json(orient = 'records'))})
+            except Exception as e:
+                self.send_json(500, {'error': repr(e)})
+            finally:
+                service.record_latency(self.path, time.perf_counter() - start)
+
+        def log_message(self, format, *args):
+            # latency is in /metrics; keep the console quiet
+            pass
+
+    return handler
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Serve sample sizes over HTTP.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8050)
+    parser.add_argument('--cache-dir', default = None, help = 'query result cache (default ~/.ssc_utils/query_cache)')
+    parser.add_argument('--local-dsn', default = None, help = 'run on a local Postgres database instead of Redshift')
+    parser.add_argument('--warm', default = None, help = 'scenario file (see batch) to compute at startup')
+    parser.add_argument('--power-grid', default = None, help = 'directory of a precomputed power grid (built there if missing)')
+    args = parser.parse_args(argv)
+
+    executor = None
+    if args.local_dsn is not None:
+        import psycopg2  # only needed for the local backend
+        executor = local_executor(psycopg2.connect(args.local_dsn))
+    cache = query_cache(args.cache_dir) if args.cache_dir is not None else None
+    grid = power_grid.load_or_build(args.power_grid) if args.power_grid is not None else None
+    service = sample_size_service(pipeline(executor = executor, cache = cache), grid = grid)
+
+    if args.warm is not None:
+        from ssc_utils.batch import load_scenarios
+        service.warm(load_scenarios(args.warm))
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print('serving sample sizes on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import ssc_utils.calculator as c
+
+# Monte Carlo power on the empirical device-level distributions.
+#
+# tvt, ad_impressions, visits, ... are heavy-tailed, so the t-test power behind sample_power_ttest can be off at the
+# sample sizes we get. Here each replicate resamples n control and n * ratio treatment devices (with replacement) from the
+# actual cuped_result values of a metric x platform (pipeline.generate_sql(..., device_level = True)), multiplies the
+# treatment values by 1 + effect, and runs the same pooled two-sample t-test.
+#
+# Replicates are batched: a chunk of replicates is one (replicates x n) array operation, with chunks sized so no array
+# holds more than max_elements values. Chunks are independent tasks (optionally in a process pool), each seeded from
+# (seed, row, n, chunk), so results don't depend on the number of processes.
+#
+# Two things keep the cost down:
+#   - the candidate sample sizes are searched from the t-test answer outwards, one round of tasks per step, and a row
+#     stops once two neighbouring candidates bracket the target power (usually 2-3 candidates instead of all of them;
+#     full_curve = True evaluates every candidate)
+#   - above max_resample_n devices per group, the resampled sums are drawn from their normal approximation
+#     (CLT: sum ~ N(n * mean, n * var)) and the sums of squares are set to their expectation. The skewness left in a
+#     sum of n draws is skew / sqrt(n), so at that size the t-test answer is already reliable and resampling every
+#     device would only cost time.
+
+
+_worker_values = {}
+
+
+def _set_worker_values(values):
+    """Process pool initializer: the device-level values are sent to each worker once, not with every task"""
+    global _worker_values
+    _worker_values = values
+
+
+def resampled_moments(rng, values, replicates, n, max_elements, max_resample_n = None):
+    """
+    Sums and sums of squares of n values resampled with replacement, for each replicate.
+    Works in blocks of at most max_elements values; above max_resample_n uses the normal approximation of the sums.
+
+    Returns: tuple of arrays (sums, sums of squares), one value per replicate
+    """
+    if max_resample_n is not None and n > max_resample_n:
+        sums = rng.normal(n * values.mean(), np.sqrt(n * values.var()), size = replicates)
+        return sums, np.full(replicates, n * np.mean(np.square(values)))
+
+    sums = np.zeros(replicates)
+    sums_of_squares = np.zeros(replicates)
+    rows = max(1, min(replicates, max_elements // max(n, 1)))
+    columns = min(n, max_elements)
+    for row in range(0, replicates, rows):
+        row_count = min(rows, replicates - row)
+        for column in range(0, n, columns):
+            block = values[rng.integers(0, len(values), size = (row_count, min(columns, n - column)))]
+            sums[row:row + row_count] += block.sum(axis = 1)
+            sums_of_squares[row:row + row_count] += np.square(block).sum(axis = 1)
+    return sums, sums_of_squares
+
+
+def simulate_rejections(key, nobs1, replicates, effect, alpha, ratio, alternative, seed, max_elements, max_resample_n = None):
+    """
+    One chunk of replicates for one metric x platform and one sample size. Top level so it can run in a process pool.
+
+    key: (group, row index, n index, chunk index); row/n/chunk indexes seed the chunk
+
+    Returns: int, number of replicates where the test rejects
+    """
+    group, row_index, n_index, chunk_index = key
+    values = _worker_values[group]
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (row_index, n_index, chunk_index)))
+    nobs2 = max(int(round(nobs1 * ratio)), 1)
+
+    control_sum, control_squares = resampled_moments(rng, values, replicates, nobs1, max_elements, max_resample_n)
+    treatment_sum, treatment_squares = resampled_moments(rng, values, replicates, nobs2, max_elements, max_resample_n)
+    treatment_sum = treatment_sum * (1 + effect)
+    treatment_squares = treatment_squares * (1 + effect) ** 2
+
+    control_mean, treatment_mean = control_sum / nobs1, treatment_sum / nobs2
+    pooled_variance = ((control_squares - nobs1 * control_mean ** 2) + (treatment_squares - nobs2 * treatment_mean ** 2)) / (nobs1 + nobs2 - 2)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        t = (treatment_mean - control_mean) / np.sqrt(pooled_variance * (1.0 / nobs1 + 1.0 / nobs2))
+
+    dof = nobs1 + nobs2 - 2
+    if alternative == 'two-sided':
+        rejected = np.abs(t) > stats.t.isf(alpha / 2.0, dof)
+    else:
+        rejected = t > stats.t.isf(alpha, dof)
+    return int(np.sum(rejected))
+
+
+def default_sample_sizes(analytic_nobs1, points = 9, low = 0.5, high = 2.0):
+    """Candidate sample sizes around the t-test answer"""
+    return np.unique(np.maximum(np.round(analytic_nobs1 * np.geomspace(low, high, points)), 2).astype('int'))
+
+
+def crossing_sample_size(sample_sizes, powers, target):
+    """
+    Smallest n where the power curve reaches target, interpolated in log(n) between the two candidates around it.
+
+    Returns: float, NaN when no candidate reaches target
+    """
+    reached = np.flatnonzero(powers >= target)
+    if len(reached) == 0:
+        return np.nan
+    upper = reached[0]
+    if upper == 0:
+        return float(sample_sizes[0])
+    lower = upper - 1
+    share = (target - powers[lower]) / (powers[upper] - powers[lower])
+    return float(np.exp(np.log(sample_sizes[lower]) + share * (np.log(sample_sizes[upper]) - np.log(sample_sizes[lower]))))
+
+
+def next_candidate(powers, candidate_count, start, target):
+    """
+    Bracket search over the (sorted) candidates of one row. powers: dict candidate index -> simulated power so far.
+
+    Returns: index of the next candidate to simulate, or None once the target is bracketed (or a grid edge is reached)
+    """
+    if not powers:
+        return start
+    lowest, highest = min(powers), max(powers)
+    if powers[highest] < target:
+        return highest + 1 if highest + 1 < candidate_count else None
+    if powers[lowest] >= target:
+        return lowest - 1 if lowest > 0 else None
+    return None
+
+
+def calculate_simulated_sample_required(df,
+                                        device_df,
+                                        parameters = None,
+                                        sample_sizes = None,
+                                        replicates = 1000,
+                                        processes = 1,
+                                        seed = 0,
+                                        max_elements = 2 ** 24,
+                                        max_resample_n = 20000,
+                                        full_curve = False,
+                                        alternative = 'two-sided',
+                                        value_col = 'cuped_result'):
+    """
+    Simulated power curves and sample sizes for the rows of a cuped summary (df, as from the pipeline),
+    from the device-level values of the same query (device_df, pipeline.generate_sql(..., device_level = True)).
+
+    Args:
+        sample_sizes: candidate n per group for every row; default is default_sample_sizes() around each row's t-test n
+        replicates: simulated experiments per candidate n (the power standard error is at most 0.5 / sqrt(replicates))
+        processes: > 1 runs the chunks in a process pool
+        seed: results are reproducible for a given seed, whatever the number of processes
+        max_resample_n: above this n per group the sums are drawn from their normal approximation (None always resamples)
+        full_curve: simulate every candidate n instead of stopping once the target power is bracketed
+
+    Returns: tuple (df from calculate_sample_required with simulated_sample_required and simulated_weeks_required added,
+                    dataframe of the simulated power curve points: metric_name, platform, nobs1, power, power_se)
+    """
+    if parameters is None:
+        from ssc_utils.scenario import statistical_parameters
+        parameters = statistical_parameters()
+
+    df = c.calculate_sample_required(df, parameters = parameters)
+    corrected_alpha = parameters.alpha / parameters.treatments
+
+    values = {group: group_df[value_col].to_numpy(dtype = float)
+              for group, group_df in device_df.groupby(['metric_name', 'platform'])}
+
+    # rows to simulate: (row index, group, sorted candidates, first candidate of the search)
+    searches = []
+    for row_index, (group, analytic_n) in enumerate(zip(zip(df['metric_name'], df['platform']), df['sample_required'])):
+        if group not in values or len(values[group]) < 2:
+            continue
+        candidates = np.sort(np.asarray(sample_sizes, dtype = int)) if sample_sizes is not None else default_sample_sizes(analytic_n)
+        start = min(int(np.searchsorted(candidates, analytic_n)), len(candidates) - 1)
+        searches.append((row_index, group, candidates, start))
+
+    # one round simulates one candidate n per row (every candidate with full_curve), one task per chunk of replicates
+    chunk_replicates = max(1, min(replicates, 256))
+    powers = [{} for _ in searches]
+    curves = []
+    pool = None
+    if processes > 1:
+        pool = ProcessPoolExecutor(max_workers = processes, initializer = _set_worker_values, initargs = (values,))
+    else:
+        _set_worker_values(values)
+    try:
+        while True:
+            tasks = []
+            for search_index, (row_index, group, candidates, start) in enumerate(searches):
+                if full_curve:
+                    n_indexes = range(len(candidates)) if not powers[search_index] else []
+                else:
+                    n_index = next_candidate(powers[search_index], len(candidates), start, parameters.power)
+                    n_indexes = [] if n_index is None else [n_index]
+                for n_index in n_indexes:
+                    for chunk_index, first in enumerate(range(0, replicates, chunk_replicates)):
+                        tasks.append((search_index, n_index, ((group, row_index, n_index, chunk_index), int(candidates[n_index]),
+                                                              min(chunk_replicates, replicates - first))))
+            if not tasks:
+                break
+
+            task_args = [(key, nobs1, chunk, parameters.effect, corrected_alpha, parameters.ratio, alternative, seed,
+                          max_elements, max_resample_n)
+                         for _, _, (key, nobs1, chunk) in tasks]
+            if pool is not None:
+                rejections = list(pool.map(simulate_rejections, *zip(*task_args)))
+            else:
+                rejections = [simulate_rejections(*args) for args in task_args]
+
+            totals = {}
+            for (search_index, n_index, (_, _, chunk)), rejected in zip(tasks, rejections):
+                rejected_sum, replicate_sum = totals.get((search_index, n_index), (0, 0))
+                totals[(search_index, n_index)] = (rejected_sum + rejected, replicate_sum + chunk)
+            for (search_index, n_index), (rejected, simulated) in totals.items():
+                powers[search_index][n_index] = rejected / float(simulated)
+                _, group, candidates, _ = searches[search_index]
+                curves.append((group, int(candidates[n_index]), rejected, simulated))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    curve_df = pd.DataFrame({'metric_name': [group[0] for group, _, _, _ in curves],
+                             'platform': [group[1] for group, _, _, _ in curves],
+                             'nobs1': [nobs1 for _, nobs1, _, _ in curves]})
+    simulated = np.maximum(np.array([count for _, _, _, count in curves], dtype = float), 1)
+    curve_df['power'] = np.array([rejected for _, _, rejected, _ in curves], dtype = float) / simulated
+    curve_df['power_se'] = np.sqrt(curve_df['power'] * (1 - curve_df['power']) / simulated)
+    curve_df = curve_df.drop_duplicates(['metric_name', 'platform', 'nobs1']).sort_values(['metric_name', 'platform', 'nobs1']).reset_index(drop = True)
+
+    crossings = {group: crossing_sample_size(group_df['nobs1'].to_numpy(), group_df['power'].to_numpy(), parameters.power)
+                 for group, group_df in curve_df.groupby(['metric_name', 'platform'])}
+    df['simulated_sample_required'] = np.ceil([crossings.get(group, np.nan) for group in zip(df['metric_name'], df['platform'])])
+    df['simulated_weeks_required'] = np.divide(df['simulated_sample_required'], (df['observations'] * 0.5 * parameters.allocation))
+    return df, curve_df
@@ -0,0 +1,171 @@
+import pandas as pd
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Per-stage timing and memory instrumentation for the pipeline:
+# SQL generation -> warehouse queue/execution -> result transfer -> to_df() -> calculate_sample_required
+#
+# Usage:
+#   TRACER = tracer(tags = {'metric': 'tvt', 'effect': 0.01})
+#   with TRACER.stage('to_df') as record:
+#       df = result.to_df()
+#       record.observe(df)
+#   TRACER.to_jsonl('traces.jsonl')              # one JSON object per stage, easy to aggregate across runs
+#   TRACER.to_chrome_trace('trace.json')         # open in chrome://tracing or https://ui.perfetto.dev
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far (None where the resource module is unavailable)"""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS, in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class stage_record(dict):
+    """One traced stage. A dict, so it exports as is."""
+
+    def observe(self, df = None, rows = None, bytes = None):
+        """Records the size of a stage's output (a dataframe, or explicit rows/bytes)"""
+        if df is not None:
+            rows = len(df)
+            bytes = int(df.memory_usage(index = True, deep = True).sum())
+        if rows is not None:
+            self['rows'] = int(rows)
+        if bytes is not None:
+            self['bytes'] = int(bytes)
+        return self
+
+
+class tracer(object):
+    """
+    Records wall time, CPU time, rows, bytes and peak RSS per pipeline stage, tagged with the scenario spec.
+
+    Stages can be nested (the parent stage is recorded) and traced from several threads.
+    A disabled tracer (tracer(enabled = False)) keeps the same interface but records nothing.
+    """
+
+    def __init__(self, tags = None, enabled = True):
+        self.tags = dict(tags) if tags is not None else {}
+        self.enabled = enabled
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name, **tags):
+        """
+        Context manager that traces one stage.
+
+        Args:
+            name: stage name (ie. 'generate_sql', 'execute', 'to_df', 'calculate_sample_required')
+            tags: extra tags for this stage only (merged over the tracer's scenario tags)
+
+        Yields: stage_record (call .observe(df) to record rows/bytes)
+        """
+        record = stage_record(name = name)
+        if not self.enabled:
+            yield record
+            return
+
+        stack = self._stack()
+        record['parent'] = stack[-1] if len(stack) > 0 else None
+        record['tags'] = dict(self.tags, **tags)
+        record['pid'] = os.getpid()
+        record['tid'] = threading.get_ident()
+        record['start'] = time.time()
+        rss_before = peak_rss_bytes()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        stack.append(name)
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            stack.pop()
+            cpu_end = time.thread_time()
+            record['wall_sec'] = time.perf_counter() - wall_start
+            record['cpu_sec'] = cpu_end - cpu_start
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            if rss_before is not None:
+                record['peak_rss_growth_bytes'] = record['peak_rss_bytes'] - rss_before
+            with self._lock:
+                self.events.append(record)
+
+    def add(self, name, start, wall_sec, **fields):
+        """
+        Records a stage that was timed elsewhere (ie. warehouse queue/execution times reported by Redshift).
+
+        Args:
+            name: stage name
+            start: epoch seconds when the stage started
+            wall_sec: duration in seconds
+            fields: any other fields to store (rows, bytes, parent, ...)
+        """
+        if not self.enabled:
+            return None
+        stack = self._stack()
+        parent = fields.pop('parent', stack[-1] if len(stack) > 0 else None)
+        record = stage_record(name = name, parent = parent, tags = dict(self.tags),
+                              pid = os.getpid(), tid = threading.get_ident(), start = start, wall_sec = wall_sec, **fields)
+        with self._lock:
+            self.events.append(record)
+        return record
+
+    ##### Export #####
+
+    def to_jsonl(self, path, append = True):
+        """Writes one JSON object per stage (appends by default, so many runs can share one file)"""
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok = True)
+        with open(path, 'a' if append else 'w') as f:
+            for record in self.events:
+                f.write(json.dumps(record, default = str) + '\n')
+
+    def chrome_trace_events(self):
+        """Stages as Chrome trace format complete ('X') events, in microseconds"""
+        events = []
+        for record in self.events:
+            args = {key: value for key, value in record.items() if key not in ('name', 'start', 'wall_sec', 'pid', 'tid', 'tags')}
+            args.update(record.get('tags', {}))
+            events.append({
+                'name': record['name'],
+                'cat': 'ssc',
+                'ph': 'X',
+                'ts': int(record['start'] * 1e6),
+                'dur': int(record['wall_sec'] * 1e6),
+                'pid': record['pid'],
+                'tid': record['tid'],
+                'args': args
+            })
+        return events
+
+    def to_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.chrome_trace_events(), 'displayTimeUnit': 'ms'}, f, default = str)
+
+    def summary(self):
+        """Returns: dataframe with one row per stage (name, wall_sec, cpu_sec, rows, bytes, peak_rss_bytes)"""
+        columns = ['name', 'parent', 'wall_sec', 'cpu_sec', 'rows', 'bytes', 'peak_rss_bytes']
+        return pd.DataFrame([{col: record.get(col) for col in columns} for record in self.events], columns = columns)
+
+
+NO_TRACE = tracer(enabled = False)
@@ -0,0 +1,112 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tubi_data_runtime')
+
+from ssc_utils.batch import load_scenarios, query_groups, run_batch
+from ssc_utils.calculator import calculate_sample_required
+from ssc_utils.executor import query_cache
+from ssc_utils.filter_expression import filter_spec
+from ssc_utils.pipeline import pipeline
+from ssc_utils.quantile_sketch import quantile_sketch
+from ssc_utils.scenario import statistical_parameters
+
+
+SCENARIOS = {
+    'defaults': {'effect': 0.02},
+    'scenarios': [
+        {'name': 'roku_tvt', 'metric': 'tvt', 'filters': {'attribute': ['platform', '=', "'ROKU'"]}},
+        {'name': 'roku_visits', 'metric': 'visits', 'filters': {'attribute': ['platform', '=', "'ROKU'"]}, 'treatments': 2},
+        {'metric': 'tvt'}
+    ]
+}
+
+
+def summary_rows(metric_names):
+    return pd.DataFrame({'metric_name': metric_names, 'platform': 'ALL', 'observations': 1e6,
+                         'avg_cuped_result': 2.0, 'std_cuped_result': 3.0})
+
+
+class fake_executor(object):
+    """Returns canned results: sketch buckets for sketch queries, a cuped summary otherwise"""
+    name = 'fake'
+
+    def __init__(self):
+        self.queries = []
+
+    def run(self, sql, tracer = None):
+        self.queries.append(sql)
+        if 'sketch_values' in sql:
+            sketch = quantile_sketch.from_values(np.random.default_rng(0).exponential(2.0, 10000))
+            keys, counts = sketch.stores[1]
+            return pd.DataFrame({'metric_name': 'tvt', 'platform_type': 'OTT', 'platform': 'ROKU',
+                                 'sign': 1, 'bucket': keys, 'count': counts})
+        return summary_rows(['tvt', 'visit'])
+
+
+@pytest.fixture
+def scenario_file(tmp_path):
+    path = tmp_path / 'scenarios.json'
+    path.write_text(json.dumps(SCENARIOS))
+    return str(path)
+
+
+def test_load_scenarios(scenario_file):
+    scenarios = load_scenarios(scenario_file)
+    assert [s.name for s in scenarios] == ['roku_tvt', 'roku_visits', 'scenario_3']
+    assert scenarios[1].parameters.treatments == 2
+    assert all(s.parameters.effect == 0.02 for s in scenarios)
+    assert len(query_groups(scenarios)) == 2
+
+
+def test_run_batch_one_query_per_filter_set(scenario_file, tmp_path):
+    executor = fake_executor()
+    results, _ = run_batch(load_scenarios(scenario_file), pipeline(executor = executor, cache = query_cache(str(tmp_path / 'cache'))),
+                           query_workers = 1)
+    assert list(results['scenario'].unique()) == ['roku_tvt', 'roku_visits', 'scenario_3']
+    assert len(executor.queries) == 2
+    # treatments = 2 halves alpha, so more samples are needed
+    sample = results.groupby('scenario')['sample_required'].first()
+    assert sample['roku_visits'] > sample['roku_tvt']
+
+
+def test_summary_routes_quantile_metrics(tmp_path):
+    executor = fake_executor()
+    summary = pipeline(executor = executor, cache = query_cache(str(tmp_path / 'cache'))).summary(filter_spec(), ['tvt', 'tvt-p50'])
+    assert set(summary['metric_name']) == {'tvt', 'visit', 'tvt-p50'}
+    assert len(executor.queries) == 2
+    median = summary[(summary['metric_name'] == 'tvt-p50') & (summary['platform'] == 'ALL')]['avg_cuped_result'].iloc[0]
+    assert median == pytest.approx(2.0 * np.log(2), rel = 0.05)
+
+
+class poisson_visits_executor(object):
+    """Sketch buckets of daily visit counts: Poisson on ROKU, always 1 on WEB"""
+    name = 'fake'
+
+    def run(self, sql, tracer = None):
+        frames = []
+        for platform_type, platform, values in (('OTT', 'ROKU', np.random.default_rng(0).poisson(3.0, 20000)),
+                                                ('WEB', 'WEB', np.ones(5000))):
+            sketch = quantile_sketch.from_values(values.astype(float))
+            keys, counts = sketch.stores[1]
+            frames.append(pd.DataFrame({'metric_name': 'visit', 'platform_type': platform_type, 'platform': platform,
+                                        'sign': 1, 'bucket': keys, 'count': counts}))
+            frames.append(pd.DataFrame({'metric_name': 'visit', 'platform_type': platform_type, 'platform': platform,
+                                        'sign': 0, 'bucket': [0], 'count': [sketch.zero_count]}))
+        return pd.concat(frames, ignore_index = True)
+
+
+def test_quantiles_of_counts_have_a_sample_size(tmp_path):
+    query_pipeline = pipeline(executor = poisson_visits_executor(), cache = query_cache(str(tmp_path / 'cache')))
+    with pytest.warns(UserWarning, match = r'visit-p50 \(WEB\)'):
+        summary = query_pipeline.summary(filter_spec(), ['visits-p50'])
+    # every value of WEB is 1, so its quantiles have no density; ALL, OTT and ROKU are Poisson atoms
+    assert sorted(summary['platform']) == ['ALL', 'OTT', 'ROKU']
+    assert summary['std_cuped_result'].notna().all()
+
+    table = calculate_sample_required(summary, parameters = statistical_parameters())
+    assert table['sample_required'].dtype.kind == 'i'
+    assert (table['sample_required'] > 0).all()
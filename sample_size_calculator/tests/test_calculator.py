@@ -0,0 +1,85 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+from statsmodels.stats.power import tt_ind_solve_power
+
+from ssc_utils.calculator import post_stratify, calculate_sample_required
+from ssc_utils.power_grid import power_grid
+
+PARAMETERS = types.SimpleNamespace(effect = 0.05, treatments = 2, allocation = 0.5, power = 0.8, alpha = 0.1, ratio = 1)
+
+
+def cuped_results():
+    """'ALL', platform_type and platform rows of two metrics, as the cuped query returns them"""
+    return pd.DataFrame({'metric_name': ['tvt'] * 4 + ['visit'] * 3,
+                         'platform': ['ALL', 'OTT', 'WEB', 'ROKU', 'ALL', 'OTT', 'WEB'],
+                         'observations': [1000.0, 800.0, 200.0, 500.0, 1000.0, 800.0, 200.0],
+                         'avg_cuped_result': [5.0, 6.0, 1.0, 7.0, 2.0, 2.5, 0.5],
+                         'std_cuped_result': [4.0, 3.0, 1.0, 3.5, 1.5, 1.0, 0.5]})
+
+
+def test_post_stratified_std():
+    df = cuped_results()
+    stratified = post_stratify(df)
+    tvt = stratified[(stratified['metric_name'] == 'tvt') & (stratified['platform'] == 'ALL')].iloc[0]
+    # std = sqrt(sum(w_h sigma_h^2)), ROKU is a platform, not a stratum
+    assert tvt['avg_cuped_result'] == pytest.approx(0.8 * 6.0 + 0.2 * 1.0)
+    assert tvt['std_cuped_result'] == pytest.approx(np.sqrt(0.8 * 9.0 + 0.2 * 1.0))
+    assert tvt['unstratified_std'] == 4.0
+    # only the 'ALL' rows change, and df is left alone
+    pd.testing.assert_frame_equal(stratified.loc[df['platform'] != 'ALL', df.columns], df[df['platform'] != 'ALL'])
+    assert df.loc[0, 'std_cuped_result'] == 4.0
+
+
+def test_post_stratify_planned_weights():
+    stratified = post_stratify(cuped_results(), weights = {'OTT': 1, 'WEB': 3})
+    visit = stratified[(stratified['metric_name'] == 'visit') & (stratified['platform'] == 'ALL')].iloc[0]
+    assert visit['avg_cuped_result'] == pytest.approx(0.25 * 2.5 + 0.75 * 0.5)
+    assert visit['std_cuped_result'] == pytest.approx(np.sqrt(0.25 * 1.0 + 0.75 * 0.25))
+
+
+def test_post_stratify_missing_stratum():
+    df = cuped_results()
+    df = df[~((df['metric_name'] == 'visit') & (df['platform'] == 'WEB'))]
+    with pytest.raises(ValueError, match = "'visit': \\['WEB'\\]"):
+        post_stratify(df, weights = {'OTT': 1, 'WEB': 1})
+    with pytest.raises(ValueError, match = 'WEB'):
+        post_stratify(df, weights = {'OTT': 1, 'MOBILE': 0, 'WEB': 1})
+    # a zero weight doesn't need a row
+    post_stratify(df, weights = {'OTT': 1, 'WEB': 0})
+
+
+def test_post_stratify_without_strata_rows():
+    df = cuped_results()
+    df = df[df['platform'].isin(['ALL', 'ROKU'])]
+    with pytest.raises(ValueError, match = 'visit'):
+        post_stratify(df)
+    with pytest.raises(ValueError, match = 'visit'):
+        calculate_sample_required(df, parameters = PARAMETERS, stratify = True)
+
+
+def test_calculate_sample_required():
+    df = cuped_results()
+    result = calculate_sample_required(df, parameters = PARAMETERS)
+    expected = [tt_ind_solve_power(effect_size = 0.05 * mean / std, alpha = 0.05, power = 0.8, ratio = 1)
+                for mean, std in zip(df['avg_cuped_result'], df['std_cuped_result'])]
+    # alpha / treatments, weeks at observations * 0.5 * allocation per arm
+    np.testing.assert_array_equal(result['sample_required'], np.round(expected))
+    assert result['sample_required'].dtype.kind == 'i'
+    np.testing.assert_allclose(result['weeks_required'], result['sample_required'] / (result['observations'] * 0.25))
+    assert 'sample_required' not in df.columns
+
+
+def test_calculate_sample_required_with_grid_and_strata():
+    df = cuped_results()
+    grid = power_grid.build(alphas = (0.05,), powers = (0.8,), alternatives = ('two-sided',))
+    solved = calculate_sample_required(df, parameters = PARAMETERS)
+    looked_up = calculate_sample_required(df, parameters = PARAMETERS, grid = grid)
+    np.testing.assert_allclose(looked_up['sample_required'], solved['sample_required'], rtol = 1e-3, atol = 1)
+
+    stratified = calculate_sample_required(df, parameters = PARAMETERS, strata_weights = {'OTT': 1})
+    all_rows = (stratified['platform'] == 'ALL').to_numpy()
+    ott_rows = (stratified['platform'] == 'OTT').to_numpy()
+    np.testing.assert_array_equal(stratified.loc[all_rows, 'sample_required'], stratified.loc[ott_rows, 'sample_required'])
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssc_utils.cupac import normal_equations, pool, solve, adjusted_summary, accumulate_device_store
+from ssc_utils.device_store import device_store
+
+KEYS = [('tvt', 'OTT', 'ROKU'), ('tvt', 'OTT', 'AMAZON'), ('tvt', 'WEB', 'WEB')]
+
+
+def rows(n = 3000, seed = 0):
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([rng.gamma(2.0, 1.0, n), rng.random(n) < 0.2, rng.normal(size = n)])
+    codes = rng.integers(0, len(KEYS), n)
+    y = 1.0 + X.dot([0.8, -0.5, 0.3]) + codes + rng.normal(size = n)
+    return codes, X.astype(float), y
+
+
+def reference_sums(codes, X, y):
+    """The per-row np.add.at accumulation update() replaced"""
+    groups = len(KEYS)
+    sums = {'n': np.zeros(groups), 'sum_y': np.zeros(groups), 'yy': np.zeros(groups), 'sum_x': np.zeros((groups, 3)),
+            'xy': np.zeros((groups, 3)), 'xx': np.zeros((groups, 3, 3))}
+    np.add.at(sums['n'], codes, 1)
+    np.add.at(sums['sum_y'], codes, y)
+    np.add.at(sums['yy'], codes, y * y)
+    np.add.at(sums['sum_x'], codes, X)
+    np.add.at(sums['xy'], codes, X * y[:, None])
+    np.add.at(sums['xx'], codes, X[:, :, None] * X[:, None, :])
+    return sums
+
+
+def assert_same_sums(accumulators, sums):
+    order = [accumulators.keys.index(key) for key in KEYS]
+    for name, expected in sums.items():
+        np.testing.assert_allclose(getattr(accumulators, name)[order], expected, rtol = 1e-10)
+
+
+def test_update_matches_per_row_accumulation():
+    codes, X, y = rows()
+    sums = reference_sums(codes, X, y)
+
+    by_codes = normal_equations(3)
+    by_codes.update(KEYS, X, y, codes = codes)
+    assert_same_sums(by_codes, sums)
+
+    by_keys = normal_equations(3)
+    by_keys.update([KEYS[code] for code in codes], X, y)
+    assert_same_sums(by_keys, sums)
+
+    single = normal_equations(3)
+    single.update(KEYS[0], X[codes == 0], y[codes == 0])
+    np.testing.assert_allclose(single.xx[0], sums['xx'][0], rtol = 1e-10)
+
+
+def test_merged_chunks_match_one_pass():
+    codes, X, y = rows()
+    one_pass = normal_equations(3)
+    one_pass.update(KEYS, X, y, codes = codes)
+
+    merged = normal_equations(3)
+    for start in range(0, len(y), 700):
+        chunk = normal_equations(3)
+        chunk.update(KEYS, X[start:start + 700], y[start:start + 700], codes = codes[start:start + 700])
+        merged.merge(chunk)
+    assert_same_sums(merged, reference_sums(codes, X, y))
+    for name in ('n', 'xx', 'xy'):
+        np.testing.assert_allclose(getattr(merged, name), getattr(one_pass, name), rtol = 1e-10)
+
+
+def test_solve_matches_least_squares():
+    codes, X, y = rows()
+    accumulators = normal_equations(3)
+    accumulators.update(KEYS, X, y, codes = codes)
+    theta, mean, std = solve(accumulators.centered())
+    for group, key in enumerate(accumulators.keys):
+        rows_g = codes == KEYS.index(key)
+        X_g = np.column_stack([np.ones(rows_g.sum()), X[rows_g]])
+        coefficients, _, _, _ = np.linalg.lstsq(X_g, y[rows_g], rcond = None)
+        np.testing.assert_allclose(theta[group], coefficients[1:], rtol = 1e-6)
+        residual = y[rows_g] - X_g.dot(coefficients)
+        assert std[group] == pytest.approx(np.sqrt(np.sum(residual ** 2) / (rows_g.sum() - 1)), rel = 1e-6)
+        assert mean[group] == pytest.approx(y[rows_g].mean())
+
+
+def test_pooling_is_a_fixed_effects_fit():
+    codes, X, y = rows()
+    accumulators = normal_equations(3)
+    accumulators.update(KEYS, X, y, codes = codes)
+    keys, pooled = pool(accumulators.centered(), lambda key: (key[0], 'ALL'), accumulators.keys)
+    theta, mean, _ = solve(pooled)
+    # one slope, one intercept per platform
+    design = np.column_stack([np.eye(len(KEYS))[codes], X])
+    coefficients, _, _, _ = np.linalg.lstsq(design, y, rcond = None)
+    assert keys == [('tvt', 'ALL')]
+    np.testing.assert_allclose(theta[0], coefficients[len(KEYS):], rtol = 1e-6)
+    assert mean[0] == pytest.approx(y.mean())
+
+
+def test_from_moments_round_trip():
+    codes, X, y = rows()
+    accumulators = normal_equations(3)
+    accumulators.update(KEYS, X, y, codes = codes)
+    moments = pd.DataFrame({'metric_name': [key[0] for key in accumulators.keys],
+                            'platform_type': [key[1] for key in accumulators.keys],
+                            'platform': [key[2] for key in accumulators.keys],
+                            'n': accumulators.n, 'sum_y': accumulators.sum_y, 'sum_yy': accumulators.yy})
+    for i in range(3):
+        moments['sum_x' + str(i)] = accumulators.sum_x[:, i]
+        moments['sum_x' + str(i) + '_y'] = accumulators.xy[:, i]
+        for j in range(i, 3):
+            moments['sum_x' + str(i) + '_x' + str(j)] = accumulators.xx[:, i, j]
+    restored = normal_equations.from_moments(moments, ['metric_name', 'platform_type', 'platform'], 3)
+    pd.testing.assert_frame_equal(adjusted_summary(restored), adjusted_summary(accumulators))
+
+
+def test_accumulate_device_store(tmp_path):
+    rng = np.random.default_rng(3)
+    n = 4000
+    covariate = rng.gamma(2.0, 1.0, n)
+    covariate[rng.random(n) < 0.15] = np.nan
+    df = pd.DataFrame({'device_id': [str(i) for i in range(n)],
+                       'metric_name': rng.choice(['tvt', 'visits'], n),
+                       'platform_type': rng.choice(['OTT', 'WEB'], n),
+                       'platform': rng.choice(['ROKU', 'WEB'], n),
+                       'metric_result': rng.gamma(2.0, 1.0, n) + np.nan_to_num(covariate),
+                       'metric_covariate': covariate})
+    store = device_store.write(df, str(tmp_path))
+    accumulators = accumulate_device_store(store, chunk_rows = 500)
+
+    stored = store.to_frame()
+    for (metric_name, platform_type, platform), group in stored.groupby(['metric_name', 'platform_type', 'platform'], observed = True):
+        index = accumulators.keys.index((metric_name, platform_type, platform))
+        covariate = group['metric_covariate'].to_numpy(dtype = float)
+        X = np.column_stack([np.nan_to_num(covariate), np.isnan(covariate)])
+        y = group['metric_result'].to_numpy(dtype = float)
+        assert accumulators.n[index] == len(group)
+        np.testing.assert_allclose(accumulators.xx[index], X.T.dot(X), rtol = 1e-9)
+        np.testing.assert_allclose(accumulators.xy[index], X.T.dot(y), rtol = 1e-9)
+    assert accumulators.n.sum() == n
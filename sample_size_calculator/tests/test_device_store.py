@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssc_utils.device_store import device_store, device_store_writer, device_keys
+
+
+def device_rows(rows = 2000, seed = 0):
+    """Unordered rows, as generate_device_metrics_sql returns them"""
+    rng = np.random.default_rng(seed)
+    covariate = rng.gamma(2.0, 1.0, rows)
+    covariate[rng.random(rows) < 0.1] = np.nan
+    return pd.DataFrame({'device_id': ['device-' + str(i) for i in range(rows)],
+                         'metric_name': rng.choice(['visits', 'tvt'], rows),
+                         'platform_type': rng.choice(['OTT', 'WEB'], rows),
+                         'platform': rng.choice(['ROKU', 'WEB', 'FIRETV'], rows),
+                         'metric_result': rng.gamma(2.0, 1.0, rows) + np.nan_to_num(covariate),
+                         'metric_covariate': covariate})
+
+
+def test_device_keys_are_stable():
+    keys = device_keys(['a', 'b', 'a'])
+    assert keys.dtype == np.uint64
+    assert keys[0] == keys[2] != keys[1]
+
+
+def test_row_groups_from_unordered_rows(tmp_path):
+    df = device_rows()
+    store = device_store.write(df, str(tmp_path))
+    assert store.rows == len(df)
+    assert store.metrics() == ['tvt', 'visits']
+    assert store.platforms('tvt') == ['FIRETV', 'ROKU', 'WEB']
+
+    for metric in ('tvt', 'visits'):
+        expected = df[df['metric_name'] == metric]
+        assert len(store.slice(metric)['metric_result']) == len(expected)
+        assert len(store.slice(metric, 'ALL')['metric_result']) == len(expected)
+        for platform in ('ROKU', 'WEB', 'FIRETV'):
+            columns = store.slice(metric, platform)
+            rows = expected[expected['platform'] == platform]
+            assert isinstance(columns['metric_result'], np.memmap)
+            np.testing.assert_allclose(np.sort(columns['metric_result']), np.sort(rows['metric_result'].to_numpy(dtype = np.float32)))
+            assert set(columns['device_key']) == set(device_keys(rows['device_id']))
+        web = store.platform_type_slice(metric, 'WEB')
+        assert len(web['metric_result']) == (expected['platform_type'] == 'WEB').sum()
+
+    assert len(store.slice('tvt', 'ANDROID')['metric_result']) == 0
+    assert len(store.platform_type_slice('tvt', 'UNKNOWN')['metric_result']) == 0
+
+
+def test_chunked_writer_and_reopen(tmp_path):
+    df = device_rows()
+    writer = device_store_writer(str(tmp_path / 'chunked'))
+    for start in range(0, len(df), 300):
+        writer.append(df.iloc[start:start + 300])
+    chunked = writer.close()
+    single = device_store.write(df, str(tmp_path / 'single'))
+    reopened = device_store(str(tmp_path / 'chunked'))
+
+    assert reopened.row_groups == single.row_groups
+    assert reopened.nbytes() == 22 * len(df)
+    for col in ('metric_result', 'device_key', 'metric_name'):
+        np.testing.assert_array_equal(np.asarray(reopened.columns[col]), np.asarray(single.columns[col]))
+    frame = chunked.to_frame('visits', 'ROKU')
+    assert set(frame['platform']) == {'ROKU'} and set(frame['metric_name']) == {'visits'}
+
+
+def test_cuped_result_matches_the_sql_formula(tmp_path):
+    df = device_rows()
+    store = device_store.write(df, str(tmp_path))
+    rows = df[(df['metric_name'] == 'tvt') & (df['platform'] == 'ROKU')]
+    result = rows['metric_result'].to_numpy(dtype = np.float32).astype(float)
+    covariate = rows['metric_covariate'].to_numpy(dtype = np.float32).astype(float)
+    known = ~np.isnan(covariate)
+    # cuped.py: theta = COVAR(result, covariate) / VAR(covariate), with AVG/STDDEV skipping NULL covariates
+    theta = (np.sum((covariate[known] - covariate[known].mean()) * (result[known] - result.mean()))
+             / (covariate[known].var(ddof = 1) * len(result)))
+    expected = np.where(known, result - (covariate - covariate[known].mean()) * theta, result)
+
+    # rows come back in store order: compare per device
+    columns = store.slice('tvt', 'ROKU')
+    by_key = dict(zip(device_keys(rows['device_id']), expected))
+    np.testing.assert_allclose(store.cuped_result('tvt', 'ROKU'), [by_key[key] for key in columns['device_key']])
+    assert np.mean(store.cuped_result('tvt', 'ROKU')) == pytest.approx(np.mean(result), rel = 1e-6)
@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip('tubi_data_runtime')
+
+from ssc_utils.filter_expression import (filter_expression, column_statistics, from_spec, predicate,
+                                         and_, or_, not_, attribute, metric, event, pre_event)
+
+
+@pytest.fixture
+def compiler():
+    return filter_expression(statistics = column_statistics(use_warehouse_stats = False))
+
+
+def test_normalize_flattens_and_dedupes(compiler):
+    a, b, c = attribute('platform', '=', "'ROKU'"), attribute('country', '=', "'US'"), attribute('app_mode', '=', "'kids'")
+    assert compiler.normalize(and_(a, and_(b, a), c)) == and_(a, b, c)
+    assert compiler.normalize(or_(a)) == a
+
+
+def test_normalize_cancels_double_negation(compiler):
+    a = attribute('platform', '=', "'ROKU'")
+    assert compiler.normalize(not_(not_(a))) == a
+
+
+def test_and_orders_most_selective_first(compiler):
+    ordered = compiler.order_by_selectivity(and_(attribute('tvt_sec', '>=', '3600'), attribute('platform', '=', "'ROKU'")), 'all_metric_hourly')
+    assert ordered.children[0].condition == '='
+
+
+def test_split_by_filter_type(compiler):
+    parts = compiler.split_by_filter_type(compiler.normalize(and_(attribute('platform', '=', "'ROKU'"),
+                                                                  metric('tvt_sec', '>=', '3600'),
+                                                                  metric('visit_total_count', '>=', '3'))))
+    assert set(parts) == {'attribute', 'metric'}
+    assert isinstance(parts['metric'], and_)
+
+
+def test_or_across_filter_types_is_rejected(compiler):
+    with pytest.raises(ValueError):
+        compiler.compile(or_(attribute('platform', '=', "'ROKU'"), metric('tvt_sec', '>=', '3600')))
+
+
+def test_unknown_filter_type_is_rejected(compiler):
+    with pytest.raises(ValueError):
+        compiler.normalize(predicate('device', 'platform', '=', "'ROKU'"))
+
+
+def test_empty_groups_are_rejected():
+    with pytest.raises(ValueError):
+        or_()
+    with pytest.raises(ValueError):
+        from_spec({'and': [{'attribute': ['platform', '=', "'ROKU'"]}, {'or': []}]})
+
+
+def test_pre_event_needs_event(compiler):
+    with pytest.raises(ValueError):
+        compiler.compile(pre_event('event_name', 'IN', "('PageLoad')"))
+
+
+def test_compile_renders_metric_aliases(compiler):
+    compiled = compiler.compile(and_(metric('tvt_sec', '>=', '3600'), event('event_name', 'IN', "('StartVideo')")))
+    assert compiled['metric_fields'] == ['tvt_sec']
+    assert compiled['metric_filter_having'].startswith('AND MAX(')
+    assert compiled['primary_event_condition'] == "event_name IN ('StartVideo')"
+
+
+def test_from_spec():
+    spec = {'and': [{'attribute': ['platform', 'IN', "('ROKU','AMAZON')"]},
+                    {'not': {'attribute': {'field': 'app_mode', 'condition': '=', 'value': "'kids'"}}}]}
+    assert from_spec(spec) == and_(attribute('platform', 'IN', "('ROKU','AMAZON')"), not_(attribute('app_mode', '=', "'kids'")))
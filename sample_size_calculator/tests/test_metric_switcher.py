@@ -0,0 +1,78 @@
+import pytest
+
+from ssc_utils.metric_switcher import metric_switcher, metric_definition
+from ssc_utils.raw_user_data import raw_user_data, DAILY_COLUMNS
+
+
+@pytest.fixture
+def switcher():
+    return metric_switcher()
+
+
+def test_metric_kinds(switcher):
+    assert switcher.metric_kind('tvt') == 'metric'
+    assert switcher.metric_kind('tvt-per_visit') == 'ratio'
+    assert switcher.metric_kind('conversion-5min-per_visit') == 'ratio'
+    assert switcher.metric_kind('visits-p90') == 'quantile'
+    for metric in ('tvt-p0', 'tvt-p100', 'nope-p50', 'tvt-pxx', 'nope'):
+        with pytest.raises(ValueError):
+            switcher.metric_kind(metric)
+
+
+def test_metric_names(switcher):
+    assert switcher.metric_name('visits') == 'visit'
+    assert switcher.metric_name('tvt-capped_new_visitors') == 'tvt-capped-new_visitors'
+    assert switcher.metric_name('tvt-per_visit') == 'tvt-per_visit'
+    assert switcher.metric_name('visits-p50') == 'visit-p50'
+    assert switcher.metric_name('tvt-p99.5') == 'tvt-p99.5'
+    assert switcher.quantile_metric('tvt-p29') == ('tvt', 0.29)
+
+
+def test_registry_definitions(switcher):
+    for metric in switcher.possible_metrics():
+        definition = switcher.definition(metric)
+        assert definition.metric_name == switcher.metric_name(metric)
+        assert "'" + definition.metric_name + "'::text AS metric_name" in switcher.generate_user_data_cte(metric)
+    with pytest.raises(ValueError):
+        metric_definition('bad', 'MEDIAN', '1.0')
+    with pytest.raises(ValueError):
+        metric_definition('bad', 'SUM', 'watch_sec', ('watch_sec',))
+    with pytest.raises(ValueError):
+        switcher.definition('nope')
+
+
+def test_required_columns(switcher):
+    assert switcher.required_columns(['visits']) == ('visit_total_count',)
+    assert switcher.required_columns(['visits', 'tvt', 'tvt-capped']) == ('tvt_sec', 'linear_tvt_sec', 'visit_total_count')
+    assert switcher.required_columns(['ad_impressions']) == ()
+    assert switcher.required_columns(['tvt-vod_movie', 'registration-did_signup']) == ('user_signup_count', 'movie_tvt_sec')
+
+
+def test_raw_user_data_only_sums_required_columns(switcher):
+    sql = raw_user_data().generate_raw_user_data_cte('WITH', columns = switcher.required_columns(['visits']))
+    assert 'sum(visit_total_count) AS visit_total_count' in sql
+    for column in DAILY_COLUMNS:
+        if column != 'visit_total_count':
+            assert column not in sql
+    everything = raw_user_data().generate_raw_user_data_cte('WITH')
+    assert all('sum(' + column + ')' in everything for column in DAILY_COLUMNS)
+    with pytest.raises(ValueError):
+        raw_user_data().generate_raw_user_data_cte('WITH', columns = ('watch_sec',))
+
+
+def test_sources_are_joined_only_when_read(switcher):
+    assert 'revenue_bydevice_daily' in switcher.generate_user_data_cte('ad_impressions')
+    assert 'revenue_bydevice_daily' not in switcher.generate_user_data_cte('tvt')
+    assert 'revenue_bydevice_daily' not in switcher.generate_multi_metric_user_data_cte(['tvt', 'visits'])
+    stacked = switcher.generate_multi_metric_user_data_cte(['ad_impressions', 'tvt', 'ad_impressions'])
+    assert stacked.count('revenue_bydevice_daily') == 1
+    assert stacked.count('UNION ALL') == 1
+    assert 'FROM device_data_impressions' in stacked
+
+
+def test_caps(switcher):
+    assert 'THEN 4.0 ELSE' in switcher.generate_user_data_cte('tvt-capped')
+    capped = metric_switcher(caps = {'tvt-capped': 6.5})
+    assert 'THEN 6.5 ELSE' in capped.generate_user_data_cte('tvt-capped')
+    assert 'THEN 4.0 ELSE' in capped.generate_user_data_cte('tvt-capped_new_visitors')
+    assert set(metric_switcher.capped_metrics) == set(metric_switcher.default_caps)
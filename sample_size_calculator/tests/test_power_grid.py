@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from statsmodels.stats.power import tt_ind_solve_power
+
+from ssc_utils.power_grid import power_grid, solve_nobs1, ttest_ind_power, bonferroni_alphas
+
+
+@pytest.fixture(scope = 'module')
+def grid():
+    return power_grid.build(alphas = (0.05, 0.025), powers = (0.8, 0.9), ratios = (1.0, 2.0))
+
+
+def test_bonferroni_alphas():
+    alphas = bonferroni_alphas()
+    assert 0.05 in alphas and 0.05 / 8 in alphas
+    assert alphas == sorted(alphas)
+
+
+@pytest.mark.parametrize('alternative', ['two-sided', 'larger'])
+@pytest.mark.parametrize('ratio', [1.0, 2.0])
+def test_solve_nobs1_matches_statsmodels(alternative, ratio):
+    for effect_size in (0.005, 0.05, 0.3):
+        expected = tt_ind_solve_power(effect_size = effect_size, alpha = 0.05, power = 0.8, ratio = ratio, alternative = alternative)
+        nobs1 = float(solve_nobs1(np.array(effect_size), 0.05, 0.8, ratio, alternative))
+        assert nobs1 == pytest.approx(expected, rel = 1e-6)
+        assert float(ttest_ind_power(effect_size, nobs1, 0.05, ratio, alternative)) == pytest.approx(0.8, abs = 1e-6)
+
+
+def test_lookup_matches_statsmodels(grid):
+    assert grid.axes['max_rel_error'] < 1e-3  # README: within ~0.1%
+    effect_sizes = np.geomspace(2e-4, 0.9, 25)
+    for alternative in ('two-sided', 'larger'):
+        for ratio in (1.0, 2.0):
+            nobs1 = grid.lookup(effect_sizes, 0.025, 0.9, ratio = ratio, alternative = alternative)
+            expected = [tt_ind_solve_power(effect_size = d, alpha = 0.025, power = 0.9, ratio = ratio, alternative = alternative)
+                        for d in effect_sizes]
+            np.testing.assert_allclose(nobs1, expected, rtol = 1.4e-4)
+
+
+def test_lookup_off_grid(grid):
+    assert grid.lookup([0.1], 0.01, 0.8) is None
+    assert grid.lookup([0.1], 0.05, 0.85) is None
+    assert grid.lookup([0.1], 0.05, 0.8, ratio = 3.0) is None
+    assert grid.lookup([0.1], 0.05, 0.8, alternative = 'smaller') is None
+    assert np.isnan(grid.lookup([2.0], 0.05, 0.8)[0])
+
+
+def test_lookup_negative_effect_size(grid):
+    np.testing.assert_allclose(grid.lookup([-0.1], 0.05, 0.8), grid.lookup([0.1], 0.05, 0.8))
+
+
+def test_save_and_load(grid, tmp_path):
+    grid.save(str(tmp_path))
+    loaded = power_grid.load(str(tmp_path))
+    assert isinstance(loaded.table, np.memmap)
+    assert loaded.axes == grid.axes
+    np.testing.assert_allclose(loaded.lookup([0.01, 0.1], 0.05, 0.8), grid.lookup([0.01, 0.1], 0.05, 0.8))
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssc_utils.quantile_sketch import (quantile_sketch, sketches_from_frame, merge_sketches, rollup, winsorization_caps,
+                                       quantile_metric_summary, metric_sketch)
+from ssc_utils.metric_switcher import metric_switcher
+
+
+def bucket_frame(values_by_key, relative_accuracy = 0.01):
+    """The rows metric_sketch's query returns, computed locally"""
+    log_gamma = np.log((1.0 + relative_accuracy) / (1.0 - relative_accuracy))
+    frames = []
+    for (metric_name, platform_type, platform), values in values_by_key.items():
+        signs = np.sign(values).astype(int)
+        with np.errstate(divide = 'ignore'):
+            buckets = np.where(values == 0, 0, np.ceil(np.log(np.abs(values)) / log_gamma)).astype(int)
+        frame = pd.DataFrame({'sign': signs, 'bucket': buckets}).value_counts().rename('count').reset_index()
+        frames.append(frame.assign(metric_name = metric_name, platform_type = platform_type, platform = platform))
+    return pd.concat(frames, ignore_index = True)
+
+
+def daily_tvt(seed = 0):
+    rng = np.random.default_rng(seed)
+    return {('tvt', 'OTT', 'ROKU'): rng.lognormal(0.0, 1.0, 20000),
+            ('tvt', 'OTT', 'AMAZON'): rng.lognormal(0.3, 1.0, 10000),
+            ('tvt', 'WEB', 'WEB'): np.concatenate([np.zeros(2000), rng.lognormal(-0.5, 1.0, 8000)])}
+
+
+@pytest.mark.parametrize('q', [0.01, 0.25, 0.5, 0.9, 0.995])
+def test_quantiles_within_relative_accuracy(q):
+    values = np.random.default_rng(1).lognormal(0.0, 2.0, 50000)
+    sketch = quantile_sketch.from_values(values)
+    exact = np.sort(values)[int(np.floor(q * (len(values) - 1)))]
+    assert abs(sketch.quantile(q) / exact - 1) <= 0.01 + 1e-12
+
+
+def test_negative_and_zero_values():
+    values = np.concatenate([-np.arange(1.0, 101.0), np.zeros(50), np.arange(1.0, 101.0), [np.nan]])
+    sketch = quantile_sketch.from_values(values)
+    assert sketch.count == 250
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(0.0) == pytest.approx(-100, rel = 0.01)
+    assert sketch.quantile(1.0) == pytest.approx(100, rel = 0.01)
+    assert np.isnan(quantile_sketch().quantile(0.5))
+
+
+def test_merge_matches_one_sketch():
+    values = np.random.default_rng(2).lognormal(0.0, 1.0, 30000)
+    merged = quantile_sketch.from_values(values[:10000]).merge(quantile_sketch.from_values(values[10000:]))
+    whole = quantile_sketch.from_values(values)
+    np.testing.assert_allclose(merged.quantile([0.1, 0.5, 0.99]), whole.quantile([0.1, 0.5, 0.99]))
+    with pytest.raises(ValueError):
+        merged.merge(quantile_sketch(relative_accuracy = 0.02))
+
+
+def test_max_buckets_collapse_the_lowest_values():
+    values = np.geomspace(1e-6, 1e6, 100000)
+    sketch = quantile_sketch.from_values(values, max_buckets = 256)
+    assert len(sketch.stores[1][0]) == 256
+    assert sketch.quantile(0.99) == pytest.approx(np.quantile(values, 0.99), rel = 0.01)
+
+
+def test_sketches_from_frame_match_local_sketches():
+    values = daily_tvt()
+    sketches = sketches_from_frame(bucket_frame(values))
+    assert sketches[('tvt', 'WEB', 'WEB')].zero_count == 2000
+    for key, key_values in values.items():
+        np.testing.assert_allclose(sketches[key].quantile([0.5, 0.9]), quantile_sketch.from_values(key_values).quantile([0.5, 0.9]))
+
+    halves = [sketches_from_frame(bucket_frame({key: key_values[i::2] for key, key_values in values.items()})) for i in (0, 1)]
+    merged = merge_sketches(*halves)
+    assert merged[('tvt', 'OTT', 'ROKU')].quantile(0.5) == sketches[('tvt', 'OTT', 'ROKU')].quantile(0.5)
+
+    levels = rollup(sketches)
+    assert set(levels) == {('tvt', 'ALL'), ('tvt', 'OTT'), ('tvt', 'WEB'), ('tvt', 'ROKU'), ('tvt', 'AMAZON')}
+    assert levels[('tvt', 'ALL')].count == 40000
+
+
+def test_winsorization_caps_are_keyed_by_capped_metric():
+    values = daily_tvt()
+    caps = winsorization_caps(sketches_from_frame(bucket_frame(values)), 0.995)
+    assert set(caps) == set(metric_switcher.capped_metrics)
+    exact = np.quantile(np.concatenate(list(values.values())), 0.995)
+    assert caps['tvt-capped'] == pytest.approx(exact, rel = 0.02)
+
+    # the cap shows up in the generated CASE instead of the default 4 hours
+    sql = metric_switcher(caps = caps).generate_user_data_cte('tvt-capped')
+    assert 'THEN ' + str(float(caps['tvt-capped'])) + ' ELSE' in sql
+    assert 'THEN 4.0 ELSE' not in sql
+    assert str(float(caps['tvt-capped_new_visitors'])) in metric_switcher(caps = caps).generate_user_data_cte('tvt-capped_new_visitors')
+    assert winsorization_caps(sketches_from_frame(bucket_frame({('visit', 'OTT', 'ROKU'): np.ones(10)}))) == {}
+
+
+def test_quantile_metric_summary():
+    # wide enough that q +- bandwidth spans many 2% buckets (the density comes from quantile differences)
+    values = {('tvt', 'OTT', 'ROKU'): np.random.default_rng(3).lognormal(0.0, 2.0, 50000)}
+    summary = quantile_metric_summary(sketches_from_frame(bucket_frame(values)), quantiles = (0.5,), bandwidth = 0.05)
+    row = summary[(summary['metric_name'] == 'tvt-p50') & (summary['platform'] == 'ALL')].iloc[0]
+    assert row['avg_cuped_result'] == pytest.approx(1.0, rel = 0.03)
+    # sqrt(q (1 - q)) / f(median), lognormal density at the median: 1 / (sigma sqrt(2 pi))
+    assert row['std_cuped_result'] == pytest.approx(0.5 * 2.0 * np.sqrt(2 * np.pi), rel = 0.1)
+    assert row['observations'] == 50000
+
+    # 70% zeros: the band is doubled from 0.5 +- 0.01 until it reaches the ones (0.5 +- 0.32), represented as 0.99
+    atom = quantile_metric_summary({('visit', 'WEB', 'WEB'): quantile_sketch.from_values(np.repeat([0.0, 1.0], [70, 30]))},
+                                   quantiles = (0.5,))
+    assert atom['avg_cuped_result'].iloc[0] == 0.0
+    assert atom['std_cuped_result'].iloc[0] == pytest.approx(0.5 / (0.64 / 0.99))
+    single = quantile_metric_summary({('tvt', 'WEB', 'WEB'): quantile_sketch.from_values(np.zeros(100))}, quantiles = (0.5,))
+    assert single['std_cuped_result'].isna().all()
+
+
+def test_sketch_sql_sources():
+    assert 'FROM user_data' in metric_sketch().generate_sketch_cte(source = 'user_data')
+    assert 'metric_result::float' in metric_sketch().generate_sketch_cte(source = 'metrics')
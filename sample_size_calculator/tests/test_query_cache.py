@@ -0,0 +1,63 @@
+import datetime
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('tubi_data_runtime')
+
+from ssc_utils.executor import query_cache, data_week
+
+UTC = datetime.timezone.utc
+SQL = "SELECT 1 FROM tubidw.device_metric_daily WHERE ds < DATE_TRUNC('week', GETDATE())"
+
+
+class frozen_clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_data_week():
+    # 2026-10-19 is a Monday
+    assert data_week(datetime.datetime(2026, 10, 19, 0, 0, tzinfo = UTC)) == '2026-10-19'
+    assert data_week(datetime.datetime(2026, 10, 25, 23, 59, tzinfo = UTC)) == '2026-10-19'
+    assert data_week(datetime.datetime(2026, 10, 26, 0, 1, tzinfo = UTC)) == '2026-10-26'
+
+
+def test_results_expire_at_the_week_rollover(tmp_path):
+    clock = frozen_clock(datetime.datetime(2026, 10, 21, 12, 0, tzinfo = UTC))
+    cache = query_cache(str(tmp_path), clock = clock)
+    cache.put(SQL, pd.DataFrame({'x': [1]}))
+    assert cache.has(SQL)
+    assert cache.has('  ' + SQL.replace(' ', '\n  '))  # whitespace only changes still hit
+
+    clock.now = datetime.datetime(2026, 10, 25, 23, 59, tzinfo = UTC)
+    assert cache.get(SQL)['x'].tolist() == [1]
+    clock.now = datetime.datetime(2026, 10, 26, 0, 0, tzinfo = UTC)
+    assert not cache.has(SQL)
+    assert cache.get(SQL) is None
+
+
+def test_concurrent_puts_of_one_key(tmp_path):
+    cache = query_cache(str(tmp_path))
+    errors = []
+
+    def put(i):
+        try:
+            for _ in range(20):
+                cache.put(SQL, pd.DataFrame({'x': [i] * 1000}))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target = put, args = (i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(set(cache.get(SQL)['x'])) == 1
+    assert os.listdir(str(tmp_path)) == [os.path.basename(cache.path(SQL))]
@@ -0,0 +1,74 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssc_utils.calculator import delta_method_summary
+from ssc_utils.ratio_summary import ratio_summary, MOMENTS, moment_name
+
+NO_EVENTS = types.SimpleNamespace(has_primary_event = False)
+
+
+def devices(n, seed = 0):
+    """Correlated numerator/denominator (tvt per visit like) and their pre-period covariates"""
+    rng = np.random.default_rng(seed)
+    activity = rng.gamma(2.0, 1.0, n)
+    x = rng.poisson(1.0 + 3.0 * activity) + 1.0
+    y = x * rng.gamma(4.0, 0.25, n) * (1.0 + 0.3 * activity)
+    x0 = rng.poisson(1.0 + 3.0 * activity) + 1.0
+    y0 = x0 * rng.gamma(4.0, 0.25, n) * (1.0 + 0.3 * activity)
+    return {'y': y, 'x': x, 'y0': y0, 'x0': x0}
+
+
+def moments_frame(values, metric_name = 'tvt-per_visit', platform = 'ALL'):
+    """The moments ratio_summary's query returns, computed locally"""
+    row = {'metric_name': metric_name, 'platform': platform, 'devices': len(values['y']), 'observations': float(len(values['y']))}
+    for moment in MOMENTS:
+        row[moment_name(moment)] = float(np.prod([values[var] for var in moment], axis = 0).sum())
+    return pd.DataFrame([row])
+
+
+def test_moments_sql():
+    sql = ratio_summary().generate_ratio_moments_cte(['tvt-per_visit'], filters = NO_EVENTS)
+    for moment in MOMENTS:
+        assert moment_name(moment) in sql
+    assert "'tvt-per_visit'::text AS metric_name" in sql
+
+
+def test_delta_method_matches_the_linearization():
+    values = devices(5000)
+    summary = delta_method_summary(moments_frame(values)).iloc[0]
+
+    ratio = values['y'].sum() / values['x'].sum()
+    linearized = (values['y'] - ratio * values['x']) / values['x'].mean()
+    assert summary['avg_cuped_result'] == pytest.approx(ratio)
+    assert summary['std_result'] == pytest.approx(linearized.std(ddof = 1), rel = 1e-6)
+
+    # CUPED: residual of L after regressing on the covariates' linearization
+    ratio_0 = values['y0'].sum() / values['x0'].sum()
+    linearized_0 = (values['y0'] - ratio_0 * values['x0']) / values['x0'].mean()
+    correlation = np.corrcoef(linearized, linearized_0)[0, 1]
+    assert summary['std_cuped_result'] == pytest.approx(linearized.std(ddof = 1) * np.sqrt(1 - correlation ** 2), rel = 1e-6)
+    assert summary['std_cuped_result'] < summary['std_result']
+
+
+def test_delta_method_matches_the_sampling_distribution():
+    # std_result / sqrt(n) is the standard error of sum(y) / sum(x) over repeated samples of n devices
+    population = devices(200000, seed = 1)
+    rng = np.random.default_rng(2)
+    n = 400
+    samples = rng.integers(0, 200000, size = (2000, n))
+    ratios = population['y'][samples].sum(axis = 1) / population['x'][samples].sum(axis = 1)
+    summary = delta_method_summary(moments_frame(population)).iloc[0]
+    assert summary['std_result'] / np.sqrt(n) == pytest.approx(ratios.std(), rel = 0.08)
+
+
+def test_no_usable_covariate():
+    values = devices(1000)
+    values['y0'] = np.zeros(1000)
+    values['x0'] = np.zeros(1000)
+    summary = delta_method_summary(moments_frame(values)).iloc[0]
+    assert summary['std_cuped_result'] == pytest.approx(summary['std_result'])
+    uncuped = delta_method_summary(moments_frame(devices(1000)), use_cuped = False).iloc[0]
+    assert uncuped['std_cuped_result'] == pytest.approx(uncuped['std_result'])
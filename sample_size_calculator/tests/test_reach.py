@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssc_utils.reach import hll, weekly_sketches, accrual_curves, accrual_weeks_required, device_reach
+
+
+def device_ids(start, stop):
+    return ['device-' + str(i) for i in range(start, stop)]
+
+
+@pytest.mark.parametrize('count', [100, 3000, 50000])
+def test_cardinality(count):
+    # relative standard error 1.04 / sqrt(4096) ~ 1.6%
+    assert hll().add(device_ids(0, count)).cardinality() == pytest.approx(count, rel = 0.05)
+
+
+def test_merge_is_the_union():
+    a = hll().add(device_ids(0, 20000))
+    b = hll().add(device_ids(10000, 30000))
+    union = hll().add(device_ids(0, 30000))
+    merged = a.copy().merge(b)
+    np.testing.assert_array_equal(merged.registers, union.registers)
+    assert merged.cardinality() == pytest.approx(30000, rel = 0.05)
+    assert a.cardinality() == pytest.approx(20000, rel = 0.05)
+    with pytest.raises(ValueError):
+        a.merge(hll(precision = 10))
+
+
+def test_sql_rank_matches_local_rank():
+    # device_reach: CASE WHEN low_bits = 0 THEN 33 ELSE 32 - FLOOR(LN(low_bits + 0.5) / LN(2)) END
+    low_bits = np.concatenate([[0, 1, 2, 3, 2 ** 31, 2 ** 32 - 1],
+                               [2 ** k for k in range(32)], [2 ** k - 1 for k in range(2, 33)],
+                               np.random.default_rng(0).integers(1, 2 ** 32, 1000)]).astype(np.int64)
+    sql_rank = np.where(low_bits == 0, 33, 32 - np.floor(np.log(low_bits + 0.5) / np.log(2))).astype(int)
+    local_rank = [33 - int(value).bit_length() for value in low_bits]
+    np.testing.assert_array_equal(sql_rank, local_rank)
+    assert 'FLOOR(high_bits / 1048576)' in device_reach().generate_reach_cte('WITH', precision = 12)
+
+
+def reach_frame(weeks):
+    """device_reach's query rows, from local sketches: {(platform_type, platform): [device ids of each week]}"""
+    rows = []
+    for (platform_type, platform), weekly_ids in weeks.items():
+        for week, ids in enumerate(weekly_ids):
+            registers = hll().add(ids).registers
+            for register in np.flatnonzero(registers):
+                rows.append((platform_type, platform, '2026-09-0' + str(week + 1), register, registers[register]))
+    return pd.DataFrame(rows, columns = ['platform_type', 'platform', 'week', 'register', 'rank'])
+
+
+def test_accrual_curves():
+    # returning devices: every week has 6000 devices of a pool that grows by 2000 a week
+    weeks = {('OTT', 'ROKU'): [device_ids(2000 * week, 2000 * week + 6000) for week in range(4)],
+             ('WEB', 'WEB'): [device_ids(10 ** 6 + 1000 * week, 10 ** 6 + 1000 * week + 1000) for week in range(4)]}
+    sketches = weekly_sketches(reach_frame(weeks))
+    assert len(sketches[('OTT', 'ROKU')]) == 4
+
+    curves = accrual_curves(sketches)
+    assert set(curves) == {'ALL', 'OTT', 'WEB', 'ROKU'}
+    for curve in curves.values():
+        assert np.all(np.diff(curve) >= 0)
+    np.testing.assert_allclose(curves['ROKU'], [6000, 8000, 10000, 12000], rtol = 0.05)
+    np.testing.assert_allclose(curves['WEB'], [1000, 2000, 3000, 4000], rtol = 0.05)
+    np.testing.assert_allclose(curves['ALL'], curves['ROKU'] + curves['WEB'], rtol = 0.05)
+
+
+def test_accrual_weeks_required_on_a_linear_curve():
+    # observations cover observation_weeks, so a linear curve needs observation_weeks * sample / weekly arm size
+    curve = 1000.0 * np.arange(1, 5)
+    sample_required = np.array([100.0, 500.0, 1000.0, 3000.0])
+    needed = sample_required / (2000 * 0.5 * 0.5)
+    weeks = accrual_weeks_required(sample_required, 2000, curve, allocation = 0.5)
+    np.testing.assert_allclose(weeks, 2 * needed)  # the last one is past the curve: extrapolated linearly
+
+
+def test_accrual_weeks_required_on_a_saturating_curve():
+    # relative to the 2 observed weeks: 0.75 after 1 week, 1.25 after 3, 1.5 after 4
+    curve = np.array([6000.0, 8000.0, 10000.0, 12000.0])
+    weeks = accrual_weeks_required([1000.0, 2000.0, 3000.0], 8000, curve, allocation = 0.5)
+    linear = accrual_weeks_required([1000.0, 2000.0, 3000.0], 8000, 4000.0 * np.arange(1, 5), allocation = 0.5)
+    np.testing.assert_allclose(weeks, [0.5 / 0.75, 2.0, 4.0])
+    np.testing.assert_allclose(linear, [1.0, 2.0, 3.0])
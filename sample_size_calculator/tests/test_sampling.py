@@ -0,0 +1,48 @@
+import types
+
+import pytest
+
+from ssc_utils.raw_user_data import raw_user_data, device_sample_filter
+from ssc_utils.cuped import cuped
+
+NO_EVENTS = types.SimpleNamespace(has_primary_event = False)
+EVENTS = types.SimpleNamespace(has_primary_event = True)
+
+
+def test_device_sample_filter():
+    assert device_sample_filter(100) == ''
+    assert device_sample_filter(10, 'a.device_id') == 'AND MOD(STRTOL(LEFT(MD5(a.device_id), 8), 16), 10000) < 1000'
+    assert device_sample_filter(0.5).endswith('< 50')
+
+
+@pytest.mark.parametrize('sample_pct', [0, -5, 150])
+def test_invalid_sample_pct(sample_pct):
+    with pytest.raises(ValueError):
+        raw_user_data().generate_raw_user_data_cte('WITH', sample_pct = sample_pct)
+    with pytest.raises(ValueError):
+        cuped().sample_multiplier(sample_pct = sample_pct, filters = NO_EVENTS)
+
+
+def test_sample_multiplier():
+    assert cuped().sample_multiplier(sample_pct = 100, filters = NO_EVENTS) == 1.0
+    assert cuped().sample_multiplier(sample_pct = 10, filters = NO_EVENTS) == 10.0
+    assert cuped().sample_multiplier(sample_pct = 50, filters = EVENTS) == 2000.0
+
+
+def test_raw_user_data_is_sampled():
+    sql = raw_user_data().generate_raw_user_data_cte('WITH', sample_pct = 10)
+    assert 'MD5(a.device_id), 8), 16), 10000) < 1000' in sql
+
+
+def test_filter_scans_are_sampled():
+    pytest.importorskip('tubi_data_runtime')
+    from ssc_utils.filter_generator import filter_generator
+
+    common = dict(metric_fields = [], metric_filter_having = '', pre_event_condition = 'TRUE', time_interval = 'NULL', sample_pct = 10)
+    attribute_sql = filter_generator().assemble_filter_cte(attr_filter = "AND country = 'US'", primary_event_condition = None, **common)
+    assert 'MD5(device_id), 8), 16), 10000) < 1000' in attribute_sql
+    event_sql = filter_generator().assemble_filter_cte(attr_filter = '', primary_event_condition = "event_name IN ('StartVideoEvent')", **common)
+    assert 'MD5(a.device_id), 8), 16), 10000) < 1000' in event_sql
+    unsampled = filter_generator().assemble_filter_cte(attr_filter = "AND country = 'US'", primary_event_condition = None,
+                                                       **dict(common, sample_pct = 100))
+    assert 'MD5' not in unsampled
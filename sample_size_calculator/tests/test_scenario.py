@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip('tubi_data_runtime')
+
+from ssc_utils.scenario import scenario_spec, statistical_parameters
+from ssc_utils.filter_expression import attribute
+
+
+def test_from_dict_fills_defaults():
+    scenario = scenario_spec.from_dict({'metric': 'tvt', 'filters': {'attribute': ['platform', '=', "'ROKU'"]}, 'effect': 0.02},
+                                       defaults = {'effect': 0.05, 'power': 0.9})
+    assert scenario.parameters == statistical_parameters(effect = 0.02, power = 0.9)
+    assert scenario.filters.expression == attribute('platform', '=', "'ROKU'")
+    assert scenario.filters.time_interval == 'NULL'
+
+
+def test_scenarios_are_hashable():
+    spec = {'metric': 'visits', 'filters': {'attribute': ['country', '=', "'US'"]}}
+    assert hash(scenario_spec.from_dict(spec)) == hash(scenario_spec.from_dict(spec))
+    assert scenario_spec.from_dict(spec).metric_name == 'visit'
+
+
+@pytest.mark.parametrize('metric', ['tvt-per_visit', 'tvt-p50'])
+def test_ratio_and_quantile_metrics(metric):
+    assert scenario_spec(metric = metric).metric_name == metric
+
+
+def test_unknown_metric():
+    with pytest.raises(ValueError):
+        scenario_spec(metric = 'tvt_typo')
+
+
+@pytest.mark.parametrize('time_interval, expected', [(None, 'NULL'), ('NULL', 'NULL'), ('', 'NULL'), (3600, '3600'), (' 60 ', '60')])
+def test_time_interval(time_interval, expected):
+    assert scenario_spec.from_dict({'metric': 'tvt', 'time_interval': time_interval}).filters.time_interval == expected
+
+
+@pytest.mark.parametrize('time_interval', [-1, 1.5, True, '1e3', '60 OR 1=1', "0) > 0 OR (SELECT 1 FROM pg_user) IS NOT NULL --"])
+def test_invalid_time_interval(time_interval):
+    with pytest.raises(ValueError, match = 'time_interval'):
+        scenario_spec.from_dict({'metric': 'tvt', 'time_interval': time_interval})
@@ -0,0 +1,61 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssc_utils.sequential import spent_alpha, design, calculate_sequential_sample_required
+
+PARAMETERS = types.SimpleNamespace(effect = 0.01, treatments = 1, allocation = 0.5, power = 0.8, alpha = 0.05, ratio = 1)
+
+
+def test_spent_alpha():
+    for spending in ('obrien_fleming', 'pocock'):
+        assert float(spent_alpha(1.0, 0.05, spending)) == pytest.approx(0.05)
+        spent = spent_alpha(np.linspace(0.1, 1.0, 10), 0.05, spending)
+        assert np.all(np.diff(spent) > 0)
+    with pytest.raises(ValueError):
+        spent_alpha(1.0, 0.05, 'haybittle')
+
+
+def test_obrien_fleming_matches_gsdesign():
+    # gsDesign(k = 5, test.type = 2, alpha = 0.025, beta = 0.2, sfu = sfLDOF)$upper$bound
+    d = design(5, 0.05, 0.8)
+    np.testing.assert_allclose(d.boundaries, [4.877, 3.357, 2.680, 2.290, 2.031], atol = 1e-3)
+    assert 1.0 < d.inflation_factor < 1.05
+    assert 0.0 < d.expected_fraction < 1.0
+    assert sum(d.stopping_probabilities) == pytest.approx(1.0)
+
+
+def test_pocock_boundaries_are_flat():
+    boundaries = np.array(design(5, 0.05, 0.8, 'pocock').boundaries)
+    assert np.all(np.diff(boundaries) <= 0)
+    assert boundaries[0] - boundaries[-1] < 0.1
+    assert design(5, 0.05, 0.8, 'pocock').inflation_factor > design(5, 0.05, 0.8).inflation_factor
+
+
+def test_single_look_is_the_fixed_design():
+    d = design(1, 0.05, 0.8)
+    assert d.boundaries[0] == pytest.approx(1.959964, abs = 1e-6)
+    assert d.inflation_factor == pytest.approx(1.0, abs = 1e-6)
+    assert design(1, 0.05, 0.8, alternative = 'larger').boundaries[0] == pytest.approx(1.644854, abs = 1e-6)
+
+
+def test_calculate_sequential_sample_required():
+    df = pd.DataFrame({'platform': ['ALL', 'OTT'],
+                       'avg_cuped_result': [2.0, 3.0],
+                       'std_cuped_result': [4.0, 5.0],
+                       'observations': [100000000, 5000]})
+    result = calculate_sequential_sample_required(df, parameters = PARAMETERS)
+    for column in ('sample_required', 'looks', 'max_sample_required', 'expected_sample_required',
+                   'max_weeks_required', 'expected_weeks_required', 'efficacy_boundaries'):
+        assert column in result.columns
+    assert list(result['looks']) == [1, 26]  # the large row fits in one week, the small one never does
+    assert result['max_sample_required'].iloc[0] == result['sample_required'].iloc[0]
+    assert (result['max_sample_required'] >= result['sample_required']).all()
+    assert (result['expected_sample_required'] <= result['max_sample_required']).all()
+    assert len(result['efficacy_boundaries'].iloc[1]) == 26
+
+    fixed = calculate_sequential_sample_required(df, parameters = PARAMETERS, looks = 5)
+    assert list(fixed['looks']) == [5, 5]
+    np.testing.assert_allclose(fixed['efficacy_boundaries'].iloc[0], design(5, 0.05, 0.8).boundaries)
@@ -0,0 +1,177 @@
+import datetime
+import json
+import sqlite3
+import threading
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen, Request
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('tubi_data_runtime')
+
+from ssc_utils.filter_expression import checked_predicate, from_spec
+from ssc_utils.executor import local_executor, query_cache
+from ssc_utils.pipeline import pipeline
+from ssc_utils.scenario import scenario_spec
+from ssc_utils.service import sample_size_service, make_handler
+
+
+@pytest.mark.parametrize('field, condition, value, rendered', [
+    ('platform', '=', "'ROKU'", "'ROKU'"),
+    ('platform', 'in', ['ROKU', "it's"], "('ROKU','it''s')"),
+    ('tvt_sec', '>=', 3600, '3600'),
+    ('device_first_seen_ts', 'BETWEEN', "'2021-01-01' AND '2021-02-01'", "'2021-01-01' AND '2021-02-01'"),
+    ('user_id', 'IS NOT', 'NULL', 'NULL'),
+])
+def test_checked_predicate_accepts_literals(field, condition, value, rendered):
+    assert checked_predicate('attribute', field, condition, value).value == rendered
+
+
+@pytest.mark.parametrize('field, condition, value', [
+    ('platform; DROP TABLE x', '=', "'ROKU'"),
+    ('platform', '= 1 OR', "'ROKU'"),
+    ('platform', '=', "'ROKU' OR 1=1"),
+    ('platform', '=', "'a\\'' OR 1=1 --'"),
+    ('platform', '=', 'ROKU'),
+    ('platform', 'IN', "('ROKU') UNION SELECT 1"),
+    ('platform', 'IS', 'NULL; SELECT 1'),
+])
+def test_checked_predicate_rejects_sql(field, condition, value):
+    with pytest.raises(ValueError):
+        checked_predicate('attribute', field, condition, value)
+
+
+def test_event_fields():
+    assert from_spec({'event': ['event_name', 'IN', ['StartVideoEvent']]}).value == "('StartVideoEvent')"
+    with pytest.raises(ValueError):
+        from_spec({'event': ['platform', '=', "'ROKU'"]})
+
+
+class fake_pipeline(object):
+    stats = {}
+    _in_flight = {}
+    _results = {}
+
+    def summary(self, filters, metrics):
+        return pd.DataFrame({'metric_name': ['tvt'], 'platform': ['ALL'], 'observations': [1e6],
+                             'avg_cuped_result': [2.0], 'std_cuped_result': [3.0]})
+
+
+class counting_pipeline(fake_pipeline):
+    def __init__(self):
+        self.calls = 0
+
+    def summary(self, filters, metrics):
+        self.calls += 1
+        return super().summary(filters, metrics)
+
+
+class frozen_clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(sample_size_service(fake_pipeline())))
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, payload):
+    request = Request(url + '/sample_size', data = json.dumps(payload).encode('utf-8'), method = 'POST')
+    try:
+        with urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_service_rejects_injection(server):
+    status, _ = post(server, {'metric': 'tvt', 'filters': {'attribute': ['platform', '=', "'ROKU'"]}})
+    assert status == 200
+    status, body = post(server, {'metric': 'tvt', 'filters': {'attribute': ['platform', '=', "'ROKU' OR 1=1"]}})
+    assert status == 400
+    assert 'invalid value' in body['error']
+
+
+def test_service_rejects_time_interval_injection(server):
+    status, _ = post(server, {'metric': 'tvt', 'time_interval': 3600})
+    assert status == 200
+    status, body = post(server, {'metric': 'tvt', 'time_interval': "0) > 0 OR (SELECT 1 FROM pg_user) IS NOT NULL --"})
+    assert status == 400
+    assert 'invalid time_interval' in body['error']
+
+
+class recording_connection(object):
+    """sqlite3 connection that counts rollbacks"""
+
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:', check_same_thread = False)
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.connection.rollback()
+
+
+def test_local_executor_rolls_back_failed_queries():
+    connection = recording_connection()
+    executor = local_executor(connection)
+    with pytest.raises(sqlite3.OperationalError):
+        executor.run('SELECT * FROM missing_table')
+    assert connection.rollbacks == 1
+    assert executor.run('SELECT 1 AS one')['one'].tolist() == [1]
+
+
+def test_local_executor_is_serialized():
+    executor = local_executor(recording_connection())
+    results = []
+    threads = [threading.Thread(target = lambda i = i: results.append(executor.run('SELECT {} AS i'.format(i))['i'].iloc[0]))
+               for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == list(range(20))
+
+
+def test_tables_expire_at_the_week_rollover():
+    clock = frozen_clock(datetime.datetime(2026, 10, 25, 23, 59, tzinfo = datetime.timezone.utc))
+    service_pipeline = counting_pipeline()
+    service = sample_size_service(service_pipeline, clock = clock)
+    service.sample_size(scenario_spec(metric = 'tvt', name = 'a'))
+    service.sample_size(scenario_spec(metric = 'tvt', name = 'b'))
+    assert service_pipeline.calls == 1
+    assert service.table_stats == {'table_hits': 1, 'table_misses': 1}
+
+    clock.now = datetime.datetime(2026, 10, 26, 0, 0, tzinfo = datetime.timezone.utc)
+    service.sample_size(scenario_spec(metric = 'tvt'))
+    assert service_pipeline.calls == 2
+    assert len(service._tables) == 1
+
+
+def test_query_results_expire_at_the_week_rollover(tmp_path):
+    clock = frozen_clock(datetime.datetime(2026, 10, 21, 12, 0, tzinfo = datetime.timezone.utc))
+    executor = local_executor(recording_connection())
+    query_pipeline = pipeline(executor = executor, cache = query_cache(str(tmp_path), clock = clock))
+    query_pipeline.run_query('SELECT 1 AS one')
+    query_pipeline.run_query('SELECT 1 AS one')
+    assert query_pipeline.stats['misses'] == 1
+    assert query_pipeline.stats['memory_hits'] == 1
+
+    clock.now = datetime.datetime(2026, 10, 26, 0, 0, tzinfo = datetime.timezone.utc)
+    assert query_pipeline.run_query('SELECT 1 AS one')['one'].tolist() == [1]
+    assert query_pipeline.stats['misses'] == 2
+    assert len(query_pipeline._results) == 1
@@ -0,0 +1,75 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ssc_utils.simulation import (calculate_simulated_sample_required, crossing_sample_size, next_candidate,
+                                  resampled_moments)
+
+PARAMETERS = types.SimpleNamespace(effect = 0.05, treatments = 1, allocation = 0.5, power = 0.8, alpha = 0.05, ratio = 1)
+
+
+@pytest.fixture(scope = 'module')
+def frames():
+    rng = np.random.default_rng(1)
+    values = {('tvt', 'ALL'): rng.lognormal(0.0, 1.0, 20000), ('tvt', 'OTT'): rng.normal(10.0, 4.0, 20000)}
+    device_df = pd.concat([pd.DataFrame({'metric_name': metric, 'platform': platform, 'cuped_result': group_values})
+                           for (metric, platform), group_values in values.items()])
+    df = pd.DataFrame({'metric_name': ['tvt', 'tvt'],
+                       'platform': ['ALL', 'OTT'],
+                       'avg_cuped_result': [group_values.mean() for group_values in values.values()],
+                       'std_cuped_result': [group_values.std() for group_values in values.values()],
+                       'observations': [100000, 100000]})
+    return df, device_df
+
+
+def test_crossing_sample_size():
+    sample_sizes = np.array([100, 200, 400])
+    assert crossing_sample_size(sample_sizes, np.array([0.5, 0.7, 0.9]), 0.8) == pytest.approx(np.sqrt(200 * 400))
+    assert crossing_sample_size(sample_sizes, np.array([0.85, 0.9, 0.95]), 0.8) == 100
+    assert np.isnan(crossing_sample_size(sample_sizes, np.array([0.1, 0.2, 0.3]), 0.8))
+
+
+def test_next_candidate():
+    assert next_candidate({}, 9, 4, 0.8) == 4
+    assert next_candidate({4: 0.7}, 9, 4, 0.8) == 5
+    assert next_candidate({4: 0.7, 5: 0.85}, 9, 4, 0.8) is None
+    assert next_candidate({4: 0.9}, 9, 4, 0.8) == 3
+    assert next_candidate({0: 0.9, 1: 0.95}, 9, 1, 0.8) is None
+    assert next_candidate({8: 0.5}, 9, 8, 0.8) is None
+
+
+def test_normal_approximation_moments():
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(0.0, 1.0, 5000)
+    sums, squares = resampled_moments(rng, values, 4000, 50000, 2 ** 20, max_resample_n = 10000)
+    assert sums.mean() == pytest.approx(50000 * values.mean(), rel = 1e-3)
+    assert sums.std() == pytest.approx(np.sqrt(50000 * values.var()), rel = 0.05)
+    np.testing.assert_allclose(squares, 50000 * np.mean(values ** 2))
+
+
+def test_bracket_search_matches_full_curve(frames):
+    df, device_df = frames
+    full, full_curves = calculate_simulated_sample_required(df, device_df, parameters = PARAMETERS, replicates = 200,
+                                                            max_resample_n = None, full_curve = True)
+    searched, curves = calculate_simulated_sample_required(df, device_df, parameters = PARAMETERS, replicates = 200,
+                                                           max_resample_n = None)
+    assert len(full_curves) == 18
+    assert len(curves) < len(full_curves)
+    # the same seeds per (row, candidate), so the searched points are points of the full curve
+    merged = curves.merge(full_curves, on = ['metric_name', 'platform', 'nobs1'], suffixes = ('', '_full'))
+    assert len(merged) == len(curves)
+    np.testing.assert_allclose(merged['power'], merged['power_full'])
+    np.testing.assert_allclose(searched['simulated_sample_required'], full['simulated_sample_required'])
+
+
+def test_simulated_sample_size_is_close_to_the_t_test(frames):
+    df, device_df = frames
+    for max_resample_n in (None, 100):
+        result, _ = calculate_simulated_sample_required(df, device_df, parameters = PARAMETERS, replicates = 400,
+                                                        max_resample_n = max_resample_n)
+        # normal values: the t-test is right, up to the Monte Carlo error of 400 replicates
+        ott = result[result['platform'] == 'OTT'].iloc[0]
+        assert ott['simulated_sample_required'] == pytest.approx(ott['sample_required'], rel = 0.2)
+        assert (result['simulated_weeks_required'] > 0).all()
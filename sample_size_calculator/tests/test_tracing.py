@@ -0,0 +1,106 @@
+import json
+import types
+
+import pandas as pd
+import pytest
+
+from ssc_utils import tracing
+from ssc_utils.tracing import tracer, stage_record, peak_rss_bytes
+
+
+def traced_run():
+    TRACER = tracer(tags = {'metric': 'tvt', 'effect': 0.01})
+    with TRACER.stage('summary'):
+        with TRACER.stage('execute', query = 'cuped') as record:
+            record.observe(pd.DataFrame({'x': range(10)}))
+        with TRACER.stage('to_df') as record:
+            record.observe(rows = 3, bytes = 120)
+    TRACER.add('queue', start = 1.5, wall_sec = 0.25, rows = 7)
+    return TRACER
+
+
+def test_stages_nest_and_record_their_parent():
+    events = {record['name']: record for record in traced_run().events}
+    assert events['summary']['parent'] is None
+    assert events['execute']['parent'] == 'summary'
+    assert events['to_df']['parent'] == 'summary'
+    assert events['queue']['parent'] is None
+    # stage tags are merged over the scenario tags
+    assert events['execute']['tags'] == {'metric': 'tvt', 'effect': 0.01, 'query': 'cuped'}
+    assert events['summary']['wall_sec'] >= events['execute']['wall_sec'] + events['to_df']['wall_sec']
+
+    TRACER = tracer()
+    with pytest.raises(KeyError):
+        with TRACER.stage('execute'):
+            raise KeyError('tvt')
+    assert TRACER.events[0]['error'] == repr(KeyError('tvt'))
+    assert TRACER._stack() == []
+
+
+def test_observe():
+    df = pd.DataFrame({'x': range(10), 'y': ['a'] * 10})
+    record = stage_record(name = 'to_df').observe(df)
+    assert record['rows'] == 10
+    assert record['bytes'] == df.memory_usage(index = True, deep = True).sum()
+    assert stage_record(name = 'execute').observe(rows = 5) == {'name': 'execute', 'rows': 5}
+
+
+def test_disabled_tracer_records_nothing():
+    TRACER = tracer(enabled = False)
+    with TRACER.stage('execute') as record:
+        record.observe(rows = 5)
+    assert TRACER.add('queue', start = 0.0, wall_sec = 1.0) is None
+    assert TRACER.events == []
+    assert TRACER.summary().empty
+
+
+def test_to_jsonl_appends(tmp_path):
+    TRACER = traced_run()
+    path = str(tmp_path / 'traces' / 'traces.jsonl')
+    TRACER.to_jsonl(path)
+    TRACER.to_jsonl(path)
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2 * len(TRACER.events)
+    assert [line['name'] for line in lines[:4]] == ['execute', 'to_df', 'summary', 'queue']
+    assert lines[0]['rows'] == 10
+
+    TRACER.to_jsonl(path, append = False)
+    with open(path) as f:
+        assert len(f.readlines()) == len(TRACER.events)
+
+
+def test_to_chrome_trace(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    traced_run().to_chrome_trace(path)
+    with open(path) as f:
+        trace = json.load(f)
+    assert trace['displayTimeUnit'] == 'ms'
+    events = {event['name']: event for event in trace['traceEvents']}
+    assert all(event['ph'] == 'X' and event['cat'] == 'ssc' for event in events.values())
+    # microseconds
+    assert events['queue']['ts'] == 1500000
+    assert events['queue']['dur'] == 250000
+    assert events['execute']['args']['rows'] == 10
+    assert events['execute']['args']['parent'] == 'summary'
+    assert events['execute']['args']['query'] == 'cuped'
+    assert events['execute']['args']['metric'] == 'tvt'
+    assert 'tags' not in events['execute']['args']
+
+
+def test_summary():
+    summary = traced_run().summary()
+    assert list(summary.columns) == ['name', 'parent', 'wall_sec', 'cpu_sec', 'rows', 'bytes', 'peak_rss_bytes']
+    assert summary['name'].tolist() == ['execute', 'to_df', 'summary', 'queue']
+    assert summary.set_index('name').loc['to_df', 'bytes'] == 120
+    assert summary.set_index('name').loc['queue', 'wall_sec'] == 0.25
+
+
+@pytest.mark.parametrize('platform, expected', [('linux', 2048 * 1024), ('darwin', 2048)])
+def test_peak_rss_units(monkeypatch, platform, expected):
+    usage = types.SimpleNamespace(ru_maxrss = 2048)
+    monkeypatch.setattr(tracing, 'resource', types.SimpleNamespace(RUSAGE_SELF = 0, getrusage = lambda who: usage))
+    monkeypatch.setattr(tracing.sys, 'platform', platform)
+    assert peak_rss_bytes() == expected
+    monkeypatch.setattr(tracing, 'resource', None)
+    assert peak_rss_bytes() is None